@@ -0,0 +1,271 @@
+'''
+Aggregate tables for the sponsor and sector reports
+#################################
+The report figures are sums over the Worth and Donations tables
+by sponsor and tax year, and by tax year alone. AggregateCube keeps
+both as small tables in a folder, so a report is a lookup in them
+instead of a pass over the full data. New filings are folded in
+with refresh: a sponsor's Worth row for a year replaces the one it
+had, and its grants for a year are added to those already counted.
+Each set of grants a sponsor and year get in a refresh is recorded
+by a fingerprint of its rows, so passing the same filings again
+adds nothing, while a second or amended filing, or the rest of a
+filing whose grants come in a later refresh, is added. Only the
+tax years touched are summed again.
+
+    python aggregates.py -cube cube -worth Worth_export.csv -donations Donations_export.csv
+'''
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+import schema
+
+WORTH_MEASURES = ['daf_held_cnt', 'daf_contri_amt', 'daf_grants_amt', 'daf_eoy_amt',
+                  'other_act_held_cnt', 'other_act_contri_amt',
+                  'other_act_grants_amt', 'other_act_eoy_amt']
+FLAGS = ['disclosed_legal', 'disclosed_prps']
+GRANT_MEASURES = ['grant_cnt', 'grant_amt']
+KEYS = ['sponsor_ein', 'tax_year']
+# Donations columns that tell one grant from another, and the sums
+# of the two halves of their row hashes, kept apart so they can't
+# overflow
+GRANT_COLUMNS = ['cash_grant_amt', 'purpose_of_grant', 'grant_type', 'grantee_ein_id']
+HASH_SUMS = ['hash_high', 'hash_low']
+
+SPONSOR_YEAR_TABLE = ([('sponsor_ein', 'string'), ('tax_year', 'int')]
+                      + [(name, 'int') for name in WORTH_MEASURES]
+                      + [(name, 'bool') for name in FLAGS]
+                      + [(name, 'int') for name in GRANT_MEASURES])
+
+# flags become the number of sponsors that made the disclosure
+YEAR_TABLE = ([('tax_year', 'int'), ('sponsors', 'int')]
+              + [(name, 'int') for name in WORTH_MEASURES + FLAGS + GRANT_MEASURES]
+              + [('median_daf_avg_amt', 'float')])
+
+# sets of grants already counted, see grant_rows
+FILINGS_TABLE = [('sponsor_ein', 'string'), ('tax_year', 'int'), ('filing', 'string')]
+
+FILES = {'sponsor_year': 'sponsor_year.csv', 'year': 'year.csv', 'filings': 'filings.csv'}
+
+
+def empty(fields):
+    '''
+    Returns an empty Dataframe with the given columns and types.
+    '''
+    return pd.DataFrame(columns=schema.columns(fields)).astype(schema.dtypes(fields))
+
+def typed(data, fields):
+    '''
+    Gives an indexed table, index included, its schema types.
+    '''
+    keys = list(data.index.names)
+    return data.reset_index().astype(schema.dtypes(fields)).set_index(keys)
+
+def worth_rows(data):
+    '''
+    Sponsor and year rows from a chunk of the Worth table. Of two
+    filings for the same year, the later row is kept.
+    '''
+    data = data.rename(columns={'sponsor_ein_id': 'sponsor_ein'})
+    data = data.dropna(subset=KEYS).drop_duplicates(KEYS, keep='last')
+    return data.set_index(KEYS).loc[:, WORTH_MEASURES + FLAGS]
+
+def grant_rows(data):
+    '''
+    Number and total amount of grants for each sponsor and year
+    in a chunk of the Donations table, with the sums of their row
+    hashes (HASH_SUMS). Sums of chunks add up to those of the
+    whole table, so the number of grants and the hash sums
+    fingerprint a sponsor and year's grants however they were
+    split.
+    '''
+    data = data.rename(columns={'sponsor_ein_id': 'sponsor_ein'}).dropna(subset=KEYS)
+    fields = [field for field in schema.DONATION_TABLE if field[0] in GRANT_COLUMNS]
+    hashes = pd.util.hash_pandas_object(data.loc[:, GRANT_COLUMNS].astype(schema.dtypes(fields)),
+                                        index=False).to_numpy()
+    data = data.assign(hash_high=(hashes >> np.uint64(32)).astype(np.int64),
+                       hash_low=(hashes & np.uint64(0xFFFFFFFF)).astype(np.int64))
+    groups = data.groupby(KEYS)
+    grants = pd.DataFrame({'grant_cnt': groups['cash_grant_amt'].size(),
+                           'grant_amt': groups['cash_grant_amt'].sum(min_count=1)}).astype('Int64')
+    for name in HASH_SUMS:
+        grants[name] = groups[name].sum().astype(np.int64)
+    return grants
+
+def year_rows(sponsor_year):
+    '''
+    Sums sponsor and year rows by tax year.
+    '''
+    data = sponsor_year.reset_index()
+    data[FLAGS] = data[FLAGS].astype('Int64')
+    groups = data.groupby('tax_year')
+    years = groups[WORTH_MEASURES + FLAGS + GRANT_MEASURES].sum(min_count=1)
+    years.insert(0, 'sponsors', groups['sponsor_ein'].size())
+    held = data['daf_held_cnt'].astype(float).replace(0, np.nan)
+    average = data['daf_eoy_amt'].astype(float) / held
+    years['median_daf_avg_amt'] = average.groupby(data['tax_year']).median()
+    return years
+
+def changes(data):
+    '''
+    Adds the derived report figures to a table of years (one
+    sponsor's rows, many sponsors' or the sector's), in tax year
+    order: average worth of a DAF account, % change from the year
+    before for each amount and count, and amounts contributed and
+    granted so far.
+    '''
+    data = data.sort_index().copy()
+    years = pd.Series(np.asarray(data.index.get_level_values('tax_year'), dtype=float), index=data.index)
+    if 'sponsor_ein' in data.index.names:
+        groups = lambda frame: frame.groupby(level='sponsor_ein', sort=False)
+    else:
+        groups = lambda frame: frame.groupby(np.zeros(len(frame)))
+    data['daf_avg_amt'] = data['daf_eoy_amt'].astype(float) / data['daf_held_cnt'].astype(float).replace(0, np.nan)
+    consecutive = (years - groups(years).shift()) == 1
+    values = data[WORTH_MEASURES].astype(float)
+    change = (values / groups(values).shift() - 1) * 100
+    for name in WORTH_MEASURES:
+        data[name + '_pct_change'] = change[name].where(consecutive)
+    totals = ['daf_contri_amt', 'daf_grants_amt', 'other_act_contri_amt', 'other_act_grants_amt']
+    cumulative = groups(data[totals].astype(float).fillna(0)).cumsum()
+    for name in totals:
+        data[name + '_cumulative'] = cumulative[name]
+    return data
+
+
+class AggregateCube:
+    '''
+    Sponsor by year and year aggregates of Worth and Donations.
+    Input:
+        directory: folder the tables are kept in; read if they
+        exist, and written by refresh. None keeps them in memory.
+    Attributes:
+        sponsor_year: Dataframe indexed by sponsor EIN and tax year
+        year: Dataframe indexed by tax year
+        filings: Dataframe of the sets of grants counted, by
+        sponsor EIN, tax year and fingerprint
+    '''
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.sponsor_year = typed(empty(SPONSOR_YEAR_TABLE).set_index(KEYS), SPONSOR_YEAR_TABLE)
+        self.year = typed(empty(YEAR_TABLE).set_index('tax_year'), YEAR_TABLE)
+        self.filings = empty(FILINGS_TABLE)
+        if directory and os.path.exists(os.path.join(directory, FILES['sponsor_year'])):
+            self.sponsor_year = typed(self._read('sponsor_year', SPONSOR_YEAR_TABLE).set_index(KEYS),
+                                      SPONSOR_YEAR_TABLE)
+            self.year = typed(self._read('year', YEAR_TABLE).set_index('tax_year'), YEAR_TABLE)
+        if directory and os.path.exists(os.path.join(directory, FILES['filings'])):
+            self.filings = self._read('filings', FILINGS_TABLE)
+
+    def _read(self, name, fields):
+        return pd.read_csv(os.path.join(self.directory, FILES[name]), dtype=schema.dtypes(fields),
+                           keep_default_na=False, na_values=[''])
+
+    def save(self):
+        '''
+        Writes the tables to the cube's folder.
+        '''
+        os.makedirs(self.directory, exist_ok=True)
+        self.sponsor_year.to_csv(os.path.join(self.directory, FILES['sponsor_year']))
+        self.year.to_csv(os.path.join(self.directory, FILES['year']))
+        self.filings.to_csv(os.path.join(self.directory, FILES['filings']), index=False)
+        return None
+
+    def refresh(self, tables):
+        '''
+        Folds new filings into the cube.
+        Input: iterable of (table name, Dataframe), e.g. from
+        transform.iter_tables or bulk_upload.iter_csv_tables; only
+        Worth and Donations are used
+        Output: dictionary of the number of sponsor and year rows
+        and of tax years updated
+        '''
+        worth = [empty(SPONSOR_YEAR_TABLE).set_index(KEYS).loc[:, WORTH_MEASURES + FLAGS]]
+        grants = [grant_rows(empty(schema.DONATION_TABLE))]
+        for name, data in tables:
+            if name == 'Worth':
+                worth.append(worth_rows(data))
+            elif name == 'Donations':
+                grants.append(grant_rows(data))
+        worth = pd.concat(worth)
+        worth = worth[~worth.index.duplicated(keep='last')]
+        # a filing's grants may be split over chunks
+        grants = pd.concat(grants).groupby(level=KEYS).sum(min_count=1)
+        filings = grants.index.to_frame(index=False)
+        filings['filing'] = (grants['grant_cnt'].astype(str) + ':' + grants['hash_high'].astype(str)
+                             + ':' + grants['hash_low'].astype(str)).to_numpy()
+        filings = filings.astype(schema.dtypes(FILINGS_TABLE))
+        counted = pd.MultiIndex.from_frame(self.filings)
+        new = ~pd.MultiIndex.from_frame(filings).isin(counted)
+        grants = grants.loc[new, GRANT_MEASURES]
+        self.filings = pd.concat([self.filings, filings[new]], ignore_index=True)
+
+        data = self.sponsor_year
+        data = data.reindex(data.index.union(worth.index).union(grants.index))
+        replaced = data.index.isin(worth.index)
+        for name in WORTH_MEASURES + FLAGS:
+            data[name] = data[name].where(~replaced, worth[name].reindex(data.index))
+        for name in GRANT_MEASURES:
+            data[name] = data[name].add(grants[name].reindex(data.index), fill_value=0)
+        self.sponsor_year = typed(data, SPONSOR_YEAR_TABLE)
+
+        touched = worth.index.union(grants.index)
+        years = touched.get_level_values('tax_year').unique()
+        rows = self.sponsor_year[self.sponsor_year.index.get_level_values('tax_year').isin(years)]
+        year = pd.concat([self.year[~self.year.index.isin(years)], year_rows(rows)])
+        self.year = typed(year.sort_index(), YEAR_TABLE)
+        if self.directory:
+            self.save()
+        return {'sponsor_year': len(touched), 'year': len(years)}
+
+    def sponsor(self, ein, years=None):
+        '''
+        Rows of one sponsor, with the figures from changes.
+        Input:
+            ein: sponsor EIN, 9 digits
+            years: tax years wanted, all if None
+        '''
+        if ein in self.sponsor_year.index.get_level_values('sponsor_ein'):
+            data = changes(self.sponsor_year.xs(ein, level='sponsor_ein', drop_level=False))
+        else:
+            data = changes(self.sponsor_year.iloc[:0])
+        if years is not None:
+            data = data[data.index.get_level_values('tax_year').isin(years)]
+        return data
+
+    def sector(self, years=None):
+        '''
+        Rows of each tax year, with the figures from changes.
+        '''
+        data = changes(self.year)
+        if years is not None:
+            data = data[data.index.isin(years)]
+        return data
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+            description='Build or refresh the report aggregates')
+    parser.add_argument('-cube', type=str, default='cube',
+                    help='folder for the aggregate tables')
+    parser.add_argument('-worth', type=str,
+                    help='Worth csv from transform.py')
+    parser.add_argument('-donations', type=str,
+                    help='Donations csv from transform.py')
+    parser.add_argument('-sponsor_input', type=str,
+                    help='Sponsors file from read_folder.py, instead of -worth')
+    parser.add_argument('-grantee_input', type=str,
+                    help='Grantees file from read_folder.py, instead of -donations')
+    args = parser.parse_args()
+    if args.sponsor_input or args.grantee_input:
+        import transform
+        tables = transform.iter_tables(args.sponsor_input, args.grantee_input,
+                                       tables=['Worth', 'Donations'])
+    else:
+        import bulk_upload
+        tables = bulk_upload.iter_csv_tables({'Worth': args.worth, 'Donations': args.donations})
+    print(AggregateCube(args.cube).refresh(tables))
@@ -1,68 +1,896 @@
-import psycopg2
+'''
+Functions for step 3 of ETL
+#################################
+Loads the five tables from transform.py into Postgres. csv_load
+copies the csv files one after another; load_tables streams
+(table name, Dataframe) batches, such as transform.iter_tables,
+straight into the database with COPY, one connection per table,
+so no intermediate csv files are needed.
+'''
+
 import argparse
+import datetime
+import queue
+import re
+import sqlite3
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import numpy as np
 import pandas as pd
 
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+import entity_resolution
+import geocode
+import schema
+import transform
+
+# database table for each file written by transform.py
+DB_TABLES = {'Sponsors': 'dafs_sponsor',
+             'Taxperiod': 'dafs_taxperiod',
+             'Grantees': 'dafs_grantee',
+             'Worth': 'dafs_worth',
+             'Donations': 'dafs_donation'}
+
+# tables whose rows must be committed before a table's rows are
+DEPENDS_ON = {'Sponsors': [],
+              'Taxperiod': ['Sponsors'],
+              'Grantees': ['Sponsors'],
+              'Worth': ['Sponsors'],
+              'Donations': ['Sponsors', 'Grantees']}
+
+# columns that identify a row when merging a new load into the
+# tables; Donations are merged a whole filing at a time
+MERGE_KEYS = {'Sponsors': ['sponsor_ein'],
+              'Taxperiod': ['sponsor_ein_id', 'tax_year'],
+              'Grantees': ['grantee_ein'],
+              'Worth': ['sponsor_ein_id', 'tax_year'],
+              'Donations': ['sponsor_ein_id', 'tax_year']}
+FILING_TABLES = {'Donations'}
+
+# indexes for the sponsor and sector report queries: name, table,
+# key columns and columns included so the index alone answers them
+REPORT_INDEXES = [
+        ('dafs_worth_sponsor_year', 'dafs_worth', ['sponsor_ein_id', 'tax_year'],
+         ['daf_held_cnt', 'daf_contri_amt', 'daf_grants_amt', 'daf_eoy_amt',
+          'disclosed_legal', 'disclosed_prps', 'other_act_held_cnt', 'other_act_contri_amt',
+          'other_act_grants_amt', 'other_act_eoy_amt']),
+        ('dafs_worth_year', 'dafs_worth', ['tax_year'],
+         ['sponsor_ein_id', 'daf_held_cnt', 'daf_contri_amt', 'daf_grants_amt', 'daf_eoy_amt']),
+        ('dafs_taxperiod_sponsor_year', 'dafs_taxperiod', ['sponsor_ein_id', 'tax_year'], []),
+        ('dafs_donation_sponsor_year', 'dafs_donation', ['sponsor_ein_id', 'tax_year'],
+         ['grantee_ein_id', 'cash_grant_amt']),
+        ('dafs_donation_grantee', 'dafs_donation', ['grantee_ein_id'],
+         ['sponsor_ein_id', 'tax_year', 'cash_grant_amt']),
+        ('dafs_donation_year', 'dafs_donation', ['tax_year'], ['cash_grant_amt']),
+        ('dafs_sponsor_state', 'dafs_sponsor', ['state'], ['sponsor_ein']),
+        ('dafs_grantee_state', 'dafs_grantee', ['state'], ['grantee_ein', 'irs_section_desc'])]
+
+# definitions of indexes dropped for a load, kept until rebuilt
+DROPPED_INDEXES = 'load_dropped_indexes'
+
+# primary key of each table in the embedded databases; the
+# others have a generated id
+PRIMARY_KEYS = {'Sponsors': 'sponsor_ein', 'Grantees': 'grantee_ein'}
+
+# binary COPY: signature, flags and header extension length;
+# the file ends with a field count of -1
+BINARY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+BINARY_TRAILER = struct.pack('>h', -1)
+NULL = struct.pack('>i', -1)
+# dates are sent as days since 2000-01-01
+EPOCH = pd.Timestamp(datetime.date(2000, 1, 1))
+
+# Postgres column type (udt_name): NumPy type of its binary form
+BINARY_NUMBERS = {'int2': '>i2', 'int4': '>i4', 'int8': '>i8',
+                  'float4': '>f4', 'float8': '>f8', 'bool': '?', 'date': '>i4'}
+BINARY_TEXT = {'text', 'varchar', 'bpchar', 'name'}
+# rows of each table's first batch decoded again and compared with
+# the Dataframe before they are sent, see check_binary
+CHECK_ROWS = 1000
+
+
+def connect(host, port, user_name, db_name, password):
+    '''
+    Opens a connection to the database.
+    '''
+    if psycopg2 is None:
+        raise ImportError("psycopg2 is needed to load the database")
+    return psycopg2.connect(dbname=db_name, user=user_name, password=password,
+                            host=host, port=port)
+
+def table_columns(name, ids=True):
+    '''
+    Returns the columns of a transform.py table in the order they
+    are copied, starting with id for tables written with one
+    unless ids is False.
+    '''
+    fields, index = transform.TABLES[name]
+    return (['id'] if index and ids else []) + schema.columns(fields)
+
+def with_id(name, data):
+    '''
+    Adds the row number as the id column for the tables that
+    are written with one.
+    '''
+    if transform.TABLES[name][1]:
+        data = data.rename_axis('id').reset_index()
+    return data
+
+def copy_statement(table, columns, binary=False):
+    return "COPY {} ({}) FROM STDIN WITH (FORMAT {});".format(
+            table, ', '.join(columns), 'binary' if binary else 'csv')
+
+def create_stage(cur, name):
+    '''
+    Creates (or empties) the unlogged staging table a table is
+    copied into before merge_stage.
+    '''
+    # no constraints, so id can be left out
+    cur.execute("""CREATE UNLOGGED TABLE IF NOT EXISTS stage_{0} AS
+                   SELECT * FROM {0} WITH NO DATA;""".format(DB_TABLES[name]))
+    # numbers the rows in the order COPY reads them, for merge_stage
+    cur.execute("ALTER TABLE stage_{} ADD COLUMN IF NOT EXISTS stage_row bigserial;".format(DB_TABLES[name]))
+    cur.execute("TRUNCATE stage_{} RESTART IDENTITY;".format(DB_TABLES[name]))
+    return None
+
+def reset_id_sequence(cur, name):
+    '''
+    Moves the id sequence of a table past the ids already used,
+    since copying ids in doesn't advance it.
+    '''
+    if transform.TABLES[name][1]:
+        cur.execute("""SELECT setval(pg_get_serial_sequence('{0}', 'id'),
+                       COALESCE((SELECT MAX(id) FROM {0}), 0) + 1, false);""".format(DB_TABLES[name]))
+    return None
+
+def merge_stage(cur, name):
+    '''
+    Merges the staging table into its table, matching rows on
+    MERGE_KEYS. A new key is inserted; an existing key is updated
+    if any of its values changed and skipped otherwise, and of
+    rows repeating a key in the staging table only the last is
+    used. For FILING_TABLES, the rows of a filing (sponsor and tax
+    year) already in the table are skipped, the rest inserted.
+    New rows get ids from the table's sequence.
+    Output: dictionary of inserted, updated and skipped row counts
+    '''
+    table = DB_TABLES[name]
+    stage = 'stage_' + table
+    keys = MERGE_KEYS[name]
+    columns = table_columns(name, ids=False)
+    values = [col for col in columns if col not in keys]
+    match = ' AND '.join('t.{0} = m.{0}'.format(key) for key in keys)
+    cols = ', '.join(columns)
+    reset_id_sequence(cur, name)
+
+    cur.execute("SELECT COUNT(*) FROM {};".format(stage))
+    staged = cur.fetchone()[0]
+    updated = 0
+    if name in FILING_TABLES:
+        cur.execute("""INSERT INTO {0} ({1}) SELECT {1} FROM {2} m
+                       WHERE NOT EXISTS (SELECT 1 FROM {0} t WHERE {3});""".format(
+                    table, cols, stage, match))
+        inserted = cur.rowcount
+    else:
+        cur.execute("""CREATE TEMP TABLE merge_rows ON COMMIT DROP AS
+                       SELECT DISTINCT ON ({0}) {1} FROM {2} ORDER BY {0}, stage_row DESC;""".format(
+                    ', '.join(keys), cols, stage))
+        if values:
+            cur.execute("""UPDATE {0} t SET {1} FROM merge_rows m WHERE {2}
+                           AND ({3}) IS DISTINCT FROM ({4});""".format(
+                        table, ', '.join('{0} = m.{0}'.format(col) for col in values), match,
+                        ', '.join('t.' + col for col in values), ', '.join('m.' + col for col in values)))
+            updated = cur.rowcount
+        cur.execute("""INSERT INTO {0} ({1}) SELECT {1} FROM merge_rows m
+                       WHERE NOT EXISTS (SELECT 1 FROM {0} t WHERE {2});""".format(table, cols, match))
+        inserted = cur.rowcount
+        cur.execute("DROP TABLE merge_rows;")
+    cur.execute("TRUNCATE {} RESTART IDENTITY;".format(stage))
+    return {'inserted': inserted, 'updated': updated, 'skipped': staged - inserted - updated}
+
+def column_types(cur, table):
+    '''
+    Returns a dictionary of column name to Postgres type name
+    (e.g. int4, varchar) for a table.
+    '''
+    cur.execute("""SELECT column_name, udt_name FROM information_schema.columns
+                   WHERE table_name = %s""", (table,))
+    return dict(cur.fetchall())
+
+def _binary_numbers(column, kind):
+    '''
+    Length-prefixed big-endian values of a number or boolean
+    column, one bytes object per row.
+    '''
+    code = np.dtype(kind).kind
+    missing = column.isna().to_numpy()
+    values = column.to_numpy(dtype='float64' if code == 'f' else None, na_value=0)
+    if code == 'i':
+        info = np.iinfo(kind)
+        values = values.astype('int64')
+        if len(values) and (values.min() < info.min or values.max() > info.max):
+            raise ValueError("values too large for a {} byte integer column".format(info.bits // 8))
+    width = np.dtype(kind).itemsize
+    packed = np.empty(len(values), dtype=[('length', '>i4'), ('value', kind)])
+    packed['length'] = width
+    packed['value'] = values
+    raw = packed.tobytes()
+    step = width + 4
+    return [NULL if missing[row] else raw[row * step:(row + 1) * step]
+            for row in range(len(values))]
+
+def _binary_text(column):
+    values = column.astype(object).where(column.notna(), None)
+    fields = []
+    for value in values:
+        if value is None:
+            fields.append(NULL)
+        else:
+            value = str(value).encode('utf-8')
+            fields.append(struct.pack('>i', len(value)) + value)
+    return fields
+
+def encode_binary(data, types):
+    '''
+    Encodes a Dataframe as rows of Postgres binary COPY data,
+    without the header and trailer.
+    Input:
+        data: Dataframe with the columns to copy, in order
+        types: dictionary of column name to Postgres type, from
+        column_types
+    Output: bytes
+    '''
+    columns = []
+    for name in data.columns:
+        kind = types.get(name)
+        if kind == 'date':
+            # dates as text, e.g. 2017-04-01
+            dates = pd.to_datetime(data[name], errors='coerce')
+            bad = dates.isna() & data[name].notna()
+            if bad.any():
+                # csv COPY would have Postgres reject them too
+                raise ValueError("column {} has values that aren't dates, e.g. {!r}".format(
+                                 name, data[name][bad].iloc[0]))
+            days = (dates - EPOCH).dt.days
+            columns.append(_binary_numbers(days, BINARY_NUMBERS[kind]))
+        elif kind in BINARY_NUMBERS:
+            columns.append(_binary_numbers(data[name], BINARY_NUMBERS[kind]))
+        elif kind in BINARY_TEXT:
+            columns.append(_binary_text(data[name]))
+        else:
+            raise ValueError("binary COPY can't send column {} of type {}".format(name, kind))
+    count = struct.pack('>h', len(columns))
+    return b''.join(count + b''.join(row) for row in zip(*columns))
+
+def decode_binary(raw, types, columns, limit=None):
+    '''
+    Reads back rows encoded by encode_binary.
+    Input:
+        raw: bytes, without the header and trailer
+        types: dictionary of column name to Postgres type
+        columns: names of the columns, in order
+        limit: most rows to read, all if None
+    Output: list of row tuples; None for NULL, datetime.date for
+    dates
+    '''
+    rows = []
+    position = 0
+    while position < len(raw) and (limit is None or len(rows) < limit):
+        count, = struct.unpack_from('>h', raw, position)
+        position += 2
+        if count != len(columns):
+            raise ValueError("row {} has {} fields, not {}".format(len(rows), count, len(columns)))
+        row = []
+        for name in columns:
+            length, = struct.unpack_from('>i', raw, position)
+            position += 4
+            if length == -1:
+                row.append(None)
+                continue
+            value = raw[position:position + length]
+            position += length
+            kind = types[name]
+            if kind in BINARY_NUMBERS:
+                number = np.dtype(BINARY_NUMBERS[kind])
+                if length != number.itemsize:
+                    raise ValueError("{} field of {} bytes in column {}".format(kind, length, name))
+                value = np.frombuffer(value, number)[0].item()
+                if kind == 'date':
+                    value = EPOCH.date() + datetime.timedelta(days=value)
+            else:
+                value = value.decode('utf-8')
+            row.append(value)
+        rows.append(tuple(row))
+    return rows
+
+def _binary_value(value, kind):
+    # what a field should hold, one value at a time, as decode_binary
+    # returns it
+    if pd.isna(value):
+        return None
+    if kind == 'date':
+        return pd.Timestamp(value).date()
+    if kind in BINARY_NUMBERS:
+        return np.array(value).astype(np.dtype(BINARY_NUMBERS[kind]).newbyteorder('=')).item()
+    return str(value)
+
+def check_binary(data, types):
+    '''
+    Encodes a Dataframe with encode_binary, checking that its
+    first CHECK_ROWS rows decode to the values they came from.
+    Output: bytes, as from encode_binary
+    '''
+    raw = encode_binary(data, types)
+    sample = data.iloc[:CHECK_ROWS]
+    expected = [tuple(_binary_value(value, types[name]) for name, value in zip(sample.columns, row))
+                for row in sample.itertuples(index=False)]
+    decoded = decode_binary(raw, types, list(data.columns), CHECK_ROWS)
+    if decoded != expected:
+        row = next(row for row, (a, b) in enumerate(zip(decoded, expected)) if a != b)
+        raise ValueError("binary COPY row {} decodes to {}, not {}".format(row, decoded[row], expected[row]))
+    return raw
+
+def encode_csv(data):
+    '''
+    Encodes a Dataframe as rows of csv COPY data: no header,
+    missing values as empty fields.
+    '''
+    return data.to_csv(header=False, index=False).encode('utf-8')
+
+
+class CopyStream:
+    '''
+    File-like object that COPY reads a table's rows from. Batches
+    are queued by the thread producing them and encoded by the
+    thread running the COPY.
+    Input:
+        name: transform.py table name
+        types: column types for binary COPY, or None for csv
+        size: most batches to hold before put waits
+        ids: send the row number as id, for tables that have one
+    '''
+    def __init__(self, name, types=None, size=4, ids=True):
+        self.name = name
+        self.types = types
+        self.ids = ids
+        self.batches = queue.Queue(size)
+        self.buffer = BINARY_HEADER if types is not None else b''
+        self.finished = False
+        self.closed = False
+        self.rows = 0
+        self.checked = False
+
+    def put(self, data):
+        '''
+        Queues a batch; dropped if the COPY has already stopped.
+        '''
+        while not self.closed:
+            try:
+                self.batches.put(data, timeout=0.5)
+                return None
+            except queue.Full:
+                pass
+        return None
+
+    def close(self):
+        '''
+        Marks the end of the table's rows.
+        '''
+        self.put(None)
+        return None
+
+    def read(self, size=-1):
+        while not self.finished and (size < 0 or len(self.buffer) < size):
+            data = self.batches.get()
+            if data is None:
+                self.finished = True
+                if self.types is not None:
+                    self.buffer += BINARY_TRAILER
+                break
+            if self.ids:
+                data = with_id(self.name, data)
+            self.rows += len(data)
+            if self.types is not None and not self.checked:
+                self.buffer += check_binary(data, self.types)
+                self.checked = True
+            elif self.types is not None:
+                self.buffer += encode_binary(data, self.types)
+            else:
+                self.buffer += encode_csv(data)
+        if size < 0:
+            size = len(self.buffer)
+        chunk, self.buffer = self.buffer[:size], self.buffer[size:]
+        return chunk
+
+    def stop(self):
+        '''
+        Discards queued batches so a producer waiting in put
+        doesn't block forever.
+        '''
+        self.closed = True
+        while True:
+            try:
+                self.batches.get_nowait()
+            except queue.Empty:
+                break
+        return None
+
+
+class TableLoader(threading.Thread):
+    '''
+    Copies one table over its own connection, in one transaction.
+    The transaction is committed only after those of the tables it
+    depends on, which lets deferred foreign keys (the Django
+    default) find the rows they point to.
+    Input:
+        name: transform.py table name
+        connect_args: dictionary of arguments for connect
+        loaders: dictionary of table name to TableLoader
+        binary: use binary COPY where the table's column types allow
+        incremental: copy into a staging table and merge it into
+        the table (merge_stage) instead of copying into the table
+    Attributes:
+        result: rows copied, or the merge_stage counts
+        error: exception that stopped the load, if any
+    '''
+    def __init__(self, name, connect_args, loaders, binary=False, incremental=False):
+        super().__init__(name='load-' + name, daemon=True)
+        self.table = name
+        self.connect_args = connect_args
+        self.loaders = loaders
+        self.binary = binary
+        self.incremental = incremental
+        self.ready = threading.Event()
+        self.done = threading.Event()
+        self.stream = None
+        self.result = 0
+        self.error = None
+
+    def run(self):
+        conn = None
+        try:
+            conn = connect(**self.connect_args)
+            cur = conn.cursor()
+            table = DB_TABLES[self.table]
+            columns = table_columns(self.table, ids=not self.incremental)
+            if self.incremental:
+                create_stage(cur, self.table)
+                table = 'stage_' + table
+            types = None
+            if self.binary:
+                types = column_types(cur, DB_TABLES[self.table])
+                if not all(types.get(col) in BINARY_NUMBERS or types.get(col) in BINARY_TEXT
+                           for col in columns):
+                    # e.g. numeric columns; fall back to csv for this table
+                    types = None
+            self.stream = CopyStream(self.table, types, ids=not self.incremental)
+            self.ready.set()
+            cur.copy_expert(copy_statement(table, columns, types is not None),
+                            self.stream, size=1 << 20)
+            if self.incremental:
+                self.result = merge_stage(cur, self.table)
+            else:
+                reset_id_sequence(cur, self.table)
+                self.result = self.stream.rows
+            for other in DEPENDS_ON[self.table]:
+                if other in self.loaders:
+                    self.loaders[other].done.wait()
+                    if self.loaders[other].error is not None:
+                        raise RuntimeError("{} was not loaded".format(other))
+            conn.commit()
+        except Exception as e:
+            self.error = e
+            if conn is not None:
+                conn.rollback()
+        finally:
+            if self.stream is not None:
+                self.stream.stop()
+            if conn is not None:
+                conn.close()
+            self.ready.set()
+            self.done.set()
+
+    def put(self, data):
+        self.ready.wait()
+        if self.stream is not None:
+            self.stream.put(data)
+        return None
+
+    def close(self):
+        self.ready.wait()
+        if self.stream is not None:
+            self.stream.close()
+        return None
+
+
+def load_tables(tables, connect_args, binary=False, incremental=False, names=DB_TABLES):
+    '''
+    Streams batches of the transform.py tables into the database
+    over one connection per table. Each table is one transaction,
+    committed after the tables it depends on (DEPENDS_ON).
+    Input:
+        tables: iterable of (table name, Dataframe), e.g.
+        transform.iter_tables(...) or a list of batches in memory
+        connect_args: dictionary of host, port, user_name,
+        db_name and password
+        binary: use binary COPY instead of csv
+        incremental: merge into tables that already have rows,
+        see merge_stage
+        names: tables to load
+    Output: dictionary of table name to rows loaded (or, if
+    incremental, inserted/updated/skipped counts), or to the
+    exception that stopped it
+    '''
+    loaders = {}
+    for name in names:
+        loaders[name] = TableLoader(name, connect_args, loaders, binary, incremental)
+    for loader in loaders.values():
+        loader.start()
+    try:
+        for name, data in tables:
+            loaders[name].put(data)
+    finally:
+        for loader in loaders.values():
+            loader.close()
+        for loader in loaders.values():
+            loader.join()
+    return {name: loader.error if loader.error is not None else loader.result
+            for name, loader in loaders.items()}
+
 def csv_load(sponsors_file, grantees_file,
             taxperiod_file, worth_file,
-            donations_file, host, port, 
-            user_name, db_name, password):
+            donations_file, host, port,
+            user_name, db_name, password, incremental=False):
     '''
     Load data from csv file into database tables for testing.
     ***SPONSORS MUST BE LOADED IN BEFORE GRANTEES***
     Input:
-    files: csv files for sponsor, grantee, taxperiod, 
+    files: csv files for sponsor, grantee, taxperiod,
             donation, and worth tables
     host: database host
     port: port connection is listening on
     db_name: database name
     user_name: username for db
     password: password for db
+    incremental: merge each file into its table through a
+            staging table (merge_stage) and print the counts
     Output: None
     '''
-    conn = psycopg2.connect(dbname=db_name, user=user_name, password=password,
-                            host=host, port=port)
+    conn = connect(host, port, user_name, db_name, password)
     cur = conn.cursor()
 
-    upload_files = [('sponsors', sponsors_file),
-                    ('taxperiod', taxperiod_file),
-                    ('grantees', grantees_file),
-                    ('worth', worth_file),
-                    ('donations', donations_file)]
+    upload_files = [('Sponsors', sponsors_file),
+                    ('Taxperiod', taxperiod_file),
+                    ('Grantees', grantees_file),
+                    ('Worth', worth_file),
+                    ('Donations', donations_file)]
 
-    copy_statements = {'sponsors':
-            """COPY dafs_sponsor
-            FROM STDIN
-            WITH (FORMAT csv, HEADER TRUE);""",
-            'taxperiod':
-            """COPY dafs_taxperiod
-            FROM STDIN
-            WITH (FORMAT csv, HEADER TRUE);""",     
-            'grantees':       
-            """COPY dafs_grantee
-            FROM STDIN
-            WITH (FORMAT csv, HEADER TRUE);""",
-            'worth':
-            """COPY dafs_worth
-            FROM STDIN
-            WITH (FORMAT csv, HEADER TRUE);""",
-            'donations':
-            """COPY dafs_donation
-            FROM STDIN
-            WITH (FORMAT csv, HEADER TRUE);""" }
-    
     for item in upload_files:
         name, table = item
         with open(table) as f:
             try:
-                cur.copy_expert(copy_statements[name], f)
+                if incremental:
+                    create_stage(cur, name)
+                    cur.copy_expert("""COPY stage_{} ({})
+            FROM STDIN
+            WITH (FORMAT csv, HEADER TRUE);""".format(DB_TABLES[name], ', '.join(table_columns(name))), f)
+                    print(name, merge_stage(cur, name))
+                else:
+                    cur.copy_expert("""COPY {}
+            FROM STDIN
+            WITH (FORMAT csv, HEADER TRUE);""".format(DB_TABLES[name]), f)
                 conn.commit()
             except Exception as e:
                 print(e)
                 conn.rollback()
-        
+
     cur.close()
     conn.close()
 
+def secondary_indexes(cur, table):
+    '''
+    Returns (qualified name, name, definition) of the indexes on
+    a table that don't back a primary key, unique or exclusion
+    constraint.
+    '''
+    cur.execute("""SELECT i.indexrelid::regclass::text, x.relname, pg_get_indexdef(i.indexrelid)
+                   FROM pg_index i JOIN pg_class t ON t.oid = i.indrelid
+                   JOIN pg_class x ON x.oid = i.indexrelid
+                   WHERE t.relname = %s AND NOT EXISTS
+                   (SELECT 1 FROM pg_constraint c WHERE c.conindid = i.indexrelid)""", (table,))
+    return cur.fetchall()
+
+def _if_not_exists(definition):
+    # so a saved definition can be run again safely
+    return re.sub(r'^CREATE (UNIQUE )?INDEX ', r'CREATE \1INDEX IF NOT EXISTS ', definition) + ';'
+
+def saved_indexes(cur):
+    '''
+    Returns the (name, statement) of indexes dropped by
+    drop_indexes and not yet rebuilt, e.g. because the load
+    was killed before it could rebuild them.
+    '''
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (DROPPED_INDEXES,))
+    if not cur.fetchone()[0]:
+        return []
+    cur.execute("SELECT name, definition FROM {} ORDER BY name;".format(DROPPED_INDEXES))
+    return cur.fetchall()
+
+def saved_index_statements(connect_args):
+    '''
+    saved_indexes over a new connection.
+    '''
+    conn = connect(**connect_args)
+    try:
+        return saved_indexes(conn.cursor())
+    finally:
+        conn.close()
+
+def drop_indexes(connect_args, names=DB_TABLES):
+    '''
+    Drops the secondary indexes of the tables before a bulk load,
+    so COPY doesn't have to keep them up to date row by row.
+    Their definitions are saved in the DROPPED_INDEXES table in the
+    same transaction, and removed from it by create_indexes, so
+    they survive a load that is killed part way.
+    Output: list of (index name, CREATE INDEX statement) to rebuild
+    them with, including any left from an earlier run
+    '''
+    conn = connect(**connect_args)
+    cur = conn.cursor()
+    cur.execute("""CREATE TABLE IF NOT EXISTS {} (name text PRIMARY KEY,
+                   definition text NOT NULL);""".format(DROPPED_INDEXES))
+    definitions = saved_indexes(cur)
+    for name in names:
+        for index, index_name, definition in secondary_indexes(cur, DB_TABLES[name]):
+            statement = _if_not_exists(definition)
+            cur.execute("""INSERT INTO {} (name, definition) VALUES (%s, %s)
+                           ON CONFLICT (name) DO UPDATE SET definition = EXCLUDED.definition;"""
+                        .format(DROPPED_INDEXES), (index_name, statement))
+            cur.execute("DROP INDEX {};".format(index))
+            definitions.append((index_name, statement))
+    conn.commit()
+    conn.close()
+    return definitions
+
+def report_index_statements(indexes=REPORT_INDEXES):
+    '''
+    Returns the (index name, CREATE INDEX statement) for
+    REPORT_INDEXES.
+    '''
+    statements = []
+    for index, table, keys, include in indexes:
+        statement = "CREATE INDEX IF NOT EXISTS {} ON {} ({})".format(index, table, ', '.join(keys))
+        if include:
+            statement += " INCLUDE ({})".format(', '.join(include))
+        statements.append((index, statement + ';'))
+    return statements
+
+def _run(connect_args, statement, saved=None):
+    conn = connect(**connect_args)
+    try:
+        with conn:
+            cur = conn.cursor()
+            cur.execute(statement)
+            if saved is not None:
+                cur.execute("DELETE FROM {} WHERE name = %s;".format(DROPPED_INDEXES), (saved,))
+    finally:
+        conn.close()
+    return None
+
+def create_indexes(statements, connect_args, workers=4, names=DB_TABLES):
+    '''
+    Runs CREATE INDEX statements, each over its own connection
+    and up to <workers> at a time (index builds on the same table
+    don't block each other), then ANALYZEs the tables so the
+    planner knows about the new rows. An index's saved definition
+    (see drop_indexes) is removed once it is rebuilt.
+    Input: list of (index name, statement); of statements for the
+    same index, e.g. a dropped report index and its entry in
+    REPORT_INDEXES, only the first is run
+    '''
+    unique = {}
+    for name, statement in statements:
+        unique.setdefault(name, statement)
+    conn = connect(**connect_args)
+    try:
+        saved = {name for name, definition in saved_indexes(conn.cursor())}
+    finally:
+        conn.close()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_run, connect_args, statement, name if name in saved else None)
+                   for name, statement in unique.items()]
+        for future in futures:
+            future.result()
+    for name in names:
+        _run(connect_args, "ANALYZE {};".format(DB_TABLES[name]))
+    return None
+
+def iter_csv_tables(files, chunksize=transform.CHUNKSIZE):
+    '''
+    Reads the csv files written by transform.py a chunk at a
+    time, with their schema.py types and id (where they have
+    one) as the index.
+    Input:
+        files: dictionary of table name to csv file
+    Output: generator of (table name, Dataframe)
+    '''
+    for name, file in files.items():
+        if not file:
+            continue
+        fields, index = transform.TABLES[name]
+        for data in pd.read_csv(file, dtype=schema.dtypes(fields), keep_default_na=False,
+                                na_values=[''], chunksize=chunksize):
+            if index:
+                data = data.set_index('id')
+            yield (name, data)
+
+
+class EmbeddedStore:
+    '''
+    The five tables in a local database file instead of Postgres,
+    with the same columns, keys and report indexes. Subclasses
+    give the column types and the bulk insert. Ids are generated
+    by the database, so loads of different years can go into the
+    same file. As in an incremental Postgres load, rows loaded
+    again replace the rows with the same MERGE_KEYS, and
+    Donations filings already in the file are skipped, so a load
+    can be run again. A load is one transaction.
+    Input:
+        path: database file
+    '''
+    TYPES = {}
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = self.connect(path)
+        self.create_tables()
+        # Donations filings in the file before this load
+        self.filings = None
+
+    def id_column(self, table):
+        return 'id INTEGER PRIMARY KEY'
+
+    def create_tables(self):
+        for name, table in DB_TABLES.items():
+            fields, index = transform.TABLES[name]
+            columns = ['{} {}'.format(col, self.TYPES[kind]) for col, kind in fields]
+            if name in PRIMARY_KEYS:
+                columns.append('PRIMARY KEY ({})'.format(PRIMARY_KEYS[name]))
+            else:
+                columns.insert(0, self.id_column(table))
+            if name not in PRIMARY_KEYS and name not in FILING_TABLES:
+                columns.append('UNIQUE ({})'.format(', '.join(MERGE_KEYS[name])))
+            self.conn.execute("CREATE TABLE IF NOT EXISTS {} ({});".format(table, ', '.join(columns)))
+        return None
+
+    def insert_statement(self, name, source):
+        columns = table_columns(name, ids=False)
+        statement = "INSERT INTO {} ({}) {}".format(DB_TABLES[name], ', '.join(columns), source)
+        if name not in FILING_TABLES:
+            keys = MERGE_KEYS[name]
+            statement += " ON CONFLICT ({}) DO UPDATE SET {}".format(', '.join(keys), ', '.join(
+                    '{0} = excluded.{0}'.format(col) for col in columns if col not in keys))
+        return statement
+
+    def new_rows(self, name, data):
+        '''
+        Drops rows that would repeat a key within the batch (the
+        last is kept) and Donations of filings already in the file.
+        '''
+        keys = MERGE_KEYS[name]
+        if name not in FILING_TABLES:
+            return data.drop_duplicates(keys, keep='last')
+        if self.filings is None:
+            self.filings = set(self.conn.execute("SELECT DISTINCT {} FROM {};".format(
+                    ', '.join(keys), DB_TABLES[name])).fetchall())
+        filings = pd.Series(list(zip(*(data[key].astype(object) for key in keys))), index=data.index)
+        return data[~filings.isin(self.filings)]
+
+    def create_indexes(self, indexes=REPORT_INDEXES):
+        '''
+        Creates REPORT_INDEXES; included columns become trailing
+        key columns, so the indexes still cover the report queries.
+        '''
+        for index, table, keys, include in indexes:
+            self.conn.execute("CREATE INDEX IF NOT EXISTS {} ON {} ({});".format(
+                    index, table, ', '.join(keys + include)))
+        self.conn.execute("ANALYZE;")
+        return None
+
+    def close(self, commit=True):
+        if commit:
+            self.conn.commit()
+        else:
+            self.conn.rollback()
+        self.conn.close()
+        return None
+
+
+class SQLiteStore(EmbeddedStore):
+    '''
+    Tables in an SQLite database file (sqlite3 is built in).
+    '''
+    TYPES = {'string': 'TEXT', 'int': 'INTEGER', 'bool': 'BOOLEAN',
+             'float': 'REAL', 'category': 'TEXT'}
+
+    def connect(self, path):
+        return sqlite3.connect(path)
+
+    def insert(self, name, data):
+        data = self.new_rows(name, data.loc[:, table_columns(name, ids=False)])
+        rows = data.astype(object).where(data.notna(), None).itertuples(index=False, name=None)
+        self.conn.executemany(self.insert_statement(name, 'VALUES ({})'.format(
+                ', '.join('?' * data.shape[1]))), rows)
+        return None
+
+
+class DuckDBStore(EmbeddedStore):
+    '''
+    Tables in a DuckDB database file; needs the duckdb package.
+    Batches are inserted straight from the Dataframe.
+    '''
+    TYPES = {'string': 'VARCHAR', 'int': 'BIGINT', 'bool': 'BOOLEAN',
+             'float': 'DOUBLE', 'category': 'VARCHAR'}
+
+    def connect(self, path):
+        if duckdb is None:
+            raise ImportError("duckdb is needed for the duckdb backend")
+        conn = duckdb.connect(path)
+        conn.begin()
+        return conn
+
+    def id_column(self, table):
+        self.conn.execute("CREATE SEQUENCE IF NOT EXISTS {}_id;".format(table))
+        return "id BIGINT PRIMARY KEY DEFAULT nextval('{}_id')".format(table)
+
+    def insert(self, name, data):
+        self.conn.register('batch', self.new_rows(name, data.loc[:, table_columns(name, ids=False)]))
+        self.conn.execute(self.insert_statement(name, 'SELECT * FROM batch'))
+        self.conn.unregister('batch')
+        return None
+
+
+BACKENDS = {'sqlite': SQLiteStore, 'duckdb': DuckDBStore}
+
+def store_tables(tables, path, backend='sqlite'):
+    '''
+    Writes batches of the transform.py tables into an embedded
+    database file, then creates the report indexes.
+    Input:
+        tables: iterable of (table name, Dataframe), e.g.
+        transform.iter_tables(...) or iter_csv_tables(...)
+        path: database file
+        backend: 'sqlite' or 'duckdb'
+    Output: dictionary of table name to rows written
+    '''
+    store = BACKENDS[backend](path)
+    rows = dict.fromkeys(DB_TABLES, 0)
+    committed = False
+    try:
+        for name, data in tables:
+            store.insert(name, data)
+            rows[name] += len(data)
+        store.create_indexes()
+        committed = True
+    finally:
+        # a failed load leaves the file as it was
+        store.close(committed)
+    return rows
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
             description='bulk upload data files to database')
@@ -76,18 +904,77 @@ if __name__ == "__main__":
                     help='worth table csv')
     parser.add_argument('-donation',type=str,
                     help='donation table csv')
+    parser.add_argument('-sponsor_input',type=str,
+                    help='Sponsors file from read_folder.py; with -grantee_input, \
+                    transforms and loads in one step without writing csv files')
+    parser.add_argument('-grantee_input',type=str,
+                    help='Grantees file from read_folder.py')
+    parser.add_argument('-grantee_map',type=str,
+                    help='grantee id map from entity_resolution.py, used with -grantee_input')
+    parser.add_argument('-geocode',type=str,
+                    help='ZIP code centroid file for geocode.py, used with -sponsor_input and -grantee_input')
+    parser.add_argument('-addresses',type=str,
+                    help='optional street address coordinates for geocode.py')
+    parser.add_argument('-chunksize',type=int, default=transform.CHUNKSIZE,
+                    help='rows transformed and copied at a time')
+    parser.add_argument('--binary', action='store_true',
+                    help='use binary COPY when loading from read_folder.py files')
+    parser.add_argument('--incremental', action='store_true',
+                    help='merge into tables that already have rows, through staging tables')
+    parser.add_argument('--drop_indexes', action='store_true',
+                    help='drop secondary indexes before loading and rebuild them after')
+    parser.add_argument('--report_indexes', action='store_true',
+                    help='create the indexes used by the report queries after loading')
+    parser.add_argument('-index_workers', type=int, default=4,
+                    help='number of indexes to build at once')
+    parser.add_argument('-backend', type=str, default='postgres',
+                    choices=['postgres'] + list(BACKENDS),
+                    help='database to load: a Postgres server or an embedded database file')
+    parser.add_argument('-db_file', type=str, default='dafs.sqlite',
+                    help='database file for the sqlite and duckdb backends')
     parser.add_argument('-host', type=str,
                     help="db host")
     parser.add_argument('-port', type=int,
-                    help="db port")    
+                    help="db port")
     parser.add_argument('-username',type=str,
                     help='db username')
     parser.add_argument('-dbname',type=str,
                     help='db name')
     parser.add_argument('-password',type=str,
-                    help='db password')                                       
+                    help='db password')
     args = parser.parse_args()
-    csv_load(sponsors_file=args.sponsor, grantees_file=args.grantee,
-            taxperiod_file=args.tax, worth_file=args.worth,
-            donations_file=args.donation, host=args.host, 
-            port=args.port, user_name=args.username, db_name=args.dbname, password=args.password)
\ No newline at end of file
+    grantee_ids = None
+    if args.grantee_map:
+        grantee_ids = entity_resolution.GranteeMap(entity_resolution.read_map(args.grantee_map))
+    geocoder = geocode.Geocoder(args.geocode, args.addresses) if args.geocode else None
+    if args.backend != 'postgres':
+        if args.sponsor_input or args.grantee_input:
+            tables = transform.iter_tables(args.sponsor_input, args.grantee_input, args.chunksize,
+                                           grantee_ids=grantee_ids, geocoder=geocoder)
+        else:
+            tables = iter_csv_tables({'Sponsors': args.sponsor, 'Taxperiod': args.tax,
+                                      'Grantees': args.grantee, 'Worth': args.worth,
+                                      'Donations': args.donation}, args.chunksize)
+        for name, rows in store_tables(tables, args.db_file, args.backend).items():
+            print(name, rows)
+    else:
+        connect_args = {'host': args.host, 'port': args.port, 'user_name': args.username,
+                        'db_name': args.dbname, 'password': args.password}
+        # indexes left dropped by an interrupted run are rebuilt too
+        indexes = drop_indexes(connect_args) if args.drop_indexes else saved_index_statements(connect_args)
+        try:
+            if args.sponsor_input or args.grantee_input:
+                tables = transform.iter_tables(args.sponsor_input, args.grantee_input, args.chunksize,
+                                               grantee_ids=grantee_ids, geocoder=geocoder)
+                for name, result in load_tables(tables, connect_args, args.binary, args.incremental).items():
+                    print(name, result)
+            else:
+                csv_load(sponsors_file=args.sponsor, grantees_file=args.grantee,
+                        taxperiod_file=args.tax, worth_file=args.worth,
+                        donations_file=args.donation, host=args.host,
+                        port=args.port, user_name=args.username, db_name=args.dbname, password=args.password,
+                        incremental=args.incremental)
+        finally:
+            if args.report_indexes:
+                indexes += report_index_statements()
+            create_indexes(indexes, connect_args, args.index_workers)
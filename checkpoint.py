@@ -0,0 +1,149 @@
+'''
+Checkpoint files for long read_folder runs
+#################################
+Completed batches of sponsors and grantees are written to numbered
+part files in a checkpoint folder, and the files each batch covered
+are then appended to a manifest, followed by a line marking the
+batch done. A run that stops part way can be resumed by skipping
+everything in the batches marked done.
+'''
+
+import os
+import pandas as pd
+import schema
+import parquet_sink
+
+MANIFEST = 'manifest.txt'
+# manifest line that ends a batch: batch number, DONE_FILE, DONE
+DONE_FILE = '*'
+DONE = 'done'
+PART_PREFIXES = ['Sponsors_', 'Grantees_']
+PART_FIELDS = [schema.SPONSOR_FIELDS, schema.GRANTEE_FIELDS]
+
+
+def part_name(directory, prefix, batch, output_format='csv'):
+    '''
+    Path of the part file for the given batch number.
+    '''
+    return os.path.join(directory, '{}{:05d}.{}'.format(prefix, batch, output_format))
+
+def _manifest_lines(directory):
+    # every whole line of the manifest, done markers included
+    entries = []
+    location = os.path.join(directory, MANIFEST)
+    if not os.path.exists(location):
+        return entries
+    with open(location) as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            # a line cut short by a crash is not a completed entry
+            if line.endswith('\n') and len(fields) == 3 and fields[0].isdigit():
+                entries.append((int(fields[0]), fields[1], fields[2]))
+    return entries
+
+def read_manifest(directory):
+    '''
+    Reads the manifest in a checkpoint folder. Only batches
+    marked done are included; the lines of a batch whose writing
+    was cut short are left out.
+    Input: checkpoint folder
+    Output: list of (batch number, file name, status) tuples,
+            where status is 'daf', 'failed' or 'none'
+    '''
+    entries = _manifest_lines(directory)
+    done = {batch for batch, daf_file, status in entries
+            if daf_file == DONE_FILE and status == DONE}
+    return [(batch, daf_file, status) for batch, daf_file, status in entries
+            if batch in done and daf_file != DONE_FILE]
+
+def processed_files(directory):
+    '''
+    Returns the set of file names in the batches marked done.
+    '''
+    return {daf_file for batch, daf_file, status in read_manifest(directory)}
+
+def start_checkpoint(directory, resume):
+    '''
+    Prepares a checkpoint folder and returns the next batch number.
+    Unless resuming, manifest and part files left by an earlier
+    run are removed.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    if resume:
+        location = os.path.join(directory, MANIFEST)
+        if os.path.exists(location) and os.path.getsize(location):
+            with open(location, 'rb+') as f:
+                f.seek(-1, os.SEEK_END)
+                # end a line cut short by a crash, so the next batch's
+                # first line isn't joined to it
+                if f.read(1) != b'\n':
+                    f.write(b'\n')
+        # after unfinished batches too, so their lines never join
+        # a batch that is later marked done
+        batches = [batch for batch, daf_file, status in _manifest_lines(directory)]
+        return max(batches) + 1 if batches else 1
+
+    for name in os.listdir(directory):
+        if name == MANIFEST or any(name.startswith(p) for p in PART_PREFIXES):
+            os.remove(os.path.join(directory, name))
+    return 1
+
+def write_batch(directory, batch, sponsors, grants_made, processed,
+                output_format='csv'):
+    '''
+    Flushes one batch to disk. The part files are written first,
+    then the batch's manifest lines and last the line marking it
+    done, so a batch only counts as done once all of it is saved.
+    Input:
+        directory: checkpoint folder
+        batch: batch number
+        sponsors: list of sponsor dictionaries
+        grants_made: list of grantee dictionaries
+        processed: list of (file name, status) tuples
+        output_format: 'csv' or 'parquet'
+    Output: None
+    '''
+    for prefix, fields, rows in zip(PART_PREFIXES, PART_FIELDS, [sponsors, grants_made]):
+        location = part_name(directory, prefix, batch, output_format)
+        if output_format == 'parquet':
+            parquet_sink.write_file(location + '.tmp', rows, fields)
+        else:
+            pd.DataFrame(rows).to_csv(location + '.tmp', index=False)
+        os.replace(location + '.tmp', location)
+
+    lines = ''.join('{}\t{}\t{}\n'.format(batch, daf_file, status)
+                    for daf_file, status in processed + [(DONE_FILE, DONE)])
+    with open(os.path.join(directory, MANIFEST), 'a') as f:
+        f.write(lines)
+        f.flush()
+        os.fsync(f.fileno())
+
+    return None
+
+def read_parts(directory, prefix):
+    '''
+    Reads and joins the part files of all completed batches, in
+    batch order. Values are kept as the strings that were written.
+    '''
+    batches = sorted({batch for batch, daf_file, status in read_manifest(directory)})
+    parts = []
+    for batch in batches:
+        try:
+            parts.append(pd.read_csv(part_name(directory, prefix, batch), dtype=str,
+                                     keep_default_na=False, na_values=['']))
+        except pd.errors.EmptyDataError:
+            # batch without any sponsors or grantees
+            pass
+    if not parts:
+        return pd.DataFrame()
+    return pd.concat(parts, ignore_index=True)
+
+def copy_parts(directory, prefix, sink):
+    '''
+    Appends the Parquet part files of all completed batches to
+    a parquet_sink.ParquetSink, one batch at a time.
+    '''
+    batches = sorted({batch for batch, daf_file, status in read_manifest(directory)})
+    for batch in batches:
+        sink.write_table(parquet_sink.pq.read_table(part_name(directory, prefix, batch, 'parquet')))
+    return None
@@ -6,6 +6,9 @@ import numpy as np
 import argparse
 import re
 import read_990 as rd
+import records
+
+IN_CARE_OF = re.compile("c/o", flags=re.IGNORECASE)
 
 def clean_daf_grantee_data(daf_dataframe, daf_sponsor_ein, daf_sponsor_taxyear):
     '''
@@ -52,3 +55,104 @@ def clean_daf_grantee_data(daf_dataframe, daf_sponsor_ein, daf_sponsor_taxyear):
     else: 
         print(daf_sponsor_ein, "had no grants?")
         return None
+
+def clean_grantee_batch(filings):
+    '''
+    Applies the clean_daf_grantee_data rules to the grantees of
+    many filings at once: the raw rows are put in a single
+    records.GrantColumns, turned into one Dataframe, and each
+    rule runs once over all of them, rather
+    than once per filing. Rules that depend on which columns a
+    filing has (dropping rows without a name, joining address
+    lines) are applied per row using that filing's columns, so
+    the result is the same as cleaning each filing and joining
+    the records.
+    Input: list of (sponsor EIN, tax year, raw grantees) tuples,
+           one per filing, where the grantees are a
+           records.GrantColumns, a list of dictionaries or None
+    Output: tuple of (cleaned Dataframe, dictionary of filing
+            position to error message for filings that could not
+            be cleaned and were left out)
+    '''
+    batch = records.GrantColumns()
+    row_filing = []
+    filing_columns = []
+    for position, (daf_sponsor_ein, daf_sponsor_taxyear, grantees) in enumerate(filings):
+        if grantees is None:
+            print(daf_sponsor_ein, "had no grants?")
+            grantees = []
+        if isinstance(grantees, records.GrantColumns):
+            batch.extend(grantees)
+            filing_columns.append(grantees.order)
+        else:
+            for row in grantees:
+                batch.append(row)
+            filing_columns.append(dict.fromkeys(key for row in grantees for key in row))
+        row_filing.extend([position] * len(grantees))
+
+    data = batch.to_frame()
+    row_filing = np.array(row_filing, dtype=int)
+    # for each filing, whether it has the given column
+    has = {column: np.array([column in columns for columns in filing_columns], dtype=bool)
+           for column in ['BusinessNameLine1Txt', 'AddressLine1Txt', 'AddressLine2Txt']}
+    errors = {}
+
+    # Get rid of null lines parsed from the Schedule I
+    if 'BusinessNameLine1Txt' in data.columns:
+        name = data['BusinessNameLine1Txt']
+        missing = (name.isna() | (name == '')).to_numpy()
+        keep = ~(missing & has['BusinessNameLine1Txt'][row_filing])
+        data = data[keep]
+        row_filing = row_filing[keep]
+
+    # joining address lines needs the first line wherever there is a second
+    for position in np.flatnonzero(has['AddressLine2Txt'] & ~has['AddressLine1Txt']):
+        errors[position] = repr('AddressLine1Txt')
+
+    if 'CashGrantAmt' in data.columns:
+        try:
+            cash = data['CashGrantAmt'].astype(float)
+        except ValueError:
+            # Find the filings with amounts that aren't numbers,
+            # and convert only those one filing at a time
+            amounts = data['CashGrantAmt']
+            cash = pd.to_numeric(amounts, errors='coerce')
+            suspect = (cash.isna() & amounts.notna()).to_numpy()
+            for position in np.unique(row_filing[suspect]):
+                # rows are in filing order
+                first, last = np.searchsorted(row_filing, [position, position + 1])
+                try:
+                    cash.iloc[first:last] = amounts.iloc[first:last].astype(float)
+                except ValueError as e:
+                    errors[position] = str(e)
+        data['CashGrantAmt'] = cash
+
+    if errors:
+        keep = ~np.isin(row_filing, list(errors))
+        data = data[keep]
+        row_filing = row_filing[keep]
+
+    # add name of DAF sponsoring organization into grantee data
+    data['Sponsor'] = np.array([filing[0] for filing in filings], dtype=object)[row_filing]
+    data['TAXYEAR'] = np.array([filing[1] for filing in filings], dtype=object)[row_filing]
+
+    # check for any C/O names in the address field
+    # And get rid of them (don't want to share individual names)
+    if 'AddressLine1Txt' in data.columns and data['AddressLine1Txt'].notna().any():
+        data['AddressLine1Txt'] = data['AddressLine1Txt'].str.replace(IN_CARE_OF, '', regex=True)
+
+    # join address lines together, for filings that have a second line
+    # (those left all have a first line too)
+    if has['AddressLine2Txt'][row_filing].any():
+        address = data['AddressLine1Txt'] + data['AddressLine2Txt']
+        data['Address'] = address.where(has['AddressLine2Txt'][row_filing])
+
+    # same column order as joining the cleaned filings one at a time:
+    # each adds its own columns, then Sponsor, TAXYEAR and Address
+    order = {}
+    for position in np.unique(row_filing):
+        order.update(filing_columns[position])
+        order.update(dict.fromkeys(['Sponsor', 'TAXYEAR']))
+        if has['AddressLine2Txt'][position]:
+            order['Address'] = None
+    return (data.reindex(columns=list(order)).reset_index(drop=True), errors)
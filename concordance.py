@@ -0,0 +1,99 @@
+'''
+Version-aware field paths for 990 forms
+#################################
+concordance.csv maps each field read by read_990.py to its exact
+path under the Return element, for a range of returnVersion values
+(see the Community Concordance linked in the README). A field may
+have several rows; the first path found in a form is used.
+FIRST_VERSION and LAST_VERSION are inclusive, and a blank
+LAST_VERSION means the path still applies to newer versions.
+
+The rows for a version are compiled once into a FieldExtractor,
+so reading a field is a direct walk down its path rather than a
+search of the whole tree. Versions with no rows get no extractor,
+and read_990.py falls back to searching the tree for them.
+'''
+
+import csv
+import os
+import re
+from functools import lru_cache
+
+CONCORDANCE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'concordance.csv')
+
+
+def version_key(version):
+    '''
+    Turns a returnVersion such as '2018v3.1' into a tuple that
+    sorts in release order, e.g. (2018, 3, 1).
+    '''
+    return tuple(int(n) for n in re.findall(r'\d+', version))
+
+def load_concordance(file=CONCORDANCE_FILE):
+    '''
+    Reads the concordance file.
+    Output: list of (field, first version, last version or None, path)
+    '''
+    rows = []
+    with open(file, newline='') as f:
+        for row in csv.DictReader(f):
+            rows.append((row['FIELD_NAME'], row['FIRST_VERSION'],
+                         row['LAST_VERSION'] or None, row['PATH']))
+    return rows
+
+
+class FieldExtractor:
+    '''
+    Exact path lookups for a single form version.
+    Input: dictionary of field name to list of paths
+    '''
+    def __init__(self, paths):
+        self.steps = {field: [tuple(path.split('/')) for path in field_paths]
+                      for field, field_paths in paths.items()}
+
+    def element(self, root, field):
+        '''
+        Returns the element for the given field, or None if the
+        form doesn't have it.
+        Input: Element object of the Return, field name
+        '''
+        for steps in self.steps.get(field, []):
+            elem = root
+            for step in steps:
+                elem = elem.find(step)
+                if elem is None:
+                    break
+            if elem is not None:
+                return elem
+        return None
+
+    def text(self, root, field):
+        '''
+        Returns the text of the given field, or None.
+        '''
+        elem = self.element(root, field)
+        return elem.text if elem is not None else None
+
+    def __contains__(self, field):
+        return field in self.steps
+
+
+@lru_cache(maxsize=None)
+def get_extractor(version):
+    '''
+    Returns the FieldExtractor for a returnVersion, built on
+    first use and cached after that, or None if the
+    concordance has no paths for the version.
+    '''
+    key = version_key(version)
+    paths = {}
+    for field, first, last, path in _concordance():
+        if version_key(first) <= key and (last is None or key <= version_key(last)):
+            paths.setdefault(field, []).append(path)
+    if not paths:
+        return None
+    return FieldExtractor(paths)
+
+@lru_cache(maxsize=1)
+def _concordance():
+    return tuple(load_concordance())
@@ -0,0 +1,182 @@
+'''
+Concurrent downloads of 990 forms
+#################################
+Forms are fetched over a shared connection pool by a fixed number
+of threads, retrying failed requests with exponential backoff.
+Results come back in the order they were asked for while later
+downloads are still in flight, so forms can be parsed as they
+arrive. base_url can point at any server laid out like the AWS
+bucket, e.g. a local copy for offline testing:
+
+    python -m http.server 8000 --directory <folder of forms>
+    python download.py -ids_file ids.txt -base_url "http://localhost:8000/{}_public.xml"
+'''
+
+import argparse
+import os
+import time
+import xml.etree.ElementTree as et
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import read_xmls
+import form_cache
+
+AWS_URL = "https://s3.amazonaws.com/irs-form-990/{}_public.xml"
+
+# responses worth trying again; anything else is an error straight away
+RETRY_STATUS = [429, 500, 502, 503, 504]
+
+
+def object_url(object_id, base_url=AWS_URL):
+    '''
+    Returns the link to a form from its object id.
+    '''
+    return base_url.format(str(object_id))
+
+def make_session(pool_size=10):
+    '''
+    Returns a requests Session that keeps up to pool_size
+    connections open per host, so that threads reuse
+    connections instead of opening one per form.
+    '''
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def fetch(url, session=None, retries=3, backoff=0.5, timeout=60, cache=None):
+    '''
+    Downloads a single form, retrying connection errors,
+    timeouts and the statuses in RETRY_STATUS.
+    Input:
+        url: link to the form
+        session: requests Session to use, if any
+        retries: number of extra attempts
+        backoff: seconds to wait before the first retry,
+        doubled after each one
+        cache: form_cache.FormCache to read from and save to
+    Output: bytes
+    '''
+    if cache is not None:
+        key = form_cache.cache_key(url)
+        content = cache.get(key)
+        if content is not None:
+            return content
+
+    getter = session if session is not None else requests
+    for attempt in range(retries + 1):
+        try:
+            r = getter.get(url, timeout=timeout)
+            if r.status_code not in RETRY_STATUS:
+                r.raise_for_status()
+                if cache is not None:
+                    cache.put(key, r.content)
+                return r.content
+            error = requests.HTTPError('{} for {}'.format(r.status_code, url), response=r)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = e
+        if attempt < retries:
+            time.sleep(backoff * 2 ** attempt)
+    raise error
+
+def download_forms(urls, workers=8, session=None, retries=3, backoff=0.5, cache=None):
+    '''
+    Downloads forms on <workers> threads, keeping at most
+    twice that many requests queued at once.
+    Input: iterable of links, plus the fetch options
+    Output: generator of (url, bytes or None, error message or None),
+            in the same order as urls
+    '''
+    options = {'retries': retries, 'backoff': backoff, 'cache': cache}
+    if session is None:
+        session = make_session(workers)
+    pending = deque()
+    urls = iter(urls)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for url in urls:
+            pending.append((url, executor.submit(fetch, url, session, **options)))
+            if len(pending) >= workers * 2:
+                yield _result(*pending.popleft())
+        while pending:
+            yield _result(*pending.popleft())
+
+def _result(url, future):
+    try:
+        return (url, future.result(), None)
+    except Exception as e:
+        return (url, None, str(e))
+
+def read_forms(urls, workers=8, session=None, retries=3, backoff=0.5, cache=None):
+    '''
+    Same as download_forms, but parses each form into a
+    cleaned Element object (as read_990.read_form does) while
+    the next downloads are still running.
+    Output: generator of (url, Element object or None, error message or None)
+    '''
+    for url, content, error in download_forms(urls, workers, session, retries, backoff, cache):
+        if error is not None:
+            yield (url, None, error)
+            continue
+        try:
+            root = et.fromstring(content)
+            read_xmls.clean_xml(root)
+        except Exception as e:
+            yield (url, None, str(e))
+            continue
+        yield (url, root, None)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+            description='Download IRS 990 forms by object id')
+    parser.add_argument('-ids', type=str, nargs='*', default=[],
+                    help='object ids to download')
+    parser.add_argument('-ids_file', type=str,
+                    help='text file with one object id per line')
+    parser.add_argument('-out', type=str,
+                    help='folder to save forms to; if not given forms are only downloaded')
+    parser.add_argument('-base_url', type=str, default=AWS_URL,
+                    help='link pattern with {} in place of the object id')
+    parser.add_argument('-workers', type=int, default=8,
+                    help='number of downloads at once')
+    parser.add_argument('-retries', type=int, default=3,
+                    help='number of extra attempts per form')
+    parser.add_argument('-cache', type=str,
+                    help='folder to cache downloaded forms in')
+    parser.add_argument('-cache_bytes', type=int, default=10 * 2 ** 30,
+                    help='most bytes of forms to keep in the cache')
+    args = parser.parse_args()
+    cache = form_cache.FormCache(args.cache, args.cache_bytes) if args.cache else None
+
+    object_ids = list(args.ids)
+    if args.ids_file:
+        with open(args.ids_file) as f:
+            object_ids.extend(line.strip() for line in f if line.strip())
+    if args.out:
+        os.makedirs(args.out, exist_ok=True)
+
+    urls = {object_url(object_id, args.base_url): object_id for object_id in object_ids}
+    start = time.time()
+    total_bytes = 0
+    failures = 0
+    for url, content, error in download_forms(urls, args.workers, retries=args.retries,
+                                              cache=cache):
+        if error is not None:
+            print(error)
+            failures += 1
+            continue
+        total_bytes += len(content)
+        if args.out:
+            with open(os.path.join(args.out, '{}_public.xml'.format(urls[url])), 'wb') as f:
+                f.write(content)
+
+    elapsed = time.time() - start
+    print(len(urls) - failures, 'forms,', round(total_bytes / 1e6, 1), 'MB in',
+          round(elapsed, 1), 'seconds;', failures, 'failed')
+    if cache is not None:
+        print('cache:', cache.stats())
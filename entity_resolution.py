@@ -0,0 +1,343 @@
+'''
+Grantee entity resolution
+#################################
+The same charity shows up in Schedule I under many spellings: with
+and without its EIN (or with a mistyped one), with "TOTAL" appended,
+with different address lines. This module groups those records
+into one grantee:
+
+1. names and addresses are normalized (case, punctuation, common
+   abbreviations, legal suffixes);
+2. records with the same EIN are joined;
+3. records are put in blocks that share a ZIP code (or city and
+   state) and one of the two rarest words of their name, and only
+   records in the same block are compared, so the work grows with
+   the number of records rather than its square; blocks that are
+   too large are split by street number, then by a third word;
+4. pairs with close enough names and addresses and no conflicting
+   EINs are joined too, with union-find. EINs one digit apart, or
+   with two neighbouring digits swapped, don't conflict when the
+   names are the same and the addresses similar.
+
+Each group gets a stable id: its EIN if it has one, otherwise an id
+derived from its records, and ids from an earlier map are kept.
+Ids are 9 characters, like an EIN, so they can stand in for the
+grantee EIN. transform.py applies the map with -grantee_map:
+
+    python entity_resolution.py -grantee Grantees.csv -out grantee_map.csv
+'''
+
+import argparse
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+
+import transform
+
+# Schedule I columns used to tell grantees apart
+GRANTEE_COLUMNS = ['BusinessNameLine1Txt', 'AddressLine1Txt', 'CityNm',
+                   'StateAbbreviationCd', 'ZIPCd', 'RecipientEIN']
+
+# words dropped from names: legal forms and Schedule I artifacts
+NAME_DROP = {'TOTAL', 'INC', 'INCORPORATED', 'LLC', 'CORP', 'CORPORATION', 'CO', 'LTD', 'THE'}
+NAME_WORDS = {'SAINT': 'ST', 'MOUNT': 'MT', 'UNIV': 'UNIVERSITY', 'ASSN': 'ASSOCIATION',
+              'FDN': 'FOUNDATION', 'CTR': 'CENTER', 'DIST': 'DISTRICT'}
+ADDRESS_WORDS = {'STREET': 'ST', 'AVENUE': 'AVE', 'ROAD': 'RD', 'DRIVE': 'DR',
+                 'BOULEVARD': 'BLVD', 'LANE': 'LN', 'PLACE': 'PL', 'COURT': 'CT',
+                 'HIGHWAY': 'HWY', 'PARKWAY': 'PKWY', 'SUITE': 'STE', 'NORTH': 'N',
+                 'SOUTH': 'S', 'EAST': 'E', 'WEST': 'W', 'P O BOX': 'PO BOX',
+                 'POST OFFICE BOX': 'PO BOX'}
+# "in care of" someone, up to the street number
+IN_CARE_OF = r'^C O\b.*?(?=\b\d)'
+
+
+def _clean(column):
+    # upper case letters, digits and single spaces
+    text = column.astype(object).where(column.notna(), '').astype(str).str.upper()
+    text = text.str.replace('&', ' AND ', regex=False)
+    return text.str.replace(r'[^A-Z0-9]+', ' ', regex=True).str.strip()
+
+def _replace_words(column, words):
+    '''
+    Replaces whole words (or phrases) in one pass over the column.
+    '''
+    pattern = r'\b(?:{})\b'.format('|'.join(sorted(words, key=len, reverse=True)))
+    return column.str.replace(pattern, lambda match: words[match.group(0)], regex=True)
+
+def _squeeze(column):
+    return column.str.replace(r'\s+', ' ', regex=True).str.strip()
+
+def normalize_name(column):
+    '''
+    Normalizes organization names, e.g. 'The Brillion School
+    District, Inc. TOTAL' to 'BRILLION SCHOOL DISTRICT'.
+    '''
+    words = dict(NAME_WORDS, **dict.fromkeys(NAME_DROP, ''))
+    return _squeeze(_replace_words(_clean(column), words))
+
+def normalize_address(column):
+    '''
+    Normalizes street addresses, e.g. '315 South Main Street,
+    Suite 2' to '315 S MAIN ST STE 2'.
+    '''
+    text = _clean(column).str.replace(IN_CARE_OF, '', regex=True)
+    return _squeeze(_replace_words(text, ADDRESS_WORDS))
+
+def prepare(data):
+    '''
+    Normalized fields and a record key for each row of Schedule I
+    grantee data (GRANTEE_COLUMNS as text).
+    Output: Dataframe of ein, name, address, zip, place and key
+    '''
+    records = pd.DataFrame(index=data.index)
+    records['ein'] = transform.to_ein(data['RecipientEIN'].astype(transform.TEXT)).astype(object)
+    # 000000000 and the like are placeholders, not EINs
+    records.loc[records['ein'].str.fullmatch(r'(\d)\1{8}').fillna(False), 'ein'] = None
+    records['ein'] = records['ein'].where(records['ein'].notna(), '')
+    records['name'] = normalize_name(data['BusinessNameLine1Txt'])
+    records['address'] = normalize_address(data['AddressLine1Txt'])
+    records['zip'] = transform.to_zip(data['ZIPCd'].astype(transform.TEXT)).astype(object).fillna('')
+    records['place'] = _clean(data['CityNm']) + '|' + _clean(data['StateAbbreviationCd'])
+    records['key'] = records['ein'] + '|' + records['name'] + '|' + records['address'] + '|' + records['zip']
+    return records
+
+def record_keys(data):
+    '''
+    Returns the record key of each row, as used in the id map.
+    '''
+    return prepare(data)['key']
+
+
+def _near_eins(a, b):
+    # one digit apart, or two neighbouring digits swapped
+    if len(a) != len(b):
+        return False
+    differ = [position for position in range(len(a)) if a[position] != b[position]]
+    if len(differ) == 1:
+        return True
+    return (len(differ) == 2 and differ[1] == differ[0] + 1
+            and a[differ[0]] == b[differ[1]] and a[differ[1]] == b[differ[0]])
+
+
+class UnionFind:
+    '''
+    Disjoint sets over 0..n-1 that refuse to join two sets with
+    different EINs, unless told the EINs may be mistyped and
+    they are near each other.
+    '''
+    def __init__(self, eins):
+        self.parent = list(range(len(eins)))
+        self.ein = [ein or None for ein in eins]
+
+    def find(self, item):
+        parent = self.parent
+        while parent[item] != item:
+            parent[item] = parent[parent[item]]
+            item = parent[item]
+        return item
+
+    def union(self, a, b, mistyped=False):
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return True
+        if self.ein[a] and self.ein[b] and self.ein[a] != self.ein[b]:
+            if not (mistyped and _near_eins(self.ein[a], self.ein[b])):
+                return False
+        if b < a:
+            a, b = b, a
+        self.parent[b] = a
+        self.ein[a] = self.ein[a] or self.ein[b]
+        return True
+
+    def roots(self):
+        return np.array([self.find(item) for item in range(len(self.parent))])
+
+
+def blocks(records, max_block=500):
+    '''
+    Blocking keys for the records: ZIP code (or city and state
+    when there is no ZIP) with each of the two rarest words of
+    the name. Blocks of more than max_block records (very common
+    words) are split by street number, then by the third rarest
+    word of the name. Blocks with one record, or still more than
+    max_block, are left out.
+    Output: Dataframe of record position and block key
+    '''
+    tokens = records['name'].str.split().explode().dropna()
+    tokens = tokens[tokens.str.len() > 1]
+    frequency = tokens.map(tokens.value_counts())
+    words = pd.DataFrame({'row': tokens.index, 'token': tokens.to_numpy(),
+                          'frequency': frequency.to_numpy()})
+    words = words.drop_duplicates(['row', 'token']).sort_values(['row', 'frequency', 'token'])
+    rank = words.groupby('row').cumcount().to_numpy()
+    third = words[rank == 2].set_index('row')['token']
+    words = words[rank < 2]
+    area = records['zip'].where(records['zip'] != '', records['place'])
+    keys = pd.DataFrame({'row': words['row'].to_numpy(),
+                         'block': area.loc[words['row']].to_numpy() + '|' + words['token'].to_numpy()})
+    number = records['address'].str.extract(r'(\d+)', expand=False).fillna('')
+    for split in [number, third.reindex(records.index, fill_value='')]:
+        large = (keys.groupby('block')['row'].transform('size') > max_block).to_numpy()
+        if not large.any():
+            break
+        rows = keys.loc[large, 'row']
+        keys.loc[large, 'block'] = keys.loc[large, 'block'] + '|' + split.loc[rows].to_numpy()
+    size = keys.groupby('block')['row'].transform('size')
+    unblocked = keys.loc[size > max_block, 'row'].nunique()
+    if unblocked:
+        print(unblocked, 'records left unblocked: blocks still over', max_block, 'after splitting')
+    return keys[(size > 1) & (size <= max_block)]
+
+def candidate_pairs(records, max_block=500):
+    '''
+    Pairs of record positions (first < second) sharing a block.
+    '''
+    keys = blocks(records, max_block)
+    pairs = keys.merge(keys, on='block', suffixes=('_a', '_b'))
+    pairs = pairs[pairs['row_a'] < pairs['row_b']]
+    return pairs[['row_a', 'row_b']].drop_duplicates().to_numpy()
+
+def _similarity(a, b):
+    # word overlap (Dice coefficient) of two sets of words
+    if not a or not b:
+        return 0.0
+    return 2 * len(a & b) / (len(a) + len(b))
+
+def match_pairs(records, pairs, name_threshold=0.8, address_threshold=0.5):
+    '''
+    Keeps the candidate pairs that are the same organization: the
+    same EIN, or no conflicting EINs, similar names and (where both
+    have one) similar addresses. At the very same address, names
+    only need to share half their words. EINs one digit apart or
+    with two digits swapped are taken as a typo when the names
+    have the same words and both have similar addresses.
+    '''
+    eins = records['ein'].to_numpy()
+    names = [frozenset(name.split()) for name in records['name']]
+    addresses = [frozenset(address.split()) for address in records['address']]
+    keep = np.zeros(len(pairs), dtype=bool)
+    for position, (a, b) in enumerate(pairs):
+        if eins[a] and eins[b]:
+            keep[position] = eins[a] == eins[b] or bool(
+                _near_eins(eins[a], eins[b]) and names[a] and names[a] == names[b]
+                and addresses[a] and addresses[b]
+                and _similarity(addresses[a], addresses[b]) >= address_threshold)
+            continue
+        name = _similarity(names[a], names[b])
+        if addresses[a] and addresses[a] == addresses[b]:
+            keep[position] = name >= 0.5
+        elif name >= name_threshold:
+            keep[position] = (not addresses[a] or not addresses[b]
+                              or _similarity(addresses[a], addresses[b]) >= address_threshold)
+    return pairs[keep]
+
+def entity_ids(records, roots, previous=None):
+    '''
+    Chooses an id for each group: the id an earlier map gave any
+    of its records (the smallest, if several), else its EIN (the
+    one most of its records have, if a typo left two), else 'X'
+    and 8 hex digits of a hash of its smallest record key.
+    '''
+    groups = pd.DataFrame({'root': roots, 'ein': records['ein'].to_numpy(),
+                           'key': records['key'].to_numpy()})
+    groups['previous'] = groups['key'].map(previous) if previous is not None else None
+
+    def first(column):
+        # smallest value of each group, through sorted codes
+        codes, values = pd.factorize(groups[column], sort=True)
+        codes = pd.Series(np.where(codes < 0, len(values), codes))
+        codes = codes.groupby(groups['root']).min()
+        return pd.Series(np.append(values.astype(object), None)[codes.to_numpy()], index=codes.index)
+
+    counts = groups[groups['ein'] != ''].groupby(['root', 'ein']).size().reset_index(name='count')
+    counts = counts.sort_values(['root', 'count', 'ein'], ascending=[True, False, True])
+    eins = counts.drop_duplicates('root').set_index('root')['ein']
+    chosen = first('previous')
+    chosen = chosen.where(chosen.notna(), eins.reindex(chosen.index))
+    missing = chosen.isna()
+    chosen[missing] = ['X' + hashlib.sha1(key.encode('utf-8')).hexdigest()[:8].upper()
+                       for key in first('key')[missing]]
+    return groups['root'].map(chosen).to_numpy()
+
+def resolve(data, previous=None, max_block=500, name_threshold=0.8, address_threshold=0.5):
+    '''
+    Groups Schedule I grantee rows that are the same organization.
+    Input:
+        data: Dataframe with GRANTEE_COLUMNS as text
+        previous: Series of record key to id from an earlier map,
+        whose ids are kept
+        max_block: largest block compared; larger ones are split,
+        and skipped if still too large
+        name_threshold, address_threshold: least word overlap for
+        names and addresses to count as the same
+    Output: Dataframe of record key and entity id, one row per
+    distinct record
+    '''
+    records = prepare(data.drop_duplicates(GRANTEE_COLUMNS)).drop_duplicates('key').reset_index(drop=True)
+    pairs = match_pairs(records, candidate_pairs(records, max_block),
+                        name_threshold, address_threshold)
+    groups = UnionFind(records['ein'].tolist())
+    for positions in records[records['ein'] != ''].groupby('ein').indices.values():
+        for position in positions[1:]:
+            groups.union(positions[0], position)
+    eins = records['ein'].to_numpy()
+    for a, b in pairs:
+        # pairs with two different EINs were kept as a typo
+        groups.union(a, b, mistyped=bool(eins[a] and eins[b]))
+    return pd.DataFrame({'key': records['key'],
+                         'entity_id': entity_ids(records, groups.roots(), previous)})
+
+def read_map(file):
+    '''
+    Reads an id map written by resolve_file.
+    Output: Series of record key to entity id
+    '''
+    data = pd.read_csv(file, dtype=str, keep_default_na=False)
+    return data.set_index('key')['entity_id']
+
+class GranteeMap:
+    '''
+    Gives Schedule I rows their grantee id from an id map, for
+    transform.iter_tables(grantee_ids=...). Rows whose record
+    isn't in the map keep their EIN.
+    Input:
+        ids: Series of record key to entity id, e.g. from read_map
+    '''
+    def __init__(self, ids):
+        self.ids = ids
+
+    def __call__(self, data):
+        ids = record_keys(data).map(self.ids)
+        return ids.fillna(data['RecipientEIN'].astype(object)).astype(transform.TEXT)
+
+def resolve_file(grantee_file, out, previous_file=None, chunksize=transform.CHUNKSIZE):
+    '''
+    Builds the id map for a Grantees file from read_folder.py and
+    writes it to a csv file. Only distinct records are kept in
+    memory while reading.
+    '''
+    records = []
+    for data in transform.iter_input(grantee_file, GRANTEE_COLUMNS, chunksize):
+        keys = record_keys(data)
+        records.append(data[~keys.duplicated()].assign(_key=keys))
+    records = pd.concat(records).drop_duplicates('_key')
+    previous = read_map(previous_file) if previous_file and os.path.exists(previous_file) else None
+    ids = resolve(records[GRANTEE_COLUMNS], previous)
+    ids.to_csv(out, index=False)
+    return ids
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+            description='Group grantee records that are the same organization')
+    parser.add_argument('-grantee', type=str,
+                    help='Grantees file from read_folder.py')
+    parser.add_argument('-out', type=str, default='grantee_map.csv',
+                    help='csv file to write the record key to id map to')
+    parser.add_argument('-previous', type=str,
+                    help='earlier map whose ids are kept')
+    args = parser.parse_args()
+    ids = resolve_file(args.grantee, args.out, args.previous)
+    print(len(ids), 'records,', ids['entity_id'].nunique(), 'grantees')
@@ -0,0 +1,157 @@
+'''
+On-disk cache for downloaded 990 forms
+#################################
+Each form is stored once under the SHA-256 hash of its content and
+looked up by object id, through a small SQLite index in the cache
+folder. When the stored forms go over the byte budget, the least
+recently used ones are removed. Used by download.fetch, and so by
+read_990.read_form and download.py, when given a cache.
+'''
+
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+
+OBJECT_ID = re.compile(r'(\d+)_public\.xml')
+
+
+def cache_key(url):
+    '''
+    Returns the object id in a form link, or the link itself
+    if it doesn't follow the AWS naming.
+    '''
+    match = OBJECT_ID.search(url)
+    return match.group(1) if match else url
+
+
+class FormCache:
+    '''
+    Content-addressed cache of forms with a size limit.
+    Input:
+        directory: folder to keep the cache in
+        max_bytes: most bytes of forms to keep
+    Attributes:
+        hits, misses: lookups since the cache was opened
+    '''
+    def __init__(self, directory, max_bytes=10 * 2 ** 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(directory, 'objects'), exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(directory, 'index.sqlite'),
+                                  timeout=60, check_same_thread=False)
+        with self.db:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('''CREATE TABLE IF NOT EXISTS forms
+                            (object_id TEXT PRIMARY KEY, sha256 TEXT NOT NULL)''')
+            self.db.execute('''CREATE TABLE IF NOT EXISTS blobs
+                            (sha256 TEXT PRIMARY KEY, size INTEGER NOT NULL,
+                             last_used REAL NOT NULL)''')
+        # running total, so that put doesn't add up the index every time
+        self.size = self._stored_bytes()
+        # the budget may be lower than when the cache was last used
+        with self.lock:
+            self._evict()
+
+    def _stored_bytes(self):
+        return self.db.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+
+    def blob_path(self, digest):
+        return os.path.join(self.directory, 'objects', digest[:2], digest + '.xml')
+
+    def get(self, object_id):
+        '''
+        Returns the cached form for an object id, or None.
+        A stored file that is missing or no longer matches
+        its hash counts as a miss and is dropped.
+        '''
+        with self.lock:
+            row = self.db.execute('SELECT sha256 FROM forms WHERE object_id = ?',
+                                  (object_id,)).fetchone()
+            content = None
+            if row is not None:
+                digest = row[0]
+                try:
+                    with open(self.blob_path(digest), 'rb') as f:
+                        content = f.read()
+                except OSError:
+                    pass
+                if content is not None and hashlib.sha256(content).hexdigest() == digest:
+                    with self.db:
+                        self.db.execute('UPDATE blobs SET last_used = ? WHERE sha256 = ?',
+                                        (time.time(), digest))
+                else:
+                    content = None
+                    self._remove_blob(digest)
+
+            if content is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return content
+
+    def put(self, object_id, content):
+        '''
+        Stores a form, then evicts the least recently used
+        forms if the cache is over its budget.
+        '''
+        digest = hashlib.sha256(content).hexdigest()
+        location = self.blob_path(digest)
+        with self.lock:
+            if not os.path.exists(location):
+                self.size += len(content)
+                os.makedirs(os.path.dirname(location), exist_ok=True)
+                temp = '{}.{}.tmp'.format(location, threading.get_ident())
+                with open(temp, 'wb') as f:
+                    f.write(content)
+                os.replace(temp, location)
+            with self.db:
+                self.db.execute('INSERT OR REPLACE INTO blobs VALUES (?, ?, ?)',
+                                (digest, len(content), time.time()))
+                self.db.execute('INSERT OR REPLACE INTO forms VALUES (?, ?)',
+                                (object_id, digest))
+            self._evict()
+        return None
+
+    def _evict(self):
+        if self.size <= self.max_bytes:
+            return None
+        # other processes may share the cache, so count again before removing
+        self.size = self._stored_bytes()
+        if self.size <= self.max_bytes:
+            return None
+        for digest, size in self.db.execute(
+                'SELECT sha256, size FROM blobs ORDER BY last_used').fetchall():
+            self._remove_blob(digest)
+            self.size -= size
+            if self.size <= self.max_bytes:
+                break
+        return None
+
+    def _remove_blob(self, digest):
+        with self.db:
+            self.db.execute('DELETE FROM forms WHERE sha256 = ?', (digest,))
+            self.db.execute('DELETE FROM blobs WHERE sha256 = ?', (digest,))
+        try:
+            os.remove(self.blob_path(digest))
+        except OSError:
+            pass
+        return None
+
+    def stats(self):
+        '''
+        Returns a dictionary of hits, misses, forms and bytes stored.
+        '''
+        with self.lock:
+            forms = self.db.execute('SELECT COUNT(*) FROM forms').fetchone()[0]
+            size = self._stored_bytes()
+        return {'hits': self.hits, 'misses': self.misses, 'forms': forms, 'bytes': size}
+
+    def close(self):
+        self.db.close()
+        return None
@@ -0,0 +1,152 @@
+'''
+Offline geocoding by ZIP code
+#################################
+Fills the latitude and longitude of sponsors and grantees without
+calling a web service. Coordinates come from ZIP code centroids:
+the Census Bureau's ZCTA Gazetteer file
+(https://www.census.gov/geographies/reference-files/time-series/geo/gazetteer-files.html,
+e.g. 2023_Gaz_zcta_national.zip), kept locally. The table is turned into sorted
+NumPy arrays once, saved next to the source as an .npz file, and
+every batch of rows is matched with one vectorized search.
+
+An optional reference file of street addresses with coordinates
+(a csv with address, zip, latitude and longitude columns, such as
+an OpenAddresses extract) places rows at their address when it is
+listed, and at their ZIP centroid otherwise.
+
+    python transform.py -sponsor Sponsors.csv -grantee Grantees.csv -suffix _export -geocode 2023_Gaz_zcta_national.zip
+'''
+
+import argparse
+import os
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+import entity_resolution
+
+
+def read_gazetteer(file):
+    '''
+    Reads ZIP code centroids from a Census ZCTA Gazetteer file
+    (tab separated, zipped or not), or from a csv file with zip,
+    latitude and longitude columns.
+    Output: Dataframe of zip (text), latitude and longitude
+    '''
+    if zipfile.is_zipfile(file):
+        with zipfile.ZipFile(file) as archive:
+            with archive.open(archive.namelist()[0]) as f:
+                data = pd.read_csv(f, sep='\t', dtype=str)
+    else:
+        data = pd.read_csv(file, sep=None, engine='python', dtype=str)
+    data.columns = data.columns.str.strip()
+    data = data.rename(columns={'GEOID': 'zip', 'INTPTLAT': 'latitude', 'INTPTLONG': 'longitude'})
+    data = data.loc[:, ['zip', 'latitude', 'longitude']]
+    data['zip'] = data['zip'].str.strip().str.zfill(5)
+    data['latitude'] = pd.to_numeric(data['latitude'], errors='coerce')
+    data['longitude'] = pd.to_numeric(data['longitude'], errors='coerce')
+    return data.dropna()
+
+def load_centroids(file, persist=True):
+    '''
+    Loads ZIP code centroids as NumPy arrays sorted by ZIP code.
+    The arrays are saved as an .npz file next to the source and
+    used instead as long as they are newer than it.
+    Output: dictionary of zip (int32), latitude and longitude
+    '''
+    if file.endswith('.npz'):
+        with np.load(file) as data:
+            return {name: data[name] for name in data.files}
+
+    binary = os.path.splitext(file)[0] + '.npz'
+    if persist and os.path.exists(binary) and os.path.getmtime(binary) >= os.path.getmtime(file):
+        return load_centroids(binary)
+
+    data = read_gazetteer(file)
+    data = data[data['zip'].str.fullmatch(r'\d{5}')]
+    zips = data['zip'].astype(np.int32).to_numpy()
+    order = np.argsort(zips, kind='stable')
+    centroids = {'zip': zips[order],
+                 'latitude': data['latitude'].to_numpy()[order],
+                 'longitude': data['longitude'].to_numpy()[order]}
+    if persist:
+        np.savez(binary, **centroids)
+    return centroids
+
+def _zip_text(zips):
+    # first five digits of each ZIP code, '' if there aren't five
+    text = pd.Series(zips).astype(object)
+    text = text.where(text.notna(), '').astype(str).str.strip().str[:5]
+    return text.where(text.str.fullmatch(r'\d{5}'), '')
+
+def zip_coordinates(zips, centroids):
+    '''
+    Looks up the centroid of each ZIP code.
+    Input:
+        zips: ZIP codes as text
+        centroids: dictionary from load_centroids
+    Output: latitude and longitude arrays, NaN where the ZIP code
+    isn't known
+    '''
+    text = _zip_text(zips)
+    numbers = pd.to_numeric(text.where(text != ''), errors='coerce').fillna(-1).astype(np.int64).to_numpy()
+    if not len(centroids['zip']):
+        return np.full(len(numbers), np.nan), np.full(len(numbers), np.nan)
+    position = np.searchsorted(centroids['zip'], numbers)
+    position = np.minimum(position, len(centroids['zip']) - 1)
+    found = centroids['zip'][position] == numbers
+    latitude = np.where(found, centroids['latitude'][position], np.nan)
+    longitude = np.where(found, centroids['longitude'][position], np.nan)
+    return latitude, longitude
+
+def read_addresses(file):
+    '''
+    Reads a reference file of street addresses with coordinates.
+    Output: Dataframe of latitude and longitude indexed by
+    normalized address and ZIP code
+    '''
+    data = pd.read_csv(file, dtype={'zip': str})
+    data['key'] = (entity_resolution.normalize_address(data['address']) + '|'
+                   + _zip_text(data['zip'].str.strip().str.zfill(5)))
+    data = data.dropna(subset=['latitude', 'longitude']).drop_duplicates('key')
+    return data.set_index('key')[['latitude', 'longitude']]
+
+
+class Geocoder:
+    '''
+    Coordinates for batches of addresses, for
+    transform.iter_tables(geocoder=...).
+    Input:
+        centroid_file: ZCTA Gazetteer file (or its .npz copy)
+        address_file: optional reference file of street addresses
+    '''
+    def __init__(self, centroid_file, address_file=None):
+        self.centroids = load_centroids(centroid_file)
+        self.addresses = read_addresses(address_file) if address_file else None
+
+    def __call__(self, addresses, zips):
+        '''
+        Input: Series of street addresses and ZIP codes
+        Output: Dataframe of latitude and longitude, with the same
+        index as the input
+        '''
+        latitude, longitude = zip_coordinates(zips, self.centroids)
+        if self.addresses is not None:
+            keys = (entity_resolution.normalize_address(addresses) + '|'
+                    + _zip_text(zips).to_numpy())
+            exact = self.addresses.reindex(keys.to_numpy())
+            found = exact['latitude'].notna().to_numpy()
+            latitude = np.where(found, exact['latitude'].to_numpy(), latitude)
+            longitude = np.where(found, exact['longitude'].to_numpy(), longitude)
+        return pd.DataFrame({'latitude': latitude, 'longitude': longitude}, index=addresses.index)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+            description='Prepare ZIP code centroids for geocoding')
+    parser.add_argument('-file', type=str,
+                    help='Census ZCTA Gazetteer file')
+    args = parser.parse_args()
+    centroids = load_centroids(args.file)
+    print(len(centroids['zip']), 'ZIP codes saved to', os.path.splitext(args.file)[0] + '.npz')
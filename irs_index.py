@@ -0,0 +1,179 @@
+'''
+AWS yearly index files
+#################################
+Loads index_YYYY.csv or index_YYYY.json into typed NumPy columns,
+saves them next to the source as index_YYYY.npz so later runs
+reload them almost instantly, and selects the object ids to read
+by return type, EIN, tax period and object id range. From the
+command line, writes the selected object ids to a text file for
+download.py:
+
+    python irs_index.py -file index_2018.csv -out ids.txt -return_type 990
+'''
+
+import argparse
+import csv
+import json
+import os
+
+import numpy as np
+
+# column name in the csv file, column name in the json file, type
+INDEX_COLUMNS = {'return_id': ('RETURN_ID', None, np.int64),
+                 'ein': ('EIN', 'EIN', np.int64),
+                 'tax_period': ('TAX_PERIOD', 'TaxPeriod', np.int32),
+                 'return_type': ('RETURN_TYPE', 'FormType', 'U8'),
+                 'dln': ('DLN', 'DLN', np.int64),
+                 'object_id': ('OBJECT_ID', 'ObjectId', np.int64)}
+INDEX_SUFFIXES = ('.csv', '.json', '.npz')
+
+
+def _to_number(value):
+    value = (value or '').strip()
+    return int(value) if value.isdigit() else -1
+
+def _column(values, kind):
+    '''
+    Turns a list of strings into a typed array. Numbers are
+    converted all at once; only a column with missing or
+    malformed values is converted one value at a time, storing
+    those as -1.
+    '''
+    if kind == 'U8':
+        return np.array([(v or '').strip() for v in values], dtype=kind)
+    try:
+        return np.fromiter(map(int, values), dtype=kind, count=len(values))
+    except (TypeError, ValueError):
+        return np.array([_to_number(v) for v in values], dtype=kind)
+
+def read_index_csv(file):
+    '''
+    Reads an AWS index_YYYY.csv file.
+    Output: dictionary of column name to NumPy array
+    '''
+    with open(file, newline='', encoding='utf-8', errors='replace') as f:
+        reader = csv.reader(f)
+        header = [name.strip() for name in next(reader)]
+        positions = {name: header.index(csv_name)
+                     for name, (csv_name, json_name, kind) in INDEX_COLUMNS.items()
+                     if csv_name in header}
+        values = {name: [] for name in positions}
+        appends = [(values[name].append, position) for name, position in positions.items()]
+        for row in reader:
+            if len(row) < len(header):
+                continue
+            for append, position in appends:
+                append(row[position])
+    rows = len(next(iter(values.values()))) if values else 0
+    return {name: _column(values.get(name, [None] * rows), kind)
+            for name, (csv_name, json_name, kind) in INDEX_COLUMNS.items()}
+
+def read_index_json(file):
+    '''
+    Reads an AWS index_YYYY.json file, which holds a single
+    list of filings, e.g. {"Filings2018": [...]}.
+    Output: dictionary of column name to NumPy array
+    '''
+    with open(file) as f:
+        data = json.load(f)
+    filings = next(iter(data.values())) if isinstance(data, dict) else data
+    return {name: _column([filing.get(json_name) if json_name else None
+                           for filing in filings], kind)
+            for name, (csv_name, json_name, kind) in INDEX_COLUMNS.items()}
+
+def save_index(index, file):
+    '''
+    Saves an index to a NumPy .npz file.
+    '''
+    np.savez(file, **index)
+    return None
+
+def load_index(file, persist=True):
+    '''
+    Loads an index from a csv, json or npz file. A csv or json
+    index is saved as an npz file next to it, and that copy is
+    used instead as long as it is newer than the source.
+    Input:
+        file: index file
+        persist: whether to save and reuse the npz copy
+    Output: dictionary of column name to NumPy array
+    '''
+    if file.endswith('.npz'):
+        with np.load(file) as data:
+            return {name: data[name] for name in data.files}
+
+    binary = os.path.splitext(file)[0] + '.npz'
+    if persist and os.path.exists(binary) and os.path.getmtime(binary) >= os.path.getmtime(file):
+        return load_index(binary)
+
+    if file.endswith('.json'):
+        index = read_index_json(file)
+    else:
+        index = read_index_csv(file)
+    if persist:
+        save_index(index, binary)
+    return index
+
+def is_index(path):
+    '''
+    True if the path is a file load_index can read.
+    '''
+    return os.path.isfile(path) and path.endswith(INDEX_SUFFIXES)
+
+def select_filings(index, return_types=None, eins=None, tax_periods=None,
+                   min_object_id=None, max_object_id=None, start=None, end=None):
+    '''
+    Builds the list of object ids to read from an index.
+    Input:
+        index: dictionary from load_index
+        return_types: list of form types to keep, e.g. ['990']
+        eins: list of EINs to keep
+        tax_periods: list of tax periods (YYYYMM) to keep
+        min_object_id, max_object_id: inclusive object id range
+        start, end: slice of the remaining filings, in index order
+    Output: NumPy array of object ids
+    '''
+    keep = np.ones(len(index['object_id']), dtype=bool)
+    if return_types:
+        keep &= np.isin(index['return_type'], [str(t) for t in return_types])
+    if eins:
+        keep &= np.isin(index['ein'], [int(ein) for ein in eins])
+    if tax_periods:
+        keep &= np.isin(index['tax_period'], [int(period) for period in tax_periods])
+    if min_object_id is not None:
+        keep &= index['object_id'] >= int(min_object_id)
+    if max_object_id is not None:
+        keep &= index['object_id'] <= int(max_object_id)
+    return index['object_id'][keep][start:end]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+            description='Select object ids from an AWS IRS 990 index')
+    parser.add_argument('-file', type=str,
+                    help='index file: csv, json or npz')
+    parser.add_argument('-out', type=str, default='Object_IDS.txt',
+                    help='text file to write object ids to')
+    parser.add_argument('-return_type', type=str, nargs='*', default=['990'],
+                    help='form types to keep')
+    parser.add_argument('-eins', type=str, nargs='*',
+                    help='EINs to keep')
+    parser.add_argument('-tax_periods', type=str, nargs='*',
+                    help='tax periods (YYYYMM) to keep')
+    parser.add_argument('-min_id', type=int,
+                    help='smallest object id to keep')
+    parser.add_argument('-max_id', type=int,
+                    help='largest object id to keep')
+    parser.add_argument('-start', type=int,
+                    help='position of the first filing to keep')
+    parser.add_argument('-end', type=int,
+                    help='position after the last filing to keep')
+    args = parser.parse_args()
+
+    object_ids = select_filings(load_index(args.file), args.return_type, args.eins,
+                               args.tax_periods, args.min_id, args.max_id,
+                               args.start, args.end)
+    with open(args.out, 'w') as f:
+        for object_id in object_ids:
+            f.write("{}\n".format(object_id))
+    print(len(object_ids), 'filings selected')
@@ -0,0 +1,165 @@
+'''
+Incremental Parquet output for sponsors and grantees
+#################################
+Rows are appended to a Parquet file one batch (row group) at a
+time as read_folder.py finishes them, using the fixed column types
+in schema.py, so nothing has to be held until the end of a run.
+Requires pyarrow.
+'''
+
+import math
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+import schema
+
+
+def arrow_schema(fields):
+    '''
+    Converts a schema.py table into a pyarrow schema.
+    Categories are stored as dictionary encoded strings.
+    '''
+    types = {'string': pa.string(),
+             'int': pa.int64(),
+             'bool': pa.bool_(),
+             'float': pa.float64(),
+             'category': pa.dictionary(pa.int32(), pa.string())}
+    return pa.schema([(name, types[kind]) for name, kind in fields])
+
+def _missing(value):
+    '''
+    True for the empty values parsing can leave behind:
+    None, NaN and ''.
+    '''
+    if value is None or value == '':
+        return True
+    return isinstance(value, float) and math.isnan(value)
+
+def _to_int(value):
+    if _missing(value):
+        return None
+    # amounts cleaned to floats, e.g. 1000.0
+    return int(float(value))
+
+def _to_bool(value):
+    if _missing(value):
+        return None
+    return str(value).strip().lower() in ('1', 'true', '1.0')
+
+def _to_float(value):
+    if _missing(value):
+        return None
+    return float(value)
+
+def _to_string(value):
+    if _missing(value):
+        return None
+    return str(value)
+
+CONVERTERS = {'string': _to_string,
+              'int': _to_int,
+              'bool': _to_bool,
+              'float': _to_float,
+              'category': _to_string}
+
+
+def to_table(rows, fields):
+    '''
+    Builds a pyarrow Table with the given schema.py columns from a
+    list of dictionaries. Columns missing from a row are null;
+    keys not in the schema are left out.
+    Input:
+        rows: list of dictionaries
+        fields: table from schema.py
+    Output: pyarrow Table
+    '''
+    target = arrow_schema(fields)
+    arrays = []
+    for (name, kind), field in zip(fields, target):
+        convert = CONVERTERS[kind]
+        values = [convert(row.get(name)) for row in rows]
+        if kind == 'category':
+            arrays.append(pa.array(values, pa.string()).dictionary_encode())
+        else:
+            arrays.append(pa.array(values, field.type))
+    return pa.Table.from_arrays(arrays, schema=target)
+
+
+class ParquetSink:
+    '''
+    Appends batches of rows to a single Parquet file, one row
+    group per batch.
+    Input:
+        path: Parquet file to write
+        fields: table from schema.py, e.g. schema.GRANTEE_FIELDS
+    '''
+    def __init__(self, path, fields):
+        if pa is None:
+            raise ImportError("pyarrow is needed to write Parquet files")
+        self.path = path
+        self.fields = fields
+        self.rows = 0
+        self.writer = pq.ParquetWriter(path, arrow_schema(fields))
+
+    def write(self, rows):
+        '''
+        Writes a list of dictionaries as one row group.
+        '''
+        if rows:
+            self.write_table(to_table(rows, self.fields))
+        return None
+
+    def write_table(self, table):
+        '''
+        Writes a pyarrow Table that already has this sink's schema.
+        '''
+        self.writer.write_table(table)
+        self.rows += table.num_rows
+        return None
+
+    def close(self):
+        self.writer.close()
+        return None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def write_file(path, rows, fields):
+    '''
+    Writes a complete list of dictionaries to a Parquet file.
+    '''
+    with ParquetSink(path, fields) as sink:
+        sink.write(rows)
+    return None
+
+def read_file(path, columns=None):
+    '''
+    Reads a Parquet file into a Dataframe, optionally only
+    the given columns.
+    '''
+    if pq is None:
+        raise ImportError("pyarrow is needed to read Parquet files")
+    return pq.read_table(path, columns=columns).to_pandas()
+
+def iter_file(path, columns=None, batch_size=100000):
+    '''
+    Reads a Parquet file <batch_size> rows at a time.
+    Output: generator of Dataframes
+    '''
+    if pq is None:
+        raise ImportError("pyarrow is needed to read Parquet files")
+    parquet_file = pq.ParquetFile(path)
+    if columns is not None:
+        columns = [name for name in columns if name in parquet_file.schema_arrow.names]
+    for batch in parquet_file.iter_batches(batch_size=batch_size, columns=columns):
+        yield batch.to_pandas()
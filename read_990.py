@@ -1,6 +1,9 @@
 import xml.etree.ElementTree as et
-import requests
 import read_xmls  
+import concordance
+import records
+import download as dl
+import form_cache
 import pandas as pd
 import numpy as np  
 import argparse
@@ -58,16 +61,32 @@ DONATION_COLUMN_NAMES = ['grantee_ein',
                         'purpose_of_grant',
                         'grant_type']
 
-def read_form(document=None, download=True):
+# Schedule D Part I fields collected for each sponsoring organization
+SCHEDULE_D_TAGS = ['DonorAdvisedFundsHeldCnt', 'DonorAdvisedFundsContriAmt', 'DonorAdvisedFundsGrantsAmt',
+                'DonorAdvisedFundsVlEOYAmt', 'DisclosedOrgLegCtrlInd', 'DisclosedForCharitablePrpsInd',
+                'FundsAndOtherAccountsHeldCnt','FundsAndOtherAccountsContriAmt',
+                'FundsAndOtherAccountsGrantsAmt','FundsAndOtherAccountsVlEOYAmt']
+
+# Schedule I children that hold a grant; everything else (e.g.
+# SupplementalInformationDetail) is skipped
+SCHEDULE_I_TAGS = ['RecipientTable', 'GrantsOtherAsstToIndivInUSGrp']
+
+# Raw byte patterns used to screen files before parsing. Both allow for
+# a namespace prefix on the tag and surrounding whitespace in the text.
+RETURN_TYPE_990 = re.compile(rb'<(?:\w+:)?ReturnTypeCd>\s*990\s*</')
+DAF_IND_YES = re.compile(rb'<(?:\w+:)?DonorAdvisedFundInd>\s*(?:1|true)\s*</', re.IGNORECASE)
+
+def read_form(document=None, download=True, session=None, cache=None):
     '''
     Reads in IRS 990 form from download or link, if download True.
-    Input: link or file name, boolean for download
+    Input: link or file name, boolean for download, optional
+    requests Session to reuse connections (see download.py) and
+    form_cache.FormCache to keep downloaded forms in
     Output: Element object
     '''
     #Get data and transform to tree object
     if download:
-        r = requests.get(document)
-        root = et.fromstring(r.content)
+        root = et.fromstring(dl.fetch(document, session, cache=cache))
     else:
         tree = et.parse(document)
         root = tree.getroot()
@@ -105,34 +124,114 @@ def confirm_daf_fund(tree):
     else:
         return False
 
-def get_form_headers(tree):
+def prescreen_daf(document):
+    '''
+    Checks the raw bytes of a form for a 990 return type and a
+    DonorAdvisedFundInd of 1 or true, without parsing it. Meant to
+    discard the large majority of filings cheaply: a False means the
+    form cannot pass get_form_type and confirm_daf_fund, a True only
+    means it is worth parsing.
+    Input: file name or bytes
+    Output: Boolean
+    '''
+    if isinstance(document, bytes):
+        content = document
+    else:
+        with open(document, 'rb') as f:
+            content = f.read()
+    if RETURN_TYPE_990.search(content) is None:
+        return False
+    return DAF_IND_YES.search(content) is not None
+
+def get_extractor(tree):
+    '''
+    Returns the concordance.FieldExtractor for the form's
+    version, or None if the concordance doesn't cover it.
+    Input: tree
+    Output: FieldExtractor or None
+    '''
+    version = tree.attrib.get('returnVersion')
+    return concordance.get_extractor(version) if version else None
+
+def form_index(tree):
+    '''
+    Returns what the get_ functions below need to look up
+    fields in a form: nothing for versions in the concordance,
+    which use exact paths, and a read_xmls.TagIndex to search
+    for anything else.
+    Input: tree
+    Output: TagIndex or None
+    '''
+    if get_extractor(tree) is not None:
+        return None
+    return read_xmls.TagIndex(tree)
+
+def get_form_headers(tree, index=None):
     '''
     Returns a dictionary with organization EIN,
     name, US address, Tax Year, and Tax Period Beginning and End from a 990 form.
+    Input: tree, optional read_xmls.TagIndex of the tree
     '''
+    extractor = get_extractor(tree)
+    if extractor is not None:
+        data = {}
+        data['EIN'] = extractor.text(tree, 'EIN')
+        # Name may have multiple lines
+        name_fields = [extractor.text(tree, line) for line in
+                       ['BusinessNameLine1Txt', 'BusinessNameLine2Txt']]
+        data['NAME'] = ' '.join(line for line in name_fields if line is not None)
+        data['TAXYEAR'] = extractor.text(tree, 'TaxYr')
+        data['TAXYRSTART'] = extractor.text(tree, 'TaxPeriodBeginDt')
+        data['TAXYREND'] = extractor.text(tree, 'TaxPeriodEndDt')
+
+        # a form that doesn't follow the concordance is searched instead
+        if None not in data.values():
+            address = extractor.element(tree, 'USAddress')
+            if address is None or not len(address):
+                address = extractor.element(tree, 'ForeignAddress')
+            if address is not None:
+                for child in address:
+                    data[child.tag] = child.text
+            return data
+
+    if index is None:
+        index = read_xmls.TagIndex(tree)
     # obtain data from tree
     data = {}
-    data['EIN'] = read_xmls.search_tree(tree, 'EIN')['EIN']
+    data['EIN'] = read_xmls.search_tree(tree, 'EIN', index=index)['EIN']
     # Name may have multiple lines
-    name_fields = read_xmls.search_tree(tree, 'BusinessName', True)
+    name_fields = read_xmls.search_tree(tree, 'BusinessName', True, index=index)
     data['NAME'] = ' '.join(name_fields.values())
     
-    data['TAXYEAR'] = read_xmls.search_tree(tree, 'TaxYr')['TaxYr']
-    data['TAXYRSTART'] = read_xmls.search_tree(tree, 'TaxPeriodBeginDt')['TaxPeriodBeginDt']
-    data['TAXYREND'] = read_xmls.search_tree(tree, 'TaxPeriodEndDt')['TaxPeriodEndDt']
+    data['TAXYEAR'] = read_xmls.search_tree(tree, 'TaxYr', index=index)['TaxYr']
+    data['TAXYRSTART'] = read_xmls.search_tree(tree, 'TaxPeriodBeginDt', index=index)['TaxPeriodBeginDt']
+    data['TAXYREND'] = read_xmls.search_tree(tree, 'TaxPeriodEndDt', index=index)['TaxPeriodEndDt']
 
     
-    if tree.find(".//Filer/USAddress"):
-        for child in tree.find(".//Filer/USAddress"):
+    if filer_address(index, 'USAddress'):
+        for child in filer_address(index, 'USAddress'):
             data[child.tag] = child.text
-    elif tree.find(".//Filer/ForeignAddress"):
-        for child in tree.find(".//Filer/ForeignAddress"):
+    elif filer_address(index, 'ForeignAddress'):
+        for child in filer_address(index, 'ForeignAddress'):
             data[child.tag] = child.text
     else:
         pass
 
     return data
 
+def filer_address(index, tag):
+    '''
+    Same as tree.find(".//Filer/" + tag), but only
+    looks under the indexed Filer elements.
+    Input: read_xmls.TagIndex, USAddress or ForeignAddress
+    Output: Element object or None
+    '''
+    for filer in index.all('Filer'):
+        address = filer.find(tag)
+        if address is not None:
+            return address
+    return None
+
 def get_summary_data(tree):
     '''
     Collects the summary data from Part I of the 
@@ -148,51 +247,77 @@ def get_summary_data(tree):
     # low priority, though, see Open990.org for this data
     return None
 
-def get_schedule_i(root):
+def get_schedule_i(root, index=None):
     '''
     Iterates through all grantees listed in a 990
     Schedule I form and returns a dataframe with 
     their information.
-    Input: Element object
+    Input: Element object, optional read_xmls.TagIndex
     Output: Pandas Dataframe
     '''
-    if read_xmls.search_tags(root, 'ScheduleI'):
-        grantees = []
-        for child in root.find('ReturnData').find('IRS990ScheduleI'):
-            org = {}
-            if (child.tag == 'RecipientTable') or (child.tag == 'GrantsOtherAsstToIndivInUSGrp'):
+    grantees = get_schedule_i_columns(root, index)
+    if grantees is None:
+        return None
+    return grantees.to_frame()
+
+def get_schedule_i_columns(root, index=None):
+    '''
+    Same as get_schedule_i, but returns the grantees as a
+    records.GrantColumns, which takes far less memory than a
+    Dataframe per form and can be cleaned together with other
+    forms by clean_990.clean_grantee_batch.
+    Output: records.GrantColumns, or None
+    '''
+    extractor = get_extractor(root)
+    if extractor is not None:
+        schedule = extractor.element(root, 'IRS990ScheduleI')
+    elif read_xmls.search_tags(root, 'ScheduleI', index):
+        schedule = root.find('ReturnData').find('IRS990ScheduleI')
+    else:
+        schedule = None
+
+    if schedule is not None:
+        grantees = records.GrantColumns()
+        for child in schedule:
+            # Get only grantee information, not Supplemental Information;
+            # other children don't get a row at all
+            if child.tag in SCHEDULE_I_TAGS:
+                grantees.add_row()
                 for item in child:
-                # Get only grantee information, not Supplemental Information
                     if item:
                         for subitem in item:
-                            org[subitem.tag] = subitem.text
+                            grantees.set(subitem.tag, subitem.text)
                     else:
-                        org[item.tag] = item.text
-            else:
-                pass
-            grantees.append(org)
+                        grantees.set(item.tag, item.text)
     else:
         return None
-    return pd.DataFrame(grantees)
+    return grantees
 
-def get_schedule_d(root):
+def get_schedule_d(root, index=None):
     '''
     Collects data from Schedule D pertaining to 
     donor-advised funds: number of funds, value
     of contributions to, value of grants from,
     value at end of year, and if all donors were
     notified of their rights to their donation.
-    Input: Element Object
+    Input: Element Object, optional read_xmls.TagIndex
     Output: Dictionary
     '''
-    if read_xmls.search_tags(root, 'ScheduleD'):
-        tags = ['DonorAdvisedFundsHeldCnt', 'DonorAdvisedFundsContriAmt', 'DonorAdvisedFundsGrantsAmt',
-                'DonorAdvisedFundsVlEOYAmt', 'DisclosedOrgLegCtrlInd', 'DisclosedForCharitablePrpsInd',
-                'FundsAndOtherAccountsHeldCnt','FundsAndOtherAccountsContriAmt',
-                'FundsAndOtherAccountsGrantsAmt','FundsAndOtherAccountsVlEOYAmt']
+    extractor = get_extractor(root)
+    if extractor is not None:
+        if extractor.element(root, 'IRS990ScheduleD') is None:
+            return None
+        info = {}
+        for tag in SCHEDULE_D_TAGS:
+            text = extractor.text(root, tag)
+            if text:
+                info[tag] = text
+        return info
+
+    if read_xmls.search_tags(root, 'ScheduleD', index):
         info = {}
         
-        for tag in tags:
+        for tag in SCHEDULE_D_TAGS:
             child = root.find('ReturnData').find('IRS990ScheduleD').find(tag)
             try:
                 # Catch any missing field and move on
@@ -208,6 +333,173 @@ def get_schedule_d(root):
 
     return info
 
+def local_tag(tag):
+    '''
+    Removes the IRS website prefix from a single tag,
+    without rewriting the element it came from.
+    Input: tag string
+    Output: tag string
+    '''
+    return tag.rsplit('}', 1)[-1]
+
+def stream_form(document):
+    '''
+    Incrementally parses a 990 form and yields records as the
+    sections holding them are closed. The full tree is never
+    built or cleaned: each Schedule I grantee, Schedule D field
+    and header is cleared and detached once read, so memory
+    stays proportional to the element currently being parsed.
+    Records are (kind, dictionary) tuples in document order:
+        'return': returnVersion and ReturnTypeCd
+        'header': same fields as get_form_headers
+        'irs990': DonorAdvisedFundInd
+        'schedule_i': one per grantee, same fields as a
+                      get_schedule_i row
+        'schedule_d': same fields as get_schedule_d
+    Callers may stop iterating early, e.g. once a form turns
+    out not to be a 990 with a donor-advised fund.
+    Input: file name or file object
+    Output: generator of (string, dictionary) tuples
+    '''
+    if hasattr(document, 'read'):
+        yield from _stream_records(document)
+    else:
+        with open(document, 'rb') as f:
+            yield from _stream_records(f)
+
+def _stream_records(f):
+    '''
+    Does the work for stream_form on an open file object.
+    '''
+    path = []
+    elements = []
+    version = None
+    schedule_d = {}
+
+    for event, elem in et.iterparse(f, events=('start', 'end')):
+        if event == 'start':
+            path.append(local_tag(elem.tag))
+            elements.append(elem)
+            if len(path) == 1:
+                version = elem.attrib.get('returnVersion')
+            continue
+
+        depth = len(path)
+        tag = path[-1]
+        if depth == 2 and tag == 'ReturnHeader':
+            header, return_type = _stream_header(elem)
+            yield ('return', {'returnVersion': version, 'ReturnTypeCd': return_type})
+            yield ('header', header)
+            elements[-2].remove(elem)
+
+        elif depth == 3 and path[1] == 'ReturnData':
+            if tag == 'IRS990ScheduleD':
+                # same field order as get_schedule_d
+                yield ('schedule_d', {tag: schedule_d[tag] for tag in SCHEDULE_D_TAGS
+                                      if tag in schedule_d})
+            elements[-2].remove(elem)
+
+        elif depth == 4 and path[1] == 'ReturnData':
+            section = path[2]
+            if section == 'IRS990' and tag == 'DonorAdvisedFundInd':
+                yield ('irs990', {tag: elem.text})
+            elif section == 'IRS990ScheduleD' and tag in SCHEDULE_D_TAGS:
+                # Catch any missing field and move on
+                if elem.text:
+                    schedule_d[tag] = elem.text
+            elif section == 'IRS990ScheduleI' and tag in SCHEDULE_I_TAGS:
+                org = {}
+                for item in elem:
+                    # Get only grantee information, not Supplemental Information
+                    if len(item):
+                        for subitem in item:
+                            org[local_tag(subitem.tag)] = subitem.text
+                    else:
+                        org[local_tag(item.tag)] = item.text
+                yield ('schedule_i', org)
+            elements[-2].remove(elem)
+
+        path.pop()
+        elements.pop()
+
+def _stream_header(header):
+    '''
+    Reads the header fields from a ReturnHeader element that
+    still carries its namespace prefixes. Mirrors the first
+    match wins behavior of search_tree.
+    Input: ReturnHeader Element object
+    Output: (dictionary of headers, return type)
+    '''
+    first = {}
+    name_fields = {}
+    filer = None
+    for elem in header.iter():
+        tag = local_tag(elem.tag)
+        if tag not in first:
+            first[tag] = elem.text
+        if tag == 'BusinessName':
+            for child in elem:
+                name_fields.setdefault(local_tag(child.tag), child.text)
+        elif tag == 'Filer' and filer is None:
+            filer = elem
+
+    data = {}
+    data['EIN'] = first['EIN']
+    data['NAME'] = ' '.join(name_fields.values())
+    data['TAXYEAR'] = first['TaxYr']
+    data['TAXYRSTART'] = first['TaxPeriodBeginDt']
+    data['TAXYREND'] = first['TaxPeriodEndDt']
+
+    if filer is not None:
+        addresses = {local_tag(child.tag): child for child in filer}
+        address = addresses.get('USAddress')
+        if address is None or not len(address):
+            address = addresses.get('ForeignAddress')
+        if address is not None:
+            for child in address:
+                data[local_tag(child.tag)] = child.text
+
+    return data, first.get('ReturnTypeCd')
+
+def stream_daf_data(document, as_frame=True):
+    '''
+    Streaming counterpart to read_form followed by
+    get_form_type, confirm_daf_fund, get_form_headers,
+    get_schedule_d and get_schedule_i. Parsing stops as soon
+    as the form is found not to be a 990 with a donor-advised
+    fund, so the rest of the file is never read.
+    Input: file name or file object; as_frame False returns the
+           grantees as a records.GrantColumns instead
+    Output: tuple of (headers dictionary, Schedule D dictionary
+            or None, grantee Dataframe or None), or None if
+            the form is not a DAF 990
+    '''
+    sponsor = None
+    daf_details = None
+    grantees = records.GrantColumns()
+    confirmed = False
+
+    for kind, record in stream_form(document):
+        if kind == 'return':
+            if record['ReturnTypeCd'] != '990':
+                return None
+        elif kind == 'header':
+            sponsor = record
+        elif kind == 'irs990':
+            if record['DonorAdvisedFundInd'] != str(1):
+                return None
+            confirmed = True
+        elif kind == 'schedule_d':
+            daf_details = record
+        elif kind == 'schedule_i':
+            grantees.append(record)
+
+    if not confirmed:
+        return None
+    if not grantees:
+        return (sponsor, daf_details, None)
+    return (sponsor, daf_details, grantees.to_frame() if as_frame else grantees)
+
 def clean_daf_grantee_data(daf_dataframe, daf_sponsor_ein, daf_sponsor_taxyear):
     '''
     Adds the sponsoring organization EIN to each grant and converts
@@ -266,25 +558,34 @@ if __name__ == "__main__":
                         or access it locally")
     parser.add_argument('--verbose', action="store_true",
                     help="whether to print progress")
+    parser.add_argument('-cache', type=str,
+                    help='folder to cache downloaded forms in')
+    parser.add_argument('-cache_bytes', type=int, default=10 * 2 ** 30,
+                    help='most bytes of forms to keep in the cache')
     args = parser.parse_args()
 
+    cache = form_cache.FormCache(args.cache, args.cache_bytes) if args.cache else None
     #read in document
-    tree = read_form(document=args.form, download=args.download)
+    tree = read_form(document=args.form, download=args.download, cache=cache)
+    if cache is not None and args.verbose:
+        print("Cache:", cache.stats())
     #confirm DAF
     if confirm_daf_fund(tree):
         if args.verbose:
             print("DAF Confirmed. Getting data...")
+        #exact paths, or an index of tags for versions without them
+        index = form_index(tree)
         #get org headers
-        sponsor = get_form_headers(tree)
+        sponsor = get_form_headers(tree, index)
         #get schedule D
-        daf_details = get_schedule_d(tree)
+        daf_details = get_schedule_d(tree, index)
         #combine headers and schedule D
         sponsor_details = pd.DataFrame([sponsor, daf_details])
         #get schedule I
-        grantees = get_schedule_i(tree)
+        grantees = get_schedule_i(tree, index)
         #clean schedule I
         if grantees is not None:
-            grantees = clean_daf_grantee_data(grantees, sponsor['EIN']) 
+            grantees = clean_daf_grantee_data(grantees, sponsor['EIN'], sponsor['TAXYEAR'])
         #save dataframes with org info and grantees (I)
             grantees.to_csv(sponsor['NAME'] + "_Grantees.csv")
         sponsor_details.to_csv(sponsor['NAME'] + "_Details.csv")
@@ -1,17 +1,58 @@
 import requests
 import read_990 as rd 
+import read_xmls
 import clean_990 as cd
+import checkpoint as cp
+import schema
+import irs_index
+import download as dl
+import form_cache
+from parquet_sink import ParquetSink
 import pandas as pd 
 import argparse
+import io
 import os
 import time
+from functools import partial
+from itertools import islice
+from multiprocessing import Pool
 
 
-def get_data(folder, start, end, verbose=False):
+def get_data(folder, start, end, verbose=False, stream=False,
+            prefilter=False, verify=False, workers=1, chunksize=100,
+            checkpoint=None, batch_size=10000, resume=False, output_format='csv',
+            index_filters=None, base_url=dl.AWS_URL, download_workers=8, cache=None,
+            batch_clean=False):
     '''
     Read AWS index file or folder of forms and aggregate Schedule I
     and sponsoring organization forms.
-    Input: AWS Index CSV
+    Input: list of folders of forms, archives of forms (zip, tar,
+    gzip or zstd, see read_xmls.iter_documents) and/or AWS index
+    files (csv, json or npz, see irs_index.py)
+        start, end: positions of the first and after the last form
+        to read, in object id order for a folder, archive order for
+        an archive and index order (after filtering) for an index file
+        stream: use the incremental parser (read_990.stream_form)
+        instead of building the full tree for each form
+        prefilter: only parse files whose raw bytes could belong
+        to a 990 with a DAF (read_990.prescreen_daf)
+        verify: parse every file anyway and write any file where the
+        prefilter and the full parse disagree to Prefilter_Check.txt
+        workers: number of processes to read files with
+        chunksize: number of files sent to a worker at a time
+        checkpoint: folder to save every <batch_size> files to, see
+        checkpoint.py
+        resume: skip files already saved in the checkpoint folder
+        output_format: 'csv', or 'parquet' to write Sponsors.parquet
+        and Grantees.parquet a batch at a time (see parquet_sink.py)
+        index_filters: dictionary of irs_index.select_filings options
+        for index files, e.g. {'return_types': ['990']}
+        base_url, download_workers, cache: download.download_forms
+        options for the forms listed in an index file
+        batch_clean: send back raw grantees and clean them
+        <batch_size> filings at a time with
+        clean_990.clean_grantee_batch, instead of one filing at a
+        time in the workers
     Output: 2 dataframes, one with sponsoring org details,
             one with grantee data
     '''
@@ -20,40 +61,138 @@ def get_data(folder, start, end, verbose=False):
 
     daf_object_ids = []
     failures  = []
+    mismatches = []
 
+    done = set()
+    processed = []
+    # DAF filings whose grantees are still to be cleaned: file
+    # name, sponsor, raw grantees and position in processed
+    pending = []
+    if checkpoint:
+        batch = cp.start_checkpoint(checkpoint, resume)
+        if resume:
+            done = cp.processed_files(checkpoint)
+            print(len(done), 'files already processed')
+
+    parquet = output_format == 'parquet'
+    if parquet:
+        sponsor_sink = ParquetSink('Sponsors.parquet', schema.SPONSOR_FIELDS)
+        grantee_sink = ParquetSink('Grantees.parquet', schema.GRANTEE_FIELDS)
+
+    read = partial(process_file, verbose=verbose, stream=stream,
+                   prefilter=prefilter, verify=verify, batch_clean=batch_clean)
     for file_location in folder:
-        if os.path.isdir(file_location):
-            file_count = 0
-            index_count = 0
-            start = time.time()
-            for daf_file in os.listdir(file_location):
+        if not (os.path.isdir(file_location) or read_xmls.is_archive(file_location)
+                or irs_index.is_index(file_location)):
+            raise ValueError("{} is not a folder, an archive or an index file ({})".format(
+                             file_location, ', '.join(irs_index.INDEX_SUFFIXES)))
 
-                try:
-                    tree = rd.read_form(document= file_location + '/' + daf_file, download=False)
-                    if rd.get_form_type(tree) == '990':
-                        if rd.confirm_daf_fund(tree):
-                            daf_object_ids.append(daf_file)
-                            sponsor_details, grantees = get_daf_data(tree, verbose)
-                            
-                            #append dataframes with org info and grantees (I)
-                            sponsors.append(sponsor_details)
-                            grants_made.append(grantees)
-                except Exception as e:
-                    print(e)
+    pool = Pool(workers) if workers > 1 else None
+    try:
+        for file_location in folder:
+            if os.path.isdir(file_location):
+                # sorted so that results come back in object id order
+                # no matter how many workers are used
+                documents = [file_location + '/' + daf_file
+                             for daf_file in sorted(os.listdir(file_location))[start:end]
+                             if daf_file not in done]
+            elif read_xmls.is_archive(file_location):
+                # members are read one at a time, without extracting
+                documents = ((name, content, None) for name, content
+                             in read_xmls.iter_documents(file_location, start, end, done))
+            else:
+                documents = index_documents(file_location, start, end, done, index_filters,
+                                            base_url, download_workers, cache)
+            if pool:
+                results = imap_window(pool, read, documents, chunksize, workers * chunksize * 2)
+            else:
+                results = map(read, documents)
+
+            file_count = 0
+            start_time = time.time()
+            for daf_file, candidate, sponsor_details, grantees, error in results:
+                if error is not None:
+                    print(error)
                     failures.append(daf_file)
+                    processed.append((daf_file, 'failed'))
+                elif sponsor_details is not None:
+                    processed.append((daf_file, 'daf'))
+                    if batch_clean:
+                        # kept until its grantees are cleaned, see clean_pending
+                        pending.append((daf_file, sponsor_details, grantees, len(processed) - 1))
+                    else:
+                        daf_object_ids.append(daf_file)
+                        #append org info and grantees (I)
+                        sponsors.append(sponsor_details)
+                        grants_made.extend(grantees)
+                else:
+                    processed.append((daf_file, 'none'))
+                if prefilter and error is None and candidate != (sponsor_details is not None):
+                    mismatches.append((daf_file, candidate))
+
+                if pending and (len(pending) == batch_size or len(processed) == batch_size):
+                    grants_made.extend(clean_pending(pending, sponsors, daf_object_ids,
+                                                     failures, processed))
+                    pending = []
+
+                if len(processed) == batch_size:
+                    if checkpoint:
+                        cp.write_batch(checkpoint, batch, sponsors, grants_made, processed,
+                                       output_format)
+                        batch += 1
+                    elif parquet:
+                        sponsor_sink.write(sponsors)
+                        grantee_sink.write(grants_made)
+                    if checkpoint or parquet:
+                        sponsors, grants_made, processed = [], [], []
 
-                if file_count == end:
-                    break
                 file_count += 1 
-                
+            
                 if file_count % 10000 == 0:
 
-                    print(file_count, 'files counted in', (time.time() - start) / 60, 'minutes')
+                    print(file_count, 'files counted in', (time.time() - start_time) / 60, 'minutes')
 
-    print(len(sponsors))
+        if pool:
+            pool.close()
+            pool.join()
+    finally:
+        if pool:
+            # stops the workers if reading failed; nothing left to stop otherwise
+            pool.terminate()
 
-    pd.concat(grants_made).to_csv("Grantees.csv", index=False)
-    pd.DataFrame(sponsors).to_csv("Sponsors.csv", index=False)
+    if pending:
+        grants_made.extend(clean_pending(pending, sponsors, daf_object_ids,
+                                         failures, processed))
+
+    if checkpoint:
+        if processed:
+            cp.write_batch(checkpoint, batch, sponsors, grants_made, processed,
+                           output_format)
+        # results of this and any earlier runs, in batch order
+        manifest = cp.read_manifest(checkpoint)
+        daf_object_ids = [daf_file for batch, daf_file, status in manifest if status == 'daf']
+        failures = [daf_file for batch, daf_file, status in manifest if status == 'failed']
+        if parquet:
+            cp.copy_parts(checkpoint, 'Grantees_', grantee_sink)
+            cp.copy_parts(checkpoint, 'Sponsors_', sponsor_sink)
+        else:
+            grantee_data = cp.read_parts(checkpoint, 'Grantees_')
+            sponsor_data = cp.read_parts(checkpoint, 'Sponsors_')
+    elif parquet:
+        grantee_sink.write(grants_made)
+        sponsor_sink.write(sponsors)
+    else:
+        grantee_data = pd.DataFrame(grants_made)
+        sponsor_data = pd.DataFrame(sponsors)
+
+    if parquet:
+        grantee_sink.close()
+        sponsor_sink.close()
+        print(sponsor_sink.rows)
+    else:
+        print(len(sponsor_data))
+        grantee_data.to_csv("Grantees.csv", index=False)
+        sponsor_data.to_csv("Sponsors.csv", index=False)
 
     with open('DAF_Object_IDS.txt', 'w') as f:
         for daf in daf_object_ids:
@@ -63,22 +202,134 @@ def get_data(folder, start, end, verbose=False):
         for daf in failures:
             f.write("{}\n".format(str(daf)))
 
+    if prefilter and verify:
+        print(len(mismatches), 'prefilter decisions differed from the full parse')
+        with open('Prefilter_Check.txt', 'w') as f:
+            for daf, candidate in mismatches:
+                f.write("{}\t{}\n".format(str(daf), 'prefilter kept' if candidate else 'prefilter dropped'))
+
     return None
 
-def get_daf_data(tree, verbose):
+def process_file(document, verbose=False, stream=False, prefilter=False, verify=False,
+                 batch_clean=False):
+    '''
+    Reads a single form and reduces it to plain records, so
+    that it can run in a worker process and send back only
+    what get_data keeps.
+    Input: file path, or (file name, bytes or None, download error
+           or None) for a downloaded or archived form, plus the
+           get_data options
+    Output: tuple of (file name, prefilter decision, sponsor
+            dictionary or None, list of grantee dictionaries,
+            error message or None); with batch_clean the grantees
+            are the raw rows as a records.GrantColumns, or None
+            if there is no Schedule I
+    '''
+    if isinstance(document, tuple):
+        daf_file, content, error = document
+        if error is not None:
+            return (daf_file, None, None, [], error)
+    else:
+        daf_file, content = os.path.basename(document), None
+    try:
+        candidate = rd.prescreen_daf(content or document) if prefilter else True
+        daf_data = None
+        if candidate or verify:
+            source = io.BytesIO(content) if content is not None else document
+            if stream:
+                daf_data = get_daf_data_stream(source, verbose, batch_clean)
+            else:
+                tree = rd.read_form(document=source, download=False)
+                if rd.get_form_type(tree) == '990':
+                    if rd.confirm_daf_fund(tree):
+                        daf_data = get_daf_data(tree, verbose, batch_clean)
+    except Exception as e:
+        return (daf_file, None, None, [], str(e))
+
+    if daf_data is None:
+        return (daf_file, candidate, None, [], None)
+    sponsor_details, grantees = daf_data
+    if batch_clean:
+        return (daf_file, candidate, sponsor_details, grantees, None)
+    records = grantees.to_dict('records') if grantees is not None else []
+    return (daf_file, candidate, sponsor_details, records, None)
+
+def clean_pending(pending, sponsors, daf_object_ids, failures, processed):
+    '''
+    Cleans the raw grantees of the DAF filings read since the
+    last call with clean_990.clean_grantee_batch. Filings that
+    are cleaned are added to sponsors and daf_object_ids; any
+    that can't be are added to failures and marked failed in
+    processed instead, as they would have been when cleaned one
+    at a time.
+    Input: list of (file name, sponsor dictionary, raw grantees
+           or None, position in processed), plus the get_data
+           lists to update
+    Output: list of grantee dictionaries
+    '''
+    filings = [(sponsor['EIN'], sponsor['TAXYEAR'], grantees)
+               for daf_file, sponsor, grantees, position in pending]
+    grantees, errors = cd.clean_grantee_batch(filings)
+    for number, (daf_file, sponsor, raw, position) in enumerate(pending):
+        if number in errors:
+            print(errors[number])
+            failures.append(daf_file)
+            processed[position] = (daf_file, 'failed')
+        else:
+            daf_object_ids.append(daf_file)
+            sponsors.append(sponsor)
+    return grantees.to_dict('records')
+
+def index_documents(index_file, start, end, done=(), index_filters=None,
+                    base_url=dl.AWS_URL, download_workers=8, cache=None):
+    '''
+    Selects forms from an AWS index file (see irs_index.py) and
+    downloads them, skipping any file name in done.
+    Output: generator of (file name, bytes or None, error message
+            or None), in index order
+    '''
+    index = irs_index.load_index(index_file)
+    object_ids = irs_index.select_filings(index, start=start, end=end,
+                                          **(index_filters or {}))
+    names = ['{}_public.xml'.format(object_id) for object_id in object_ids]
+    names = [name for name in names if name not in done]
+    print(len(names), 'forms selected from', index_file)
+    urls = [dl.object_url(name[:-len('_public.xml')], base_url) for name in names]
+    downloads = dl.download_forms(urls, download_workers, cache=cache)
+    for name, (url, content, error) in zip(names, downloads):
+        yield (name, content, error)
+
+def imap_window(pool, func, documents, chunksize, window):
+    '''
+    pool.imap over documents <window> at a time, so that a
+    generator of downloaded forms isn't read into memory all at
+    once. Results keep the order of documents.
+    '''
+    documents = iter(documents)
+    while True:
+        batch = list(islice(documents, window))
+        if not batch:
+            break
+        yield from pool.imap(func, batch, chunksize)
+
+def get_daf_data(tree, verbose, batch_clean=False):
     #confirm DAF
     if rd.confirm_daf_fund(tree):
         if verbose:
             print("DAF Confirmed. Getting data...")
+        #exact paths, or an index of tags for versions without them
+        index = rd.form_index(tree)
         #get org headers
-        sponsor = rd.get_form_headers(tree)
+        sponsor = rd.get_form_headers(tree, index)
         #get schedule D
-        daf_details = rd.get_schedule_d(tree)
+        daf_details = rd.get_schedule_d(tree, index)
         #combine headers and schedule D
         #sponsor_details = pd.DataFrame({**sponsor, **daf_details}, index=[0])
         sponsor_details = {**sponsor, **daf_details}
-        #get schedule I
-        grantees = rd.get_schedule_i(tree)
+        #get schedule I, left raw to be cleaned with other filings
+        if batch_clean:
+            return (sponsor_details, rd.get_schedule_i_columns(tree, index))
+        grantees = rd.get_schedule_i(tree, index)
         #clean schedule I for database loading
         if grantees is not None:
             grantees = cd.clean_daf_grantee_data(grantees, sponsor['EIN'], sponsor['TAXYEAR']) 
@@ -87,6 +338,27 @@ def get_daf_data(tree, verbose):
     else:
         return None
 
+def get_daf_data_stream(document, verbose, batch_clean=False):
+    '''
+    Same output as get_daf_data, but reads the form with the
+    incremental parser instead of a full tree. Returns None if
+    the form is not a 990 with a donor-advised fund.
+    '''
+    daf_data = rd.stream_daf_data(document, as_frame=not batch_clean)
+    if daf_data is None:
+        return None
+    if verbose:
+        print("DAF Confirmed. Getting data...")
+    sponsor, daf_details, grantees = daf_data
+    sponsor_details = {**sponsor, **daf_details}
+    if batch_clean:
+        return (sponsor_details, grantees)
+    #clean schedule I for database loading
+    if grantees is not None:
+        grantees = cd.clean_daf_grantee_data(grantees, sponsor['EIN'], sponsor['TAXYEAR'])
+
+    return (sponsor_details, grantees)
+
 #################
 # CODE ANALYSIS #
 #################
@@ -143,17 +415,63 @@ if __name__ == "__main__":
             description='Read an AWS IRS 990 Index and download data \
                         associated with a donor-advised fund')
     parser.add_argument('-file',type=str, nargs='*',
-                    help='file to use, either a folder or a csv')
+                    help='file to use: a folder, an archive (zip, tar, gz, zst) or an index (csv, json or npz)')
     parser.add_argument('-start',type=int, default=0,
                     help='object id index to start with')
     parser.add_argument('-end',type=int, default=500000,
-                    help='object id index to end with')
+                    help='object id index to end before')
     parser.add_argument('--verbose', action="store_true",
                     help="whether to print progress")
     parser.add_argument('--analyze', action="store_true",
                     help="Check version and form types")        
+    parser.add_argument('--stream', action="store_true",
+                    help="parse forms incrementally instead of building full trees")
+    parser.add_argument('--prefilter', action="store_true",
+                    help="skip parsing files whose raw bytes show no 990 DAF")
+    parser.add_argument('--verify_prefilter', action="store_true",
+                    help="parse all files and report where the prefilter disagrees")
+    parser.add_argument('-workers', '--workers', type=int, default=1,
+                    help='number of processes to read files with')
+    parser.add_argument('-chunksize', type=int, default=100,
+                    help='number of files handed to a worker at a time')
+    parser.add_argument('-checkpoint', type=str,
+                    help='folder to save completed batches to')
+    parser.add_argument('-batch_size', type=int, default=10000,
+                    help='number of files per checkpoint batch')
+    parser.add_argument('--resume', action="store_true",
+                    help="skip files already saved in the checkpoint folder")
+    parser.add_argument('--batch_clean', action="store_true",
+                    help="clean grantees many filings at a time instead of one by one")
+    parser.add_argument('-format', type=str, default='csv', choices=['csv', 'parquet'],
+                    help='write Sponsors and Grantees as csv or parquet')
+    parser.add_argument('-return_type', type=str, nargs='*', default=['990'],
+                    help='form types to read from an index file')
+    parser.add_argument('-eins', type=str, nargs='*',
+                    help='EINs to read from an index file')
+    parser.add_argument('-tax_periods', type=str, nargs='*',
+                    help='tax periods (YYYYMM) to read from an index file')
+    parser.add_argument('-min_id', type=int,
+                    help='smallest object id to read from an index file')
+    parser.add_argument('-max_id', type=int,
+                    help='largest object id to read from an index file')
+    parser.add_argument('-base_url', type=str, default=dl.AWS_URL,
+                    help='link pattern with {} in place of the object id')
+    parser.add_argument('-download_workers', type=int, default=8,
+                    help='number of downloads at once for an index file')
+    parser.add_argument('-cache', type=str,
+                    help='folder to cache downloaded forms in')
+    parser.add_argument('-cache_bytes', type=int, default=10 * 2 ** 30,
+                    help='most bytes of forms to keep in the cache')
     args = parser.parse_args()   
+    index_filters = {'return_types': args.return_type, 'eins': args.eins,
+                     'tax_periods': args.tax_periods, 'min_object_id': args.min_id,
+                     'max_object_id': args.max_id}
+    cache = form_cache.FormCache(args.cache, args.cache_bytes) if args.cache else None
     if args.analyze:
         filing_type(args.file, args.end)
     else:
-        get_data(args.file, args.start, args.end, args.verbose)
\ No newline at end of file
+        get_data(args.file, args.start, args.end, args.verbose, args.stream,
+                args.prefilter, args.verify_prefilter, args.workers, args.chunksize,
+                args.checkpoint, args.batch_size, args.resume, args.format,
+                index_filters, args.base_url, args.download_workers, cache,
+                args.batch_clean)
\ No newline at end of file
@@ -3,7 +3,21 @@
 import xml.etree.ElementTree as ET
 import matplotlib.pyplot as plt
 import numpy as np
+import gzip
+import heapq
 import os
+import queue
+import tarfile
+import threading
+import zipfile
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# bundles of forms that can be read without extracting them
+ARCHIVE_SUFFIXES = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.zst', '.gz', '.zst')
 
 def read_xml(file):
     '''
@@ -74,7 +88,68 @@ def write_long_labels(tree, prefix=None):
 
     return None
     
-def search_tree(tree, tag, children=False):
+def _join_path(tag, parents):
+    # path from the root to an element, given its parent chain
+    tags = [tag]
+    while parents is not None:
+        parent, parents = parents
+        tags.append(parent)
+    return '/'.join(reversed(tags))
+
+class TagIndex:
+    '''
+    Index of every tag in a tree, built in a single
+    traversal, so repeated lookups on the same form
+    don't each walk the whole tree again.
+    Input: ElementTree object (after clean_xml)
+    Attributes:
+        elements: dictionary of tag to list of all
+        elements with that tag, in document order
+        paths: dictionary of tag to the path of the
+        first element with that tag
+    '''
+    def __init__(self, tree):
+        self.elements = {}
+        self.paths = {}
+        # each element carries its parents as (tag, parents) pairs,
+        # so a path is only joined for the first element of a tag
+        stack = [(tree, None)]
+        while stack:
+            elem, parents = stack.pop()
+            if elem.tag in self.elements:
+                self.elements[elem.tag].append(elem)
+            else:
+                self.elements[elem.tag] = [elem]
+                self.paths[elem.tag] = _join_path(elem.tag, parents)
+            parents = (elem.tag, parents)
+            # reversed so children come off the stack in document order
+            for child in reversed(elem):
+                stack.append((child, parents))
+
+    def first(self, tag):
+        '''
+        Returns the first element with the given tag, or None.
+        '''
+        found = self.elements.get(tag)
+        return found[0] if found else None
+
+    def all(self, tag):
+        '''
+        Returns all elements with the given tag.
+        '''
+        return self.elements.get(tag, [])
+
+    def path(self, tag):
+        '''
+        Returns the path from the root to the first element
+        with the given tag, or None.
+        '''
+        return self.paths.get(tag)
+
+    def __contains__(self, tag):
+        return tag in self.elements
+
+def search_tree(tree, tag, children=False, index=None):
     '''
     Recursively searches tree for given tag and
     returns a dictionary of tag and text pairs. If
@@ -84,10 +159,23 @@ def search_tree(tree, tag, children=False):
         tree: ElementTree object
         tag: given path or tag
         children: Boolean
+        index: optional TagIndex of tree; looks the tag
+        up instead of walking the tree
     Output:
         dictionary with selected tags as keys and the
         texts as values.
     '''
+    if index is not None:
+        # first match wins, as in the recursive search
+        g = {}
+        if children:
+            for elem in index.all(tag):
+                for child in elem:
+                    g[child.tag] = g.get(child.tag, child.text)
+        elif tag in index:
+            g[tag] = index.first(tag).text
+        return g
+
     g = {}
     if tag == tree.tag:
         if children:
@@ -102,7 +190,7 @@ def search_tree(tree, tag, children=False):
             
     return g
 
-def search_tags(tree, keyword):
+def search_tags(tree, keyword, index=None):
     '''
     Takes in a key and returns list of tags that include
     that given keyword. Allows user to search for tag that
@@ -110,9 +198,14 @@ def search_tags(tree, keyword):
     Input:
         tree: ElementTree object
         keyword: text to search for in tags
+        index: optional TagIndex of tree; only checks
+        each distinct tag once
     Returns:
         list of tags with keyword included
     '''
+    if index is not None:
+        return [tag for tag in index.elements if keyword.lower() in tag.lower()]
+
     tags = set()
     if keyword.lower() in tree.tag.lower():
         tags.add(tree.tag)
@@ -124,48 +217,401 @@ def search_tags(tree, keyword):
     return list(tags)
     
 
-def filter_tree(trees, **kwargs):
+def filter_tree(trees, columns=None, **kwargs):
     '''
     Takes a list of trees and returns
     those only which meet parameters.
     Inputs:
         trees: a list of trees
+        columns: optional FormColumns of trees with
+        the filtered tags, from extract_columns
         **kwargs: a list of filters to
         be applied to the trees
     Output:
         a list of filtered ElementTree objects
     '''
-    filtered_trees = []
-
-    for tree in trees:
-        for key, value in kwargs.items():
-            check = search_tree(tree, key)
-            if check[key] == value:
-                filtered_trees.append(tree)
-                    
-    return filtered_trees
+    if columns is None:
+        columns = extract_columns(trees, kwargs)
+    return [trees[i] for i in np.flatnonzero(columns.where(**kwargs))]
     
+def is_archive(path):
+    '''
+    True if the path is a file iter_documents can read.
+    '''
+    return os.path.isfile(path) and path.lower().endswith(ARCHIVE_SUFFIXES)
+
+def _zstd_reader(f):
+    if zstandard is None:
+        raise ImportError("zstandard is needed to read .zst files")
+    return zstandard.ZstdDecompressor().stream_reader(f)
+
+def iter_documents(path, start=None, end=None, skip=()):
+    '''
+    Reads the XML forms in a zip or tar archive (plain, gzip or
+    zstd compressed), or a single gzip or zstd compressed form,
+    one member at a time and without extracting them to disk.
+    Input:
+        path: archive file
+        start, end: positions of the first and after the last
+        form to read, in archive order
+        skip: file names not to read
+    Output: generator of (file name, bytes), in archive order
+    '''
+    lower = path.lower()
+    if lower.endswith('.zip'):
+        with zipfile.ZipFile(path) as archive:
+            members = [info for info in archive.infolist()
+                       if not info.is_dir() and info.filename.endswith('.xml')]
+            for info in members[start:end]:
+                name = os.path.basename(info.filename)
+                if name not in skip:
+                    yield (name, archive.read(info))
+    elif lower.endswith(('.tar', '.tar.gz', '.tgz', '.tar.zst')):
+        with open(path, 'rb') as f:
+            fileobj = _zstd_reader(f) if lower.endswith('.zst') else f
+            # read as a stream, so members come straight from the file
+            with tarfile.open(fileobj=fileobj, mode='r|*') as archive:
+                position = -1
+                for member in archive:
+                    if not member.isfile() or not member.name.endswith('.xml'):
+                        continue
+                    position += 1
+                    if start is not None and position < start:
+                        continue
+                    if end is not None and position >= end:
+                        break
+                    name = os.path.basename(member.name)
+                    if name not in skip:
+                        yield (name, archive.extractfile(member).read())
+    else:
+        # a single compressed form, e.g. 201800000000000001_public.xml.gz
+        name = os.path.basename(os.path.splitext(path)[0])
+        if (start or 0) > 0 or end == 0 or name in skip:
+            return
+        if lower.endswith('.zst'):
+            with open(path, 'rb') as f:
+                yield (name, _zstd_reader(f).read())
+        else:
+            with gzip.open(path) as f:
+                yield (name, f.read())
+
+def iter_contents(folder_path):
+    '''
+    Reads the forms in a folder, or an archive of them (see
+    iter_documents), one at a time.
+    Output: generator of (file name, bytes)
+    '''
+    if is_archive(folder_path):
+        yield from iter_documents(folder_path)
+        return
+    for file in os.listdir(folder_path):
+        with open(folder_path + "/" + file, 'rb') as f:
+            yield (file, f.read())
+
+def prefetched(items, size):
+    '''
+    Runs an iterator on a background thread, keeping up to
+    <size> items ready, so reading files overlaps with
+    working on them. Stops reading when the caller stops.
+    '''
+    ready = queue.Queue(size)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                ready.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read():
+        try:
+            for item in items:
+                if not put((None, item)):
+                    return
+        except Exception as error:
+            put((error, None))
+        put((None, done))
+
+    thread = threading.Thread(target=read, daemon=True)
+    thread.start()
+    try:
+        while True:
+            error, item = ready.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+def iter_forms(folder_path, *args, project=None, names=False, prefetch=0):
+    '''
+    Iterate through folder of 990s, applies given
+    functions to them, and yields them one at a time,
+    so only the forms being worked on are in memory.
+    Input:
+        folder_path: system path to folder of 990s,
+        or an archive of them (see iter_documents)
+        *args: functions to apply
+        project: function from a form to what is
+        yielded in its place, e.g. a few of its values
+        names: yield (file name, form) pairs
+        prefetch: number of files to read ahead on a
+        background thread
+    Output:
+        generator of ElementTree objects, or of
+        projections of them
+    '''
+    contents = iter_contents(folder_path)
+    if prefetch:
+        contents = prefetched(contents, prefetch)
+    for name, content in contents:
+        form = ET.fromstring(content)
+        for function in args:
+            function(form)
+        if project is not None:
+            form = project(form)
+        yield (name, form) if names else form
+
 def aggregate(folder_path, *args):
     '''
     Iterate through folder of 990s, applies
     given functions to them, and returns a list.
+    For large folders, iter_forms with reduce_forms
+    keeps memory use flat instead.
     Input:
-        folder_path: system path to folder of 990s
+        folder_path: system path to folder of 990s,
+        or an archive of them (see iter_documents)
         *args: functions to apply
     Output:
         list of ElementTree objects
 
     '''
-    forms = []
-    for file in os.listdir(folder_path):
-        location = folder_path + "/" + file
-        form = read_xml(location)
-        for function in args:
-            function(form)
-        forms.append(form)
-    return forms
+    return list(iter_forms(folder_path, *args))
+
+class FormColumns:
+    '''
+    Text of selected tags across a set of forms, one column
+    per tag, so questions about the forms don't each walk every
+    tree again. Each tag takes the first value in the form, as
+    search_tree does; a form without the tag, or with it empty,
+    has no value.
+    Input: tags to collect
+    Attributes:
+        tags: the tags collected
+        rows: number of forms added
+    '''
+    def __init__(self, tags):
+        self.tags = list(dict.fromkeys(tags))
+        self.rows = 0
+        self._text = {tag: [] for tag in self.tags}
+        self._arrays = {}
+
+    def __len__(self):
+        return self.rows
+
+    def add(self, tree):
+        '''
+        Adds the values of one form, in a single pass over it.
+        '''
+        found = {}
+        for elem in tree.iter():
+            if elem.tag in self._text and elem.tag not in found:
+                found[elem.tag] = elem.text
+                if len(found) == len(self._text):
+                    break
+        for tag, values in self._text.items():
+            values.append(found.get(tag))
+        self.rows += 1
+        self._arrays = {}
+        return None
+
+    def text(self, tag):
+        '''
+        Returns the values of a tag as an object array, with
+        None where a form has no value.
+        '''
+        if ('text', tag) not in self._arrays:
+            values = np.empty(self.rows, dtype=object)
+            values[:] = self._text[tag]
+            self._arrays[('text', tag)] = values
+        return self._arrays[('text', tag)]
+
+    def mask(self, tag):
+        '''
+        Returns a boolean array, True where a form has a value.
+        '''
+        if ('mask', tag) not in self._arrays:
+            self._arrays[('mask', tag)] = np.array([value is not None for value in self._text[tag]],
+                                                   dtype=bool)
+        return self._arrays[('mask', tag)]
+
+    def numbers(self, tag):
+        '''
+        Returns the values of a tag as whole numbers, 0 where
+        a form has no value.
+        '''
+        if ('numbers', tag) not in self._arrays:
+            numbers = np.zeros(self.rows, dtype=np.int64)
+            mask = self.mask(tag)
+            numbers[mask] = self.text(tag)[mask].astype(np.int64)
+            self._arrays[('numbers', tag)] = numbers
+        return self._arrays[('numbers', tag)]
+
+    def values(self, tag, integers=True, missingdata=False):
+        '''
+        Returns the values of a tag; see list_values for the
+        arguments. Forms without a value get 0 or '' when
+        missingdata is True, and are left out otherwise.
+        '''
+        if integers:
+            values = self.numbers(tag)
+        else:
+            values = self.text(tag).copy()
+            values[~self.mask(tag)] = ''
+        return values if missingdata else values[self.mask(tag)]
+
+    def mean(self, tag, missingdata=False):
+        '''
+        Returns the average value of a tag.
+        '''
+        return self.values(tag, True, missingdata).mean()
+
+    def quantiles(self, tag, num_quantiles, missingdata=False):
+        '''
+        Returns list of tuples (quantile, value), as get_quantiles.
+        '''
+        amounts = np.quantile(self.values(tag, True, missingdata), num_quantiles)
+        return list(zip(num_quantiles, amounts))
+
+    def top(self, tag, num_vals):
+        '''
+        Returns the positions of the forms with the highest
+        values of a tag, highest first; ties keep form order.
+        '''
+        rows = np.flatnonzero(self.mask(tag))
+        order = np.argsort(-self.numbers(tag)[rows], kind='stable')
+        return rows[order[:num_vals]]
+
+    def where(self, **kwargs):
+        '''
+        Returns a boolean array, True for the forms whose tags
+        have all of the given values.
+        '''
+        selected = np.ones(self.rows, dtype=bool)
+        for tag, value in kwargs.items():
+            selected &= self.text(tag) == value
+        return selected
+
+def extract_columns(trees, tags):
+    '''
+    Collects the given tags from each tree, walking each
+    tree once.
+    Input:
+        trees: iterable of ElementTree objects
+        tags: tags to collect
+    Output: FormColumns
+    '''
+    columns = FormColumns(tags)
+    for tree in trees:
+        columns.add(tree)
+    return columns
 
-def averages(trees, tag, missingdata):
+class TagSummary:
+    '''
+    Running count, total, lowest and highest whole-number
+    value of a tag, without keeping the forms or values.
+    Input: tag
+    '''
+    def __init__(self, tag):
+        self.tag = tag
+        self.forms = 0
+        self.count = 0
+        self.total = 0
+        self.low = None
+        self.high = None
+
+    def add(self, tree):
+        self.forms += 1
+        elem = next(tree.iter(self.tag), None)
+        if elem is not None and elem.text is not None:
+            value = int(elem.text)
+            self.count += 1
+            self.total += value
+            self.low = value if self.low is None else min(self.low, value)
+            self.high = value if self.high is None else max(self.high, value)
+        return None
+
+    def mean(self, missingdata=False):
+        '''
+        Average value, as averages: over every form if
+        missingdata, otherwise over forms with a value.
+        '''
+        return self.total / (self.forms if missingdata else self.count)
+
+class TopForms:
+    '''
+    The forms with the highest values of a tag, as
+    find_highest_forms, keeping only <num_vals> of them
+    at a time.
+    Input:
+        tag: given tag
+        num_vals: number of forms to keep
+        project: function from a form to what is kept
+        for it, e.g. its file name or EIN; the form
+        itself if None
+    '''
+    def __init__(self, tag, num_vals, project=None):
+        self.tag = tag
+        self.num_vals = num_vals
+        self.project = project
+        self.heap = []
+        self.forms = 0
+
+    def add(self, tree):
+        elem = next(tree.iter(self.tag), None)
+        # nothing is kept when no forms are wanted
+        if self.num_vals > 0 and elem is not None and elem.text is not None:
+            # earlier forms win ties, as in a stable sort
+            item = (int(elem.text), -self.forms)
+            if len(self.heap) < self.num_vals:
+                heapq.heappush(self.heap, item + (self._keep(tree),))
+            elif item > self.heap[0][:2]:
+                heapq.heapreplace(self.heap, item + (self._keep(tree),))
+        self.forms += 1
+        return None
+
+    def _keep(self, tree):
+        return tree if self.project is None else self.project(tree)
+
+    def result(self):
+        '''
+        Returns the kept forms, highest value first.
+        '''
+        return [kept for value, order, kept in sorted(self.heap, key=lambda item: item[:2], reverse=True)]
+
+def reduce_forms(forms, *reducers):
+    '''
+    Passes each form to every reducer, e.g. FormColumns,
+    TagSummary or TopForms, without keeping the forms.
+    Input:
+        forms: iterable of ElementTree objects, e.g.
+        from iter_forms
+        *reducers: objects with an add(tree) method
+    Output: the reducers
+    '''
+    for form in forms:
+        for reducer in reducers:
+            reducer.add(form)
+    return reducers
+
+def averages(trees, tag, missingdata, columns=None):
     '''
     Returns the average value for the selected tag.
     Input:
@@ -177,10 +623,12 @@ def averages(trees, tag, missingdata):
         only uses data when a value was entered
         on the form and prints out number of forms
         with values used.
+        columns: optional FormColumns of trees with the
+        tag, from extract_columns
     Output: int
     '''
-    values = list_values(trees, tag, True, missingdata)
-    return sum(values)/len(values)
+    values = list_values(trees, tag, True, missingdata, columns)
+    return values.mean()
     
 
 def plot_hist_values(values, missingdata=False):
@@ -195,7 +643,7 @@ def plot_hist_values(values, missingdata=False):
 
     return plt.hist(values)
 
-def list_values(trees, tag, integers, missingdata):
+def list_values(trees, tag, integers, missingdata, columns=None):
     '''
     Creates a list of values for given tag
     across a list of ElementTree objects
@@ -210,31 +658,22 @@ def list_values(trees, tag, integers, missingdata):
         only uses data when a value was entered
         on the form and prints out number of forms
         with values used.
+        columns: optional FormColumns of trees with the
+        tag, from extract_columns
     Returns:
-        list of values
+        array of values
     '''
-    values = []
-    n = len(trees)
-    sample_size = 0
-    for tree in trees:
-        val = search_tree(tree, tag)
-        if missingdata:
-            if len(val) == 0:
-                (values.append(0) if integers else values.append(''))
-            else:
-                (values.append(int(val[tag])) if integers
-                 else values.append(val[tag]))
-        else:
-            if len(val) != 0:
-                (values.append(int(val[tag])) if integers
-                 else values.append(val[tag]))
-                sample_size += 1
+    if columns is None:
+        columns = extract_columns(trees, [tag])
+    values = columns.values(tag, integers, missingdata)
     if not missingdata:
+        n = len(columns)
+        sample_size = len(values)
         print("Out of {} given forms, {}, ({}%), had values".format(
             n, sample_size, (sample_size/n)*100))
     return values
 
-def find_highest_forms(trees, tag, num_vals):
+def find_highest_forms(trees, tag, num_vals, columns=None):
     '''
     Returns list of ElementTree objects in which
     given tag values are highest. Allows us to examine
@@ -245,14 +684,12 @@ def find_highest_forms(trees, tag, num_vals):
         tag: given tag
         number_wanted: number of highest values you
         want returned
+        columns: optional FormColumns of trees with the
+        tag, from extract_columns
     '''
-    filtered_trees = {}
-    for tree in trees:
-        check = search_tree(tree, tag)
-        if len(check) != 0:
-            filtered_trees[tree] = filtered_trees.get(tree, int(check[tag]))
-
-    return sorted(filtered_trees, key=filtered_trees.get, reverse=True)[:num_vals]
+    if columns is None:
+        columns = extract_columns(trees, [tag])
+    return [trees[i] for i in columns.top(tag, num_vals)]
 
 
 def get_quantiles(values, num_quantiles):
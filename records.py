@@ -0,0 +1,247 @@
+'''
+Compact Schedule I rows
+#################################
+GrantColumns collects grantee rows column by column instead of as
+one dictionary per row. Each field listed in
+schema.SCHEDULE_I_FIELDS is a single column: text is packed into
+one UTF-8 buffer with an array of end offsets (no Python string
+per value), and category fields (state and country codes, IRC
+section, grant type) are small integer codes into one shared list
+of values. Any other tag a form uses is kept in a sparse column of
+its own. The columns are turned into a DataFrame or a pyarrow
+Table in one step.
+'''
+
+from array import array
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+import schema
+
+
+def _missing(value):
+    # None, or NaN from a Dataframe row
+    return value is None or value != value
+
+
+class TextColumn:
+    '''
+    Strings packed into one bytearray, with the end offset of
+    each value and whether it is present.
+    '''
+    __slots__ = ('data', 'ends', 'valid')
+
+    def __init__(self):
+        self.data = bytearray()
+        self.ends = array('q')
+        self.valid = bytearray()
+
+    def __len__(self):
+        return len(self.ends)
+
+    def pad(self, rows):
+        '''
+        Adds missing values up to the given number of rows.
+        '''
+        if rows > len(self.ends):
+            self.ends.extend([len(self.data)] * (rows - len(self.ends)))
+            self.valid.extend(bytes(rows - len(self.valid)))
+        return None
+
+    def put(self, row, value):
+        '''
+        Sets the value of the given row, which must be the last
+        row of the column or the one after it.
+        '''
+        self.pad(row)
+        if len(self.ends) > row:
+            # replace the last value
+            del self.data[self.ends[row - 1] if row else 0:]
+            self.ends.pop()
+            self.valid.pop()
+        if _missing(value):
+            self.valid.append(0)
+        else:
+            self.data += str(value).encode('utf-8', 'surrogatepass')
+            self.valid.append(1)
+        self.ends.append(len(self.data))
+        return None
+
+    def extend(self, other):
+        '''
+        Adds the values of another TextColumn.
+        '''
+        if len(other):
+            ends = np.frombuffer(other.ends, dtype=np.int64) + len(self.data)
+            self.ends.frombytes(ends.tobytes())
+            self.data += other.data
+            self.valid += other.valid
+        return None
+
+    def to_arrow(self):
+        '''
+        Returns the values as a pyarrow large_string array.
+        '''
+        offsets = np.concatenate([[0], np.frombuffer(self.ends, dtype=np.int64)])
+        nulls = np.packbits(np.frombuffer(self.valid, dtype=np.uint8), bitorder='little')
+        return pa.LargeStringArray.from_buffers(len(self), pa.py_buffer(offsets.tobytes()),
+                                                pa.py_buffer(bytes(self.data)),
+                                                pa.py_buffer(nulls.tobytes()))
+
+    def values(self):
+        '''
+        Returns the values as an object array, with None where
+        a value is missing.
+        '''
+        if pa is not None:
+            return self.to_arrow().to_numpy(zero_copy_only=False)
+        data = bytes(self.data)
+        values = np.empty(len(self), dtype=object)
+        start = 0
+        for row, (end, valid) in enumerate(zip(self.ends, self.valid)):
+            if valid:
+                values[row] = data[start:end].decode('utf-8', 'surrogatepass')
+            start = end
+        return values
+
+
+class GrantColumns:
+    '''
+    Column builder for Schedule I rows.
+    Input: table of (field, type) pairs, see schema.py
+    Attributes:
+        order: dictionary of the fields set so far, in the
+        order they were first set (the DataFrame column order)
+        rows: number of rows
+    '''
+    __slots__ = ('text', 'codes', 'categories', 'extra', 'order', 'rows')
+
+    def __init__(self, fields=schema.SCHEDULE_I_FIELDS):
+        self.text = {name: TextColumn() for name, kind in fields if kind != 'category'}
+        self.codes = {name: array('i') for name, kind in fields if kind == 'category'}
+        # for each category field, value: code
+        self.categories = {name: {} for name in self.codes}
+        # tags not in fields, as {row: value}
+        self.extra = {}
+        self.order = {}
+        self.rows = 0
+
+    def __len__(self):
+        return self.rows
+
+    def add_row(self):
+        '''
+        Starts a new, empty row. set fills in its fields.
+        '''
+        self.rows += 1
+        return None
+
+    def set(self, name, value):
+        '''
+        Sets a field of the last row. Setting the same field
+        twice keeps the last value, as with a dictionary.
+        '''
+        row = self.rows - 1
+        self.order[name] = None
+        if name in self.text:
+            self.text[name].put(row, value)
+        elif name in self.codes:
+            categories = self.categories[name]
+            code = -1 if _missing(value) else categories.setdefault(value, len(categories))
+            column = self.codes[name]
+            if len(column) < row:
+                column.extend([-1] * (row - len(column)))
+            if len(column) == row:
+                column.append(code)
+            else:
+                column[row] = code
+        else:
+            self.extra.setdefault(name, {})[row] = value
+        return None
+
+    def append(self, row):
+        '''
+        Adds a row from a dictionary of field: value.
+        '''
+        self.add_row()
+        for name, value in row.items():
+            self.set(name, value)
+        return None
+
+    def _pad(self):
+        for column in self.text.values():
+            column.pad(self.rows)
+        for column in self.codes.values():
+            column.extend([-1] * (self.rows - len(column)))
+        return None
+
+    def extend(self, other):
+        '''
+        Adds the rows of another GrantColumns with the same fields.
+        '''
+        self._pad()
+        other._pad()
+        for name, column in self.text.items():
+            column.extend(other.text[name])
+        for name, column in self.codes.items():
+            categories = self.categories[name]
+            # other's codes to ours, with -1 (missing) kept as -1
+            remap = np.array([categories.setdefault(value, len(categories))
+                              for value in other.categories[name]] + [-1], dtype=np.intc)
+            column.frombytes(remap[np.frombuffer(other.codes[name], dtype=np.intc)].tobytes())
+        for name, values in other.extra.items():
+            column = self.extra.setdefault(name, {})
+            for row, value in values.items():
+                column[self.rows + row] = value
+        self.order.update(other.order)
+        self.rows += other.rows
+        return None
+
+    def column(self, name):
+        '''
+        Returns the values of a field as an object array, with
+        None where a row doesn't have the field.
+        '''
+        self._pad()
+        if name in self.text:
+            return self.text[name].values()
+        if name in self.codes:
+            values = np.array(list(self.categories[name]) + [None], dtype=object)
+            return values[np.frombuffer(self.codes[name], dtype=np.intc)]
+        values = self.extra.get(name, {})
+        return np.array([values.get(row) for row in range(self.rows)], dtype=object)
+
+    def to_frame(self):
+        '''
+        Returns a DataFrame with a column for each field set,
+        the same as pd.DataFrame of the rows as dictionaries.
+        '''
+        return pd.DataFrame({name: self.column(name) for name in self.order},
+                            index=range(self.rows), columns=list(self.order))
+
+    def to_arrow(self):
+        '''
+        Returns a pyarrow Table with a column for each field set.
+        Category fields become dictionary encoded strings.
+        '''
+        if pa is None:
+            raise ImportError("pyarrow is needed to build Arrow tables")
+        self._pad()
+        arrays = []
+        for name in self.order:
+            if name in self.text:
+                arrays.append(self.text[name].to_arrow().cast(pa.string()))
+            elif name in self.codes:
+                codes = np.frombuffer(self.codes[name], dtype=np.intc)
+                indices = pa.array(codes, mask=codes < 0, type=pa.int32())
+                arrays.append(pa.DictionaryArray.from_arrays(
+                        indices, pa.array(list(self.categories[name]), pa.string())))
+            else:
+                arrays.append(pa.array(self.column(name), pa.string()))
+        return pa.Table.from_arrays(arrays, names=list(self.order))
@@ -1,44 +1,209 @@
 '''
 
 Code for creating Sponsoring Organization and Grantee reports for DonorAdvisedFunds.io
+Figures come from the tables of an aggregates.AggregateCube, so each
+report is a lookup rather than a pass over the csv files.
 
 '''
-from fpdf2 import FPDF
+import argparse
+import hashlib
+import json
+import os
+import time
+from multiprocessing import Pool
 
-def aggregate_report(sponsors, grantees, year):
-    sponsors = pd.read_csv(sponsors)
-    grantees = pd.read_csv(grantees)
+import pandas as pd
 
-    sponsors = sponsors.loc[sponsors['TAXYEAR'] == year]
-    grantees = grantees.loc[grantees['TAXYEAR'] == year]
+try:
+    from fpdf import FPDF
+except ImportError:
+    FPDF = None
 
-    text = 'In {year}, {total_daf_accounts} donor-advised funds  '
+import aggregates
 
-def create_pdf(data):
-    pdf = FPDF()
+SUMMARY = ('In {year}, {sponsors} sponsoring organizations held {accounts} '
+           'donor-advised funds worth {worth} at the end of the year. '
+           '{contributed} was contributed to them and {granted} granted from them.')
+
+def _total(value, money=False):
+    # totals are missing when every sponsor left the figure blank
+    if pd.isna(value):
+        return 'n/a'
+    return ('${:,}' if money else '{:,}').format(int(value))
+
+def aggregate_report(cube, year):
+    '''
+    Input:
+        cube: AggregateCube
+        year: tax year
+    Returns a summary sentence for the sector in that year,
+    or None if the cube has no filings for it.
+    '''
+    if year not in cube.year.index:
+        return None
+    row = cube.year.loc[year]
+    return SUMMARY.format(year=year, sponsors=_total(row['sponsors']),
+                          accounts=_total(row['daf_held_cnt']),
+                          worth=_total(row['daf_eoy_amt'], True),
+                          contributed=_total(row['daf_contri_amt'], True),
+                          granted=_total(row['daf_grants_amt'], True))
+
+# figures in the report table: column, label
+FIGURES = [('daf_held_cnt', 'DAF accounts'),
+           ('daf_held_cnt_pct_change', '% change'),
+           ('daf_contri_amt', 'Contributed to DAFs'),
+           ('daf_contri_amt_pct_change', '% change'),
+           ('daf_grants_amt', 'Granted from DAFs'),
+           ('daf_grants_amt_pct_change', '% change'),
+           ('daf_eoy_amt', 'DAF worth at end of year'),
+           ('daf_eoy_amt_pct_change', '% change'),
+           ('daf_avg_amt', 'Average per DAF account'),
+           ('other_act_held_cnt', 'Similar accounts'),
+           ('other_act_contri_amt', 'Contributed to similar accounts'),
+           ('other_act_grants_amt', 'Granted from similar accounts'),
+           ('other_act_eoy_amt', 'Similar accounts worth at end of year'),
+           ('grant_amt', 'Grants listed in Schedule I'),
+           ('daf_contri_amt_cumulative', 'Contributed to DAFs so far'),
+           ('daf_grants_amt_cumulative', 'Granted from DAFs so far')]
+# most recent years that fit across a page
+PAGE_YEARS = 8
+# bumped when the layout changes, so every report is drawn again
+LAYOUT_VERSION = '1'
+MANIFEST = 'manifest.json'
+SECTOR = 'sector'
+
+def _number(value, percent=False):
+    if pd.isna(value):
+        return ''
+    if percent:
+        return '{:+.1f}%'.format(value)
+    return '{:,.0f}'.format(value)
+
+def _bars(pdf, years, values, label, height=40):
+    '''
+    Draws a bar chart of one figure by year at the current position.
+    '''
+    values = [0 if pd.isna(value) else float(value) for value in values]
+    top = max(values + [1])
+    x, y = pdf.get_x(), pdf.get_y()
+    width = (pdf.epw / 2) / max(len(values), 1)
+    pdf.set_font('helvetica', '', 8)
+    pdf.cell(0, 5, label)
+    pdf.set_fill_color(70, 110, 160)
+    for i, (year, value) in enumerate(zip(years, values)):
+        bar = height * max(value, 0) / top
+        pdf.rect(x + i * width + 1, y + 5 + height - bar, width - 2, bar, style='F')
+        pdf.text(x + i * width + 1, y + height + 9, str(year))
+    pdf.set_xy(x, y + height + 12)
+    return None
+
+def create_pdf(data, path, title, lines=(), chart=None):
+    '''
+    Writes a one page report.
+    Input:
+        data: Dataframe of figures by tax year, from
+        sponsor_report or sector_report
+        path: pdf file to write
+        title: heading of the page
+        lines: sentences printed under the heading
+        chart: image file to include instead of the bars of
+        DAF worth
+    '''
+    if FPDF is None:
+        raise ImportError("fpdf2 is needed to write pdf reports")
+    data = data.iloc[-PAGE_YEARS:]
+    years = list(data.index.get_level_values('tax_year'))
+    pdf = FPDF(orientation='L')
     pdf.add_page()
-    pdf.set_font('Arial','B',16)
-    pdf.cell(40, 10, 'Hello World!')
-    pdf.output('test.pdf','F')
+    pdf.set_font('helvetica', 'B', 16)
+    pdf.cell(0, 10, title, new_x='LMARGIN', new_y='NEXT')
+    pdf.set_font('helvetica', '', 10)
+    for line in lines:
+        pdf.multi_cell(0, 5, line, new_x='LMARGIN', new_y='NEXT')
+    pdf.ln(3)
+
+    # the table is drawn with text rather than cells, which is
+    # several times faster for a few hundred values
+    label_width = 70
+    width = (pdf.epw - label_width) / max(len(years), 1)
+    left, y = pdf.l_margin, pdf.get_y() + 4
+    pdf.set_font('helvetica', 'B', 9)
+    pdf.text(left, y, 'Tax year')
+    for i, year in enumerate(years):
+        pdf.text(left + label_width + (i + 1) * width - pdf.get_string_width(str(year)), y, str(year))
+    pdf.line(left, y + 1.5, left + pdf.epw, y + 1.5)
+    pdf.set_font('helvetica', '', 9)
+    for name, label in FIGURES:
+        y += 5
+        pdf.text(left, y, label)
+        for i, value in enumerate(data[name]):
+            text = _number(value, name.endswith('_pct_change'))
+            pdf.text(left + label_width + (i + 1) * width - pdf.get_string_width(text), y, text)
+    pdf.set_xy(left, y + 6)
 
-class Report(self, sponsors, grantees, donations,
-            taxperiod, worth, orgs=None, **kwargs):
+    if chart:
+        pdf.image(chart, h=60)
+    else:
+        _bars(pdf, years, data['daf_eoy_amt'], 'DAF worth at end of year')
+    pdf.output(path)
+    return None
+
+class Report:
     '''
-    First 5 arguments reflect corresponding .csv
-    sheets.
+    Input:
+        cube: AggregateCube built from the Worth and Donations
+        sheets
     <orgs> takes a list of EIN numbers. If orgs is None,
     then all organizations are used. 
     **kwargs may take the following additional arguments:
     year: list of years to develop reports for. 
-    multi-year: returns a single multi-year report identifying
+    multi_year: returns a single multi-year report identifying
     time trends. 
     '''
+    def __init__(self, cube, orgs=None, **kwargs):
+        self.cube = cube
+        if orgs is None:
+            orgs = cube.sponsor_year.index.get_level_values('sponsor_ein').unique()
+        self.orgs = list(orgs)
+        self.years = kwargs.get('year')
+        self.multi_year = kwargs.get('multi_year', False)
+
+    def sponsor(self, ein):
+        '''
+        Yearly figures for one sponsoring organization, see
+        sponsor_report.
+        '''
+        return sponsor_report(self.cube, ein, self.years)
+
+    def sponsors(self):
+        '''
+        Dictionary of EIN to sponsor figures for each of orgs.
+        '''
+        return {ein: self.sponsor(ein) for ein in self.orgs}
+
+    def sector(self):
+        '''
+        Yearly figures for the sector, see sector_report.
+        '''
+        return sector_report(self.cube, self.years)
+
+    def summaries(self):
+        '''
+        Summary sentence for each year of the sector report; one
+        for the latest year unless multi_year.
+        '''
+        years = list(self.sector().index)
+        if not self.multi_year:
+            years = years[-1:]
+        return [aggregate_report(self.cube, year) for year in years]
     
 
-def sponsor_report():
+def sponsor_report(cube, ein, years=None):
     '''
     Input:
+        cube: AggregateCube
         Sponsoring organization EIN
+        years: tax years wanted, all if None
     Returns the following statistics and visualizations, 
     depending on given arguments:
     ---------------SINGLE ORGANIZATION---------
@@ -102,3 +267,180 @@ def sponsor_report():
 
         VISUALIZATIONS
     '''
+    return cube.sponsor(ein, years)
+
+def sector_report(cube, years=None):
+    '''
+    Yearly figures for all sponsoring organizations; the
+    SECTOR REPORT part of sponsor_report.
+    '''
+    return cube.sector(years)
+
+def sector_chart(cube, path):
+    '''
+    Draws the sector's DAF worth and grants by year to an image.
+    '''
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    data = cube.year.astype(float)
+    fig, ax = plt.subplots(figsize=(8, 3))
+    ax.plot(data.index, data['daf_eoy_amt'], marker='o', label='DAF worth at end of year')
+    ax.plot(data.index, data['daf_grants_amt'], marker='o', label='Granted from DAFs')
+    ax.legend()
+    fig.tight_layout()
+    fig.savefig(path, dpi=150)
+    plt.close(fig)
+    return path
+
+def fingerprints(rows, level=None):
+    '''
+    Hash of the aggregate rows each report is drawn from.
+    Input:
+        rows: Dataframe of aggregate rows
+        level: index level naming the report of each row; one
+        report for all rows if None
+    Output: Series of report name: fingerprint
+    '''
+    # a hash for each row, tax year included, summed by report
+    hashes = pd.Series(pd.util.hash_pandas_object(rows.reset_index(), index=False).to_numpy(),
+                       index=rows.index)
+    if level is None:
+        sums = pd.Series([hashes.sum()], index=[SECTOR])
+    else:
+        sums = hashes.groupby(level=level, sort=False).sum()
+    return sums.map(lambda total: hashlib.sha1('{}:{}'.format(LAYOUT_VERSION, total).encode()).hexdigest())
+
+def read_manifest(folder):
+    '''
+    Reads the report name: fingerprint manifest in a report folder.
+    '''
+    location = os.path.join(folder, MANIFEST)
+    if not os.path.exists(location):
+        return {}
+    with open(location) as f:
+        return json.load(f)
+
+def write_manifest(folder, manifest):
+    location = os.path.join(folder, MANIFEST)
+    with open(location + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=0, sort_keys=True)
+    os.replace(location + '.tmp', location)
+    return None
+
+def _render_sponsor(task):
+    # runs in a worker process; an error is sent back rather than
+    # raised, so the other reports are still drawn
+    ein, rows, path = task
+    try:
+        create_pdf(rows, path, 'Sponsoring organization {}'.format(ein))
+    except Exception as error:
+        return ein, '{}: {}'.format(type(error).__name__, error)
+    return ein, None
+
+def render_reports(cube, folder, workers=4, orgs=None, force=False, chunksize=8):
+    '''
+    Writes a pdf report for each sponsoring organization and one
+    for the sector into a folder, on <workers> processes. Reports
+    whose figures haven't changed since the last run (see the
+    manifest in the folder) are skipped unless force.
+    Input:
+        cube: AggregateCube
+        folder: folder for the pdf files
+        orgs: EINs to report on, all if None
+    Output: dictionary of reports rendered and skipped, names of
+    reports that failed, seconds taken and reports rendered per
+    second
+    '''
+    if FPDF is None:
+        raise ImportError("fpdf2 is needed to write pdf reports")
+    start_time = time.time()
+    os.makedirs(folder, exist_ok=True)
+    manifest = {} if force else read_manifest(folder)
+    stats = {'rendered': 0, 'skipped': 0, 'failed': []}
+
+    def changed(marks):
+        paths = {name: os.path.join(folder, name + '.pdf') for name in marks.index}
+        names = [name for name, mark in marks.items()
+                 if manifest.get(name) != mark or not os.path.exists(paths[name])]
+        stats['skipped'] += len(marks) - len(names)
+        return [(name, paths[name]) for name in names]
+
+    marks = fingerprints(cube.year)
+    for name, path in changed(marks):
+        # a failed sector page is drawn again next run; the
+        # sponsor reports don't depend on it
+        try:
+            chart = sector_chart(cube, os.path.join(folder, SECTOR + '.png'))
+            lines = [aggregate_report(cube, year) for year in cube.year.index[-1:]]
+            create_pdf(aggregates.changes(cube.year), path, 'Donor-advised funds',
+                       [line for line in lines if line], chart)
+            manifest[name] = marks[name]
+            stats['rendered'] += 1
+        except Exception as error:
+            print('sector report failed:', error)
+            manifest.pop(name, None)
+            stats['failed'].append(name)
+
+    rows = cube.sponsor_year
+    if orgs is not None:
+        rows = rows[rows.index.get_level_values('sponsor_ein').isin(orgs)]
+    marks = fingerprints(rows, 'sponsor_ein')
+    todo = changed(marks)
+    # figures for all sponsors at once, then a slice for each report
+    figures = aggregates.changes(rows[rows.index.get_level_values('sponsor_ein').isin([ein for ein, path in todo])])
+    figures = figures.loc[:, [name for name, label in FIGURES]]
+    slices = dict(list(figures.groupby(level='sponsor_ein', sort=False)))
+    tasks = [(ein, slices[ein], path) for ein, path in todo]
+
+    pool = Pool(workers) if workers > 1 and len(tasks) > 1 else None
+    try:
+        results = pool.imap_unordered(_render_sponsor, tasks, chunksize) if pool else map(_render_sponsor, tasks)
+        # a failed report is left out of the manifest, so it is
+        # drawn again next run
+        for ein, error in results:
+            if error is None:
+                manifest[ein] = marks[ein]
+                stats['rendered'] += 1
+            else:
+                print('report for', ein, 'failed:', error)
+                manifest.pop(ein, None)
+                stats['failed'].append(ein)
+    finally:
+        # reports finished before a failure are kept
+        write_manifest(folder, manifest)
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    stats['seconds'] = time.time() - start_time
+    stats['per_second'] = stats['rendered'] / stats['seconds']
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+            description='Print report figures from the aggregate tables')
+    parser.add_argument('-cube', type=str, default='cube',
+                    help='folder written by aggregates.py')
+    parser.add_argument('-ein', type=str,
+                    help='sponsoring organization; the sector if not given')
+    parser.add_argument('-pdf_folder', type=str,
+                    help='write pdf reports for every sponsoring organization and the sector here')
+    parser.add_argument('-workers', type=int, default=4,
+                    help='number of processes rendering reports')
+    parser.add_argument('--force', action='store_true',
+                    help='render every report, even if its figures have not changed')
+    args = parser.parse_args()
+    report = Report(aggregates.AggregateCube(args.cube), multi_year=True)
+    if args.pdf_folder:
+        stats = render_reports(report.cube, args.pdf_folder, args.workers, force=args.force)
+        print(stats['rendered'], 'reports rendered and', stats['skipped'], 'unchanged in',
+              round(stats['seconds'], 1), 'seconds,', round(stats['per_second'], 1), 'per second')
+        if stats['failed']:
+            print('failed:', ', '.join(stats['failed']))
+    elif args.ein:
+        print(report.sponsor(args.ein).T.to_string())
+    else:
+        print(report.sector().T.to_string())
+        print('\n'.join(report.summaries()))
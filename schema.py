@@ -0,0 +1,150 @@
+'''
+Column types for the files written by the pipeline
+#################################
+Each table is a list of (column, type) pairs, where type is one of:
+    'string': text, kept exactly as filed (EINs and ZIP codes
+              keep their leading zeros)
+    'int': whole numbers such as counts, amounts and years
+    'bool': 1/0 or true/false indicators
+    'float': decimal numbers, such as coordinates
+    'category': text drawn from a small set of values, such as
+                state codes
+The load tables at the bottom are the files transform.py writes
+for bulk_upload.py; EINs in them are 9 characters and ZIP codes 5,
+matching the char(9) and char(5) database columns.
+'''
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+# Sponsors.csv / Sponsors.parquet from read_folder.py; get_form_headers
+# and get_schedule_d fields
+SPONSOR_FIELDS = [
+        ('EIN', 'string'),
+        ('NAME', 'string'),
+        ('TAXYEAR', 'int'),
+        ('TAXYRSTART', 'string'),
+        ('TAXYREND', 'string'),
+        ('AddressLine1Txt', 'string'),
+        ('AddressLine2Txt', 'string'),
+        ('CityNm', 'string'),
+        ('StateAbbreviationCd', 'category'),
+        ('ZIPCd', 'string'),
+        ('ProvinceOrStateNm', 'string'),
+        ('CountryCd', 'category'),
+        ('ForeignPostalCd', 'string'),
+        ('DonorAdvisedFundsHeldCnt', 'int'),
+        ('DonorAdvisedFundsContriAmt', 'int'),
+        ('DonorAdvisedFundsGrantsAmt', 'int'),
+        ('DonorAdvisedFundsVlEOYAmt', 'int'),
+        ('DisclosedOrgLegCtrlInd', 'bool'),
+        ('DisclosedForCharitablePrpsInd', 'bool'),
+        ('FundsAndOtherAccountsHeldCnt', 'int'),
+        ('FundsAndOtherAccountsContriAmt', 'int'),
+        ('FundsAndOtherAccountsGrantsAmt', 'int'),
+        ('FundsAndOtherAccountsVlEOYAmt', 'int')]
+
+# Grantees.csv / Grantees.parquet from read_folder.py; get_schedule_i
+# fields after clean_990.clean_daf_grantee_data
+GRANTEE_FIELDS = [
+        ('BusinessNameLine1Txt', 'string'),
+        ('BusinessNameLine2Txt', 'string'),
+        ('AddressLine1Txt', 'string'),
+        ('AddressLine2Txt', 'string'),
+        ('CityNm', 'string'),
+        ('StateAbbreviationCd', 'category'),
+        ('ZIPCd', 'string'),
+        ('ProvinceOrStateNm', 'string'),
+        ('CountryCd', 'category'),
+        ('ForeignPostalCd', 'string'),
+        ('RecipientEIN', 'string'),
+        ('IRCSectionDesc', 'category'),
+        ('CashGrantAmt', 'int'),
+        ('NonCashAssistanceAmt', 'int'),
+        ('ValuationMethodUsedDesc', 'string'),
+        ('NonCashAssistanceDesc', 'string'),
+        ('PurposeOfGrantTxt', 'string'),
+        ('GrantTypeTxt', 'category'),
+        ('RecipientCnt', 'int'),
+        ('Sponsor', 'string'),
+        ('TAXYEAR', 'int'),
+        ('Address', 'string')]
+
+# fields of a Schedule I grantee as read by read_990.get_schedule_i,
+# before cleaning adds Sponsor, TAXYEAR and Address (see records.py)
+SCHEDULE_I_FIELDS = [field for field in GRANTEE_FIELDS
+                     if field[0] not in ('Sponsor', 'TAXYEAR', 'Address')]
+
+# load tables written by transform.py
+TAXPERIOD_TABLE = [
+        ('tax_year', 'int'),
+        ('period_begin', 'string'),
+        ('period_end', 'string'),
+        ('sponsor_ein_id', 'string')]
+
+WORTH_TABLE = [
+        ('daf_held_cnt', 'int'),
+        ('daf_contri_amt', 'int'),
+        ('daf_grants_amt', 'int'),
+        ('daf_eoy_amt', 'int'),
+        ('disclosed_legal', 'bool'),
+        ('disclosed_prps', 'bool'),
+        ('other_act_held_cnt', 'int'),
+        ('other_act_contri_amt', 'int'),
+        ('other_act_grants_amt', 'int'),
+        ('other_act_eoy_amt', 'int'),
+        ('sponsor_ein_id', 'string'),
+        ('tax_year', 'int')]
+
+SPONSOR_TABLE = [
+        ('sponsor_ein', 'string'),
+        ('name', 'string'),
+        ('address_line_1', 'string'),
+        ('city', 'string'),
+        ('state', 'category'),
+        ('zip_code', 'string'),
+        ('latitude', 'float'),
+        ('longitude', 'float')]
+
+DONATION_TABLE = [
+        ('cash_grant_amt', 'int'),
+        ('purpose_of_grant', 'string'),
+        ('grant_type', 'category'),
+        ('grantee_ein_id', 'string'),
+        ('sponsor_ein_id', 'string'),
+        ('tax_year', 'int')]
+
+GRANTEE_TABLE = [
+        ('grantee_ein', 'string'),
+        ('name', 'string'),
+        ('address_line_1', 'string'),
+        ('city', 'string'),
+        ('state', 'category'),
+        ('zip_code', 'string'),
+        ('latitude', 'float'),
+        ('longitude', 'float'),
+        ('irs_section_desc', 'category')]
+
+# pandas types for each kind: nullable, so missing values stay
+# missing instead of becoming 0; text is stored by pyarrow when
+# it is installed, which takes much less memory than objects
+PANDAS_TYPES = {'string': 'string[pyarrow]' if pyarrow is not None else 'string',
+                'int': 'Int64',
+                'bool': 'boolean',
+                'float': 'float64',
+                'category': 'category'}
+
+
+def columns(fields):
+    '''
+    Returns just the column names of a table.
+    '''
+    return [name for name, kind in fields]
+
+def dtypes(fields):
+    '''
+    Returns a dictionary of column name to pandas type.
+    '''
+    return {name: PANDAS_TYPES[kind] for name, kind in fields}
@@ -6,99 +6,176 @@ and readies data for csv export or database bulk upload
 '''
 
 import argparse
+import numpy as np
 import pandas as pd
-
-
-sponsor_col_names = [
-        'sponsor_ein',
-        'name',
-        'address_line_1',
-        'city',
-        'state',
-        'zip_code',
-        'latitude',
-        'longitude']
-
-worth_col_names = [
-        'daf_held_cnt',
-        'daf_contri_amt',
-        'daf_grants_amt', 
-        'daf_eoy_amt',
-        'disclosed_legal',
-        'disclosed_prps',
-        'other_act_held_cnt',
-        'other_act_contri_amt',
-        'other_act_grants_amt',
-        'other_act_eoy_amt',
-        'sponsor_ein_id',
-        'tax_year']
-
-grantee_col_names = ['grantee_ein',
-                            'name',
-                            'address_line_1',
-                            'city',
-                            'state',
-                            'zip_code', 
-                            'latitude',
-                            'longitude',
-                            'irs_section_desc']
-
-donation_col_names = [ 'cash_grant_amt',
-                                'purpose_of_grant',
-                                'grant_type',
-                                'grantee_ein_id',
-                                'sponsor_ein_id',
-                                'tax_year']
-
-taxperiod_col_names = ['tax_year',
-                        'period_begin',
-                        'period_end',
-                        'sponsor_ein_id']
-
-def update_sponsor_csv(file_path, suffix, drop_duplicates=True):
+import parquet_sink
+import schema
+
+
+sponsor_col_names = schema.columns(schema.SPONSOR_TABLE)
+worth_col_names = schema.columns(schema.WORTH_TABLE)
+grantee_col_names = schema.columns(schema.GRANTEE_TABLE)
+donation_col_names = schema.columns(schema.DONATION_TABLE)
+taxperiod_col_names = schema.columns(schema.TAXPERIOD_TABLE)
+
+sponsor_input_cols = ['EIN', 'NAME', 'TAXYEAR', 'TAXYRSTART', 'TAXYREND',
+                      'AddressLine1Txt', 'CityNm', 'StateAbbreviationCd', 'ZIPCd',
+                      'DonorAdvisedFundsHeldCnt', 'DonorAdvisedFundsContriAmt',
+                      'DonorAdvisedFundsGrantsAmt', 'DonorAdvisedFundsVlEOYAmt',
+                      'DisclosedOrgLegCtrlInd', 'DisclosedForCharitablePrpsInd',
+                      'FundsAndOtherAccountsHeldCnt', 'FundsAndOtherAccountsContriAmt',
+                      'FundsAndOtherAccountsGrantsAmt', 'FundsAndOtherAccountsVlEOYAmt']
+
+grantee_input_cols = ['BusinessNameLine1Txt', 'AddressLine1Txt', 'CityNm',
+                      'StateAbbreviationCd', 'ZIPCd', 'RecipientEIN', 'IRCSectionDesc']
+
+donation_input_cols = ['CashGrantAmt', 'PurposeOfGrantTxt', 'GrantTypeTxt',
+                       'RecipientEIN', 'Sponsor', 'TAXYEAR']
+
+# types of the input columns, from schema.py; EINs are padded to
+# 9 digits and ZIP codes cut to 5, as text so leading zeros stay
+input_types = dict(schema.SPONSOR_FIELDS + schema.GRANTEE_FIELDS)
+ein_input_cols = ['EIN', 'RecipientEIN', 'Sponsor']
+zip_input_cols = ['ZIPCd']
+
+# output files, in the order iter_tables produces them, with
+# their columns and types, and whether the row number is written as id
+TABLES = {'Taxperiod': (schema.TAXPERIOD_TABLE, True),
+          'Worth': (schema.WORTH_TABLE, True),
+          'Sponsors': (schema.SPONSOR_TABLE, False),
+          'Donations': (schema.DONATION_TABLE, True),
+          'Grantees': (schema.GRANTEE_TABLE, False)}
+
+CHUNKSIZE = 100000
+TEXT = schema.PANDAS_TYPES['string']
+
+
+def _text(value):
+    # Parquet values written the way read_folder.py writes csv
+    if value is None or value != value:
+        return None
+    if isinstance(value, (bool, np.bool_)):
+        return '1' if value else '0'
+    if isinstance(value, (float, np.floating)) and float(value).is_integer():
+        return str(int(value))
+    return str(value)
+
+def iter_input(file_path, columns, chunksize=CHUNKSIZE):
     '''
-    Data cleaning steps for uploading a batch testing csv
-    to the database.
+    Reads a Sponsors or Grantees file from read_folder.py
+    <chunksize> rows at a time, only the given columns and every
+    one of them as text, so that no chunk depends on type
+    inference and nothing is lost before convert_types.
+    Row numbers carry on from chunk to chunk.
+    Output: generator of Dataframes with the given columns
+    '''
+    if file_path.endswith('.parquet'):
+        first = 0
+        for data in parquet_sink.iter_file(file_path, columns, chunksize):
+            data = data.apply(lambda column: column.map(_text)).astype(TEXT)
+            data.index = pd.RangeIndex(first, first + len(data))
+            first += len(data)
+            yield data.reindex(columns=columns).astype(TEXT)
+        return
+    for data in pd.read_csv(file_path, usecols=lambda name: name in columns, dtype=TEXT,
+                            keep_default_na=False, na_values=[''], chunksize=chunksize):
+        yield data.reindex(columns=columns).astype(TEXT)
+
+def to_integers(column):
+    '''
+    Whole numbers from text such as '5000' or '5000.0'; missing
+    or unreadable values stay missing.
     '''
-    data = pd.read_csv(file_path)
-    try:
-        # If data was saved to csv without index=False option
-        del data['Unnamed: 0']
-    except KeyError:
-        pass
+    return pd.to_numeric(column, errors='coerce').round().astype('Int64')
 
-    # Holdouts for geocoding
-    # may just end up using zip code with google maps/open street map API?
-    if 'latitude' not in data.columns:
-        data.insert(6, 'latitude', 0)
-    if 'longitude' not in data.columns:
-        data.insert(7, 'longitude', 0)       
+def to_flags(column):
+    '''
+    True for '1' or 'true', False for '0' or 'false',
+    otherwise missing.
+    '''
+    text = column.str.strip().str.lower()
+    flags = pd.Series(pd.NA, index=column.index, dtype='boolean')
+    flags[text.isin(['1', 'true', '1.0']).fillna(False)] = True
+    flags[text.isin(['0', 'false', '0.0']).fillna(False)] = False
+    return flags
 
+def to_ein(column):
+    '''
+    EINs as 9 digit text, e.g. '000123456' for 123456 or
+    '00-0123456'; anything that isn't an EIN becomes missing.
+    '''
+    text = column.str.strip().str.replace('-', '', regex=False).str.replace(r'\.0$', '', regex=True)
+    return text.where(text.str.fullmatch(r'\d{1,9}').fillna(False)).str.zfill(9).astype(TEXT)
 
-    data['ZIPCd'] = data['ZIPCd'].astype(str).str[:5]
+def to_zip(column):
+    '''
+    The first five digits of a ZIP code, as text; anything
+    else becomes missing.
+    '''
+    text = column.str.strip().str[:5]
+    return text.where(text.str.fullmatch(r'\d{1,5}').fillna(False)).str.zfill(5).astype(TEXT)
 
-    if data.isna().any().any():
-        data.fillna(0, inplace=True)
+def convert_types(data):
+    '''
+    Converts the text columns of a chunk to their schema.py
+    types. Missing values stay missing.
+    '''
+    for col in data.columns:
+        kind = input_types.get(col, 'string')
+        if col in ein_input_cols:
+            data[col] = to_ein(data[col])
+        elif col in zip_input_cols:
+            data[col] = to_zip(data[col])
+        elif kind == 'bool':
+            data[col] = to_flags(data[col])
+        elif kind == 'int':
+            data[col] = to_integers(data[col])
+    return data
+
+def typed(data, fields):
+    '''
+    Gives a load table its column names and types from schema.py.
+    '''
+    data.columns = schema.columns(fields)
+    return data.astype(schema.dtypes(fields))
 
-    for col in data.select_dtypes(include='float64').columns.values:
-        # Don't want to lose leading zeros on the EIN numbers
-        if (col != 'latitude') and (col != 'longtitude') and (col != 'EIN'):
-            data[col] = data[col].astype('int64')
+def locate(data, geocoder):
+    '''
+    Fills latitude and longitude of a Sponsors or Grantees table
+    from its street address and ZIP code.
+    Input:
+        data: table from sponsor_tables or grantee_table
+        geocoder: function from (addresses, zip codes) to a
+        Dataframe of latitude and longitude, e.g. a geocode.Geocoder
+    '''
+    coordinates = geocoder(data['address_line_1'], data['zip_code'])
+    data['latitude'] = coordinates['latitude'].to_numpy()
+    data['longitude'] = coordinates['longitude'].to_numpy()
+    return data
 
+def sponsor_tables(data, seen=None, geocoder=None):
+    '''
+    Data cleaning steps for uploading a batch testing csv
+    to the database: Taxperiod, Worth and Sponsors rows
+    for one chunk of Sponsors.
+    Input:
+        data: chunk from iter_input
+        seen: set of sponsor EINs already written; if given,
+        sponsors in it are dropped and new ones added to it
+        geocoder: fills latitude and longitude, see locate
+    Output: dictionary of table name to Dataframe
+    '''
+    data = convert_types(data.copy())
     # Some organizations filed twice in one year, so for sponsor table
     # can just drop these organizations
     # TAX PERIOD TABLE
-    date_data = data.loc[:,['TAXYEAR','TAXYRSTART','TAXYREND','EIN']]
-    date_data.columns = taxperiod_col_names
     # for bulk upload, model has a serial as id (autofield in Django)
     # need to save with an index to make copy export work
-    date_data.to_csv('Taxperiod' + suffix + '.csv', index=True, index_label='id')
-    
-    del data['TAXYRSTART']
-    del data['TAXYREND']
+    date_data = typed(data.loc[:, ['TAXYEAR', 'TAXYRSTART', 'TAXYREND', 'EIN']],
+                      schema.TAXPERIOD_TABLE)
 
     # WORTH TABLE
-    worth_data = data.loc[:,['DonorAdvisedFundsHeldCnt',
+    worth_data = data.loc[:, ['DonorAdvisedFundsHeldCnt',
                     'DonorAdvisedFundsContriAmt',
                     'DonorAdvisedFundsGrantsAmt',
                     'DonorAdvisedFundsVlEOYAmt',
@@ -110,92 +187,155 @@ def update_sponsor_csv(file_path, suffix, drop_duplicates=True):
                     'FundsAndOtherAccountsVlEOYAmt',
                     'EIN',
                     'TAXYEAR']]
-
-    worth_data.columns = worth_col_names
-    worth_data.to_csv('Worth' + suffix + '.csv', index=True, index_label='id')
+    worth_data = typed(worth_data, schema.WORTH_TABLE)
 
     # Copy from for bulk upload; the names need to match and be in the correct order
-    data = data.loc[:,['EIN','NAME','AddressLine1Txt','CityNm','StateAbbreviationCd','ZIPCd']]
-    # Holdouts for geocoding
-    # may just end up using zip code with google maps/open street map API?
-    if 'latitude' not in data.columns:
-        data.insert(6, 'latitude', 0)
-    if 'longitude' not in data.columns:
-        data.insert(7, 'longitude', 0)
-    
-    data.columns = sponsor_col_names
-
-    if drop_duplicates:
-        data.drop_duplicates(subset='sponsor_ein', inplace=True)
-    
-    data.to_csv('Sponsors' + suffix + '.csv', index=False)
+    data = data.loc[:, ['EIN', 'NAME', 'AddressLine1Txt', 'CityNm', 'StateAbbreviationCd', 'ZIPCd']]
+    # filled by locate when a geocoder is given
+    data.insert(6, 'latitude', np.nan)
+    data.insert(7, 'longitude', np.nan)
+    data = typed(data, schema.SPONSOR_TABLE)
 
-    return None
+    if seen is not None:
+        data = data[~data['sponsor_ein'].isin(seen) & ~data['sponsor_ein'].duplicated()]
+        seen.update(data['sponsor_ein'])
+    if geocoder is not None:
+        data = locate(data.copy(), geocoder)
 
-def update_grantee_csv(file_path, suffix, drop_duplicates=True):
+    return {'Taxperiod': date_data, 'Worth': worth_data, 'Sponsors': data}
+
+def donation_table(data):
     '''
-    Data cleaning steps for uploading a batch testing csv
-    to the database.
-    '''   
-    data = pd.read_csv(file_path)
-    try:
-        del data['Unnamed: 0']
-    except KeyError:
-        pass
-
-    data = data.loc[:, ['BusinessNameLine1Txt','AddressLine1Txt',
-                        'CityNm','StateAbbreviationCd',
-                        'ZIPCd','RecipientEIN','IRCSectionDesc']]
-    
+    Donations rows for one chunk of Grantees, after convert_types.
+    Grant type is frequently missing and is left that way.
+    '''
+    data = data.loc[:, ['CashGrantAmt', 'PurposeOfGrantTxt', 'GrantTypeTxt', 'RecipientEIN', 'Sponsor', 'TAXYEAR']].copy()
+    data['PurposeOfGrantTxt'] = data['PurposeOfGrantTxt'].str[:100]
+    data['GrantTypeTxt'] = data['GrantTypeTxt'].str[:50]
+    data = typed(data, schema.DONATION_TABLE)
+
+    data.dropna(subset=['grantee_ein_id'], inplace=True)
+    return data
+
+def grantee_table(data, seen=None, geocoder=None):
+    '''
+    Grantees rows for one chunk of Grantees.
+    Input:
+        data: chunk from iter_input, after convert_types
+        seen: set of grantee EINs already written; if given,
+        grantees in it are dropped and new ones added to it
+        geocoder: fills latitude and longitude, see locate
+    '''
+    data = data.loc[:, ['BusinessNameLine1Txt', 'AddressLine1Txt',
+                        'CityNm', 'StateAbbreviationCd',
+                        'ZIPCd', 'RecipientEIN', 'IRCSectionDesc']].copy()
+
     data.insert(0, 'grantee_ein', data['RecipientEIN'])
-    data.insert(6,'latitude', 0)
-    data.insert(7,'longitude',0)
+    data.insert(6, 'latitude', np.nan)
+    data.insert(7, 'longitude', np.nan)
     del data['RecipientEIN']
-
-    data.columns = grantee_col_names
+    data['IRCSectionDesc'] = data['IRCSectionDesc'].str[:10]
+    data = typed(data, schema.GRANTEE_TABLE)
 
     # get rid of empty rows
     data.dropna(subset=['grantee_ein'], inplace=True)
 
-    data['irs_section_desc'] = data['irs_section_desc'].str[:10]
-
-    if data.isna().any().any():
-        data.fillna(0, inplace=True)
+    if seen is not None:
+        data = data[~data['grantee_ein'].isin(seen) & ~data['grantee_ein'].duplicated()]
+        seen.update(data['grantee_ein'])
+    if geocoder is not None:
+        data = locate(data.copy(), geocoder)
+    return data
 
-    data['zip_code'] = data['zip_code'].astype(str).str.strip('.')
-
-    data['zip_code'] = data['zip_code'].astype(str).str[:5].astype(float).astype('int64')
+def iter_tables(sponsor_file=None, grantee_file=None, chunksize=CHUNKSIZE,
+                tables=TABLES, drop_duplicates=True, grantee_ids=None, geocoder=None):
+    '''
+    Single pass over the Sponsors and Grantees files, producing
+    the five load tables a chunk at a time. Sponsors and grantees
+    seen in earlier chunks are dropped, so each appears once.
+    Input:
+        sponsor_file, grantee_file: files from read_folder.py
+        chunksize: rows read at a time
+        tables: names of the tables wanted
+        drop_duplicates: drop sponsors already written
+        grantee_ids: function giving the grantee id of each row of
+        a grantee chunk, used instead of its EIN, e.g. an
+        entity_resolution.GranteeMap
+        geocoder: fills latitude and longitude of sponsors and
+        grantees, e.g. a geocode.Geocoder
+    Output: generator of (table name, Dataframe)
+    '''
+    if sponsor_file and {'Taxperiod', 'Worth', 'Sponsors'} & set(tables):
+        seen = set() if drop_duplicates else None
+        for data in iter_input(sponsor_file, sponsor_input_cols, chunksize):
+            for name, table in sponsor_tables(data, seen, geocoder).items():
+                if name in tables:
+                    yield (name, table)
+
+    if grantee_file and {'Donations', 'Grantees'} & set(tables):
+        columns = list(dict.fromkeys(donation_input_cols + grantee_input_cols))
+        seen = set()
+        for data in iter_input(grantee_file, columns, chunksize):
+            data = convert_types(data)
+            if grantee_ids is not None:
+                data['RecipientEIN'] = grantee_ids(data)
+            if 'Donations' in tables:
+                yield ('Donations', donation_table(data))
+            if 'Grantees' in tables:
+                yield ('Grantees', grantee_table(data, seen, geocoder))
+
+def write_tables(tables, suffix, names=TABLES):
+    '''
+    Writes (table name, Dataframe) chunks to <name><suffix>.csv,
+    appending after the first chunk. Every table in names gets
+    a file, with just the header if it has no rows.
+    '''
+    started = set()
+    for name, data in tables:
+        fields, index = TABLES[name]
+        data.to_csv(name + suffix + '.csv', mode='a' if name in started else 'w',
+                    header=name not in started, index=index,
+                    index_label='id' if index else None)
+        started.add(name)
+    for name in names:
+        if name not in started:
+            fields, index = TABLES[name]
+            pd.DataFrame(columns=schema.columns(fields)).to_csv(name + suffix + '.csv', index=index,
+                                                 index_label='id' if index else None)
+    return None
 
-    for col in data.select_dtypes(include='float64').columns.values:
-        data[col] = data[col].astype('int64')
+def transform_all(sponsor_file, grantee_file, suffix, chunksize=CHUNKSIZE, grantee_ids=None,
+                  geocoder=None):
+    '''
+    Writes all five load tables in one pass over the inputs.
+    '''
+    write_tables(iter_tables(sponsor_file, grantee_file, chunksize,
+                             grantee_ids=grantee_ids, geocoder=geocoder), suffix)
+    return None
 
-    data.drop_duplicates(subset='grantee_ein', inplace=True)
-    data.to_csv('Grantees' + suffix + '.csv', index=False)
+def update_sponsor_csv(file_path, suffix, drop_duplicates=True):
+    '''
+    Data cleaning steps for uploading a batch testing csv
+    to the database.
+    '''
+    names = ['Taxperiod', 'Worth', 'Sponsors']
+    write_tables(iter_tables(sponsor_file=file_path, tables=names,
+                             drop_duplicates=drop_duplicates), suffix, names)
+    return None
 
+def update_grantee_csv(file_path, suffix, drop_duplicates=True):
+    '''
+    Data cleaning steps for uploading a batch testing csv
+    to the database.
+    '''
+    write_tables(iter_tables(grantee_file=file_path, tables=['Grantees']), suffix, ['Grantees'])
     return None
 
 def update_donation_csv(file_path, suffix, drop_duplicates=True):
-    data = pd.read_csv(file_path)
-
-    data = data.loc[:, ['CashGrantAmt', 'PurposeOfGrantTxt','GrantTypeTxt','RecipientEIN', 'Sponsor','TAXYEAR']]
-    data.columns = donation_col_names
-    data['purpose_of_grant'] = data['purpose_of_grant'].str[:100]
-    data['grant_type'] = data['grant_type'].astype(str).str[:50]
-
-    data.dropna(subset=['grantee_ein_id'], inplace=True)
-    # Need to change this - grant type is frequently null
-    if data.isna().any().any():
-        data.fillna(0, inplace=True)
-
-    for col in data.select_dtypes(include='float64').columns.values:
-        data[col] = data[col].astype('int64')
-    data.index.name = 'id'
-
-    data.to_csv('Donations' + suffix + '.csv', index=True, index_label='id')
+    write_tables(iter_tables(grantee_file=file_path, tables=['Donations']), suffix, ['Donations'])
     return None
 
 
-
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
             description='Clean spreadsheet data \
@@ -206,7 +346,21 @@ if __name__ == "__main__":
                     help='link or file name to csv')
     parser.add_argument('-suffix',type=str,
                     help='suffix for file names')                                                          
+    parser.add_argument('-chunksize',type=int, default=CHUNKSIZE,
+                    help='number of rows to read at a time')
+    parser.add_argument('-grantee_map',type=str,
+                    help='grantee id map from entity_resolution.py')
+    parser.add_argument('-geocode',type=str,
+                    help='ZIP code centroid file for geocode.py')
+    parser.add_argument('-addresses',type=str,
+                    help='optional street address coordinates for geocode.py')
     args = parser.parse_args()
-    update_sponsor_csv(file_path = args.sponsor, suffix=args.suffix)
-    update_donation_csv(file_path = args.grantee, suffix=args.suffix)
-    update_grantee_csv(file_path = args.grantee, suffix=args.suffix)
\ No newline at end of file
+    grantee_ids = None
+    if args.grantee_map:
+        import entity_resolution
+        grantee_ids = entity_resolution.GranteeMap(entity_resolution.read_map(args.grantee_map))
+    geocoder = None
+    if args.geocode:
+        import geocode
+        geocoder = geocode.Geocoder(args.geocode, args.addresses)
+    transform_all(args.sponsor, args.grantee, args.suffix, args.chunksize, grantee_ids, geocoder)
\ No newline at end of file